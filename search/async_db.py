@@ -0,0 +1,166 @@
+import asyncio
+import os
+import re
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import startup_profile
+
+ENV = os.environ.get("ENV")
+
+# connections the search path keeps for itself; the responders keep using db.connection_manager
+ASYNC_DB_POOL_SIZE = int(os.environ.get("ASYNC_DB_POOL_SIZE", 4))
+# ASYNC_DB_DRIVER=threads skips asyncpg and runs statements on the psycopg2 pool from a few threads
+ASYNC_DB_DRIVER = os.environ.get("ASYNC_DB_DRIVER", "asyncpg")
+# asyncpg closes connections idle for longer than this. their maximum age is db.CONNECTION_MAX_LIFETIME, same as the
+# psycopg2 pool's: asyncpg has no such setting, so the whole pool is replaced once it's that old
+ASYNC_DB_IDLE_TIMEOUT = float(os.environ.get("ASYNC_DB_IDLE_TIMEOUT", 5 * 60))
+
+PLACEHOLDER = re.compile(r'%s')
+
+
+def numbered_placeholders(sql):
+    '''
+    the sql constants are written for psycopg2 (%s); asyncpg wants $1, $2, ...
+    '''
+    counter = iter(range(1, 10000))
+    return PLACEHOLDER.sub(lambda match: '$' + str(next(counter)), sql)
+
+
+class AsyncDB:
+    '''
+    database access for coroutines on the search path, so lookups and writes overlap with the https requests
+    in flight instead of freezing the loop. statements use psycopg2 style placeholders either way and rows
+    come back as tuples. asyncpg is used when it's installed; without it (or with ASYNC_DB_DRIVER=threads)
+    statements run on the psycopg2 pool from a small thread pool, which still keeps the loop free.
+    jsonb goes in as json text; select it as ::text to get json text back from both drivers
+    '''
+
+    def __init__(self, pool_size=ASYNC_DB_POOL_SIZE, driver=ASYNC_DB_DRIVER):
+        self.pool_size = pool_size
+        self.driver = driver
+        self.pool = None
+        self.pool_loop = None
+        self.pool_created_at = None
+        self.pool_locks = weakref.WeakKeyDictionary()  # loop -> lock, so concurrent first queries make one pool
+        self.retiring = set()  # close() of pools that were replaced, still waiting for their connections back
+        self.executor = None
+        self.statements = {}  # psycopg2 sql -> asyncpg sql
+
+    def use_asyncpg(self):
+        if self.driver != "asyncpg":
+            return False
+        try:
+            startup_profile.load('asyncpg')
+            return True
+        except ImportError:
+            print("asyncpg not available, running search path queries on threads")
+            self.driver = "threads"
+            return False
+
+    def pool_usable(self, loop):
+        return (self.pool is not None and self.pool_loop is loop
+                and time.monotonic() - self.pool_created_at < db.CONNECTION_MAX_LIFETIME)
+
+    def retire(self, pool):
+        '''
+        close() lets the connections in use finish first, so it runs in the background
+        '''
+        task = asyncio.get_running_loop().create_task(pool.close())
+        self.retiring.add(task)
+        task.add_done_callback(self.retiring.discard)
+
+    async def get_pool(self):
+        loop = asyncio.get_running_loop()
+        if self.pool_usable(loop):
+            return self.pool
+        lock = self.pool_locks.get(loop)
+        if lock is None:
+            lock = self.pool_locks[loop] = asyncio.Lock()
+        async with lock:
+            if not self.pool_usable(loop):
+                # a pool belongs to the loop it was made on; the runtime keeps one loop, so this is once per
+                # container, then again each time the pool reaches its maximum age
+                expired = self.pool if self.pool_loop is loop else None
+                asyncpg = startup_profile.load('asyncpg')
+                with startup_profile.timed('async db pool'):
+                    self.pool = await asyncpg.create_pool(
+                        host=db.DB_HOST_NAME, port=db.DB_PORT, database=db.DB_NAME,
+                        user=db.secret_params['db_username'], password=db.secret_params['db_password'],
+                        min_size=1, max_size=self.pool_size,
+                        max_inactive_connection_lifetime=ASYNC_DB_IDLE_TIMEOUT)
+                self.pool_loop = loop
+                self.pool_created_at = time.monotonic()
+                if expired is not None:
+                    self.retire(expired)
+        return self.pool
+
+    def translate(self, sql):
+        if sql not in self.statements:
+            self.statements[sql] = numbered_placeholders(sql)
+        return self.statements[sql]
+
+    def run_on_thread(self, work):
+        '''
+        work gets a psycopg2 cursor on an autocommit connection
+        '''
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='db')
+
+        def run():
+            with db.connection_manager.connection(autocommit=True) as connection:
+                with connection.cursor() as cur:
+                    return work(cur)
+
+        return asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+    async def execute(self, sql, params=()):
+        if self.use_asyncpg():
+            pool = await self.get_pool()
+            # no parameters is the simple query protocol, which also takes several statements at once
+            if params:
+                await pool.execute(self.translate(sql), *params)
+            else:
+                await pool.execute(sql)
+            return
+        await self.run_on_thread(lambda cur: cur.execute(sql, params or None))
+
+    async def executemany(self, sql, rows):
+        if not rows:
+            return
+        if self.use_asyncpg():
+            pool = await self.get_pool()
+            await pool.executemany(self.translate(sql), rows)
+            return
+        await self.run_on_thread(lambda cur: cur.executemany(sql, rows))
+
+    async def fetch(self, sql, params=()):
+        if self.use_asyncpg():
+            pool = await self.get_pool()
+            return [tuple(record) for record in await pool.fetch(self.translate(sql), *params)]
+
+        def fetch(cur):
+            cur.execute(sql, params)
+            return cur.fetchall()
+
+        return await self.run_on_thread(fetch)
+
+    async def fetchrow(self, sql, params=()):
+        rows = await self.fetch(sql, params)
+        return rows[0] if rows else None
+
+    async def close(self):
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            await pool.close()
+        if self.retiring:
+            await asyncio.gather(*self.retiring, return_exceptions=True)
+
+
+async_db = AsyncDB()
+
+
+def get_async_db():
+    return async_db
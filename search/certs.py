@@ -0,0 +1,38 @@
+import startup_profile
+
+cqcert_https = ''
+cqkey_https = ''
+trusted_https = ''
+
+CERT_FILE = '/tmp/cqcert.crt'
+KEY_FILE = '/tmp/cqkey.key'
+TRUSTED_FILE = '/tmp/trusted.pem'
+
+files_written = False
+secretsmanager = None
+
+
+def get_secretsmanager():
+    '''
+    boto3 client for secrets manager, created on first use rather than at import
+    '''
+    global secretsmanager
+    if secretsmanager is None:
+        import boto3
+        secretsmanager = boto3.client('secretsmanager')
+    return secretsmanager
+
+
+def ensure_cert_files():
+    '''
+    writes the carequality cert, key and trust store to /tmp the first time an initiator needs them,
+    instead of on import. /tmp survives warm invocations, so this only happens once per container
+    '''
+    global files_written
+    if files_written:
+        return
+    with startup_profile.timed('cert files'):
+        for path, contents in [(CERT_FILE, cqcert_https), (KEY_FILE, cqkey_https), (TRUSTED_FILE, trusted_https)]:
+            with open(path, 'w') as f:
+                f.write(contents)
+    files_written = True
@@ -1,39 +1,28 @@
 import asyncio
-import boto3
 import json
 import os
 import random
-import re
 from datetime import datetime, timezone
 from typing import List, Tuple, Union
 
-import fhirbase
-import psycopg2
+import document_store
+import document_sync
+import patient_locator
+import retrieval_scheduler
+from db import connection_manager
+from document_persistence import DocumentPersister
 from iti38initiator import ITI38Initiator
-from iti39initiator import ITI39Initiator
 from iti55initiator import ITI55Initiator
-from lxml import etree
+from retrieval_planner import RetrievalPlanner
+from parse_pool import get_parse_stage
 from patient_metadata import PatientMetadata
-
-from utils import extract_envelope_content
+from runtime import get_runtime
 
 ENV = os.environ.get("ENV")
 
-DB_HOST_NAME = ''
-secretsmanager = boto3.client('secretsmanager')
 secret_id = ""
 secret_params = {}
 
-cqcert_https = ''
-cqkey_https = ''
-trusted_https = ''
-with open('/tmp/cqcert.crt', 'w') as f:
-    f.write(cqcert_https)
-with open('/tmp/cqkey.key', 'w') as f:
-    f.write(cqkey_https)
-with open('/tmp/trusted.pem', 'w') as f:
-    f.write(trusted_https)
-
 doc_sorting_schema = {
     '11488-4': "ConsultationNote.hbs",
     '11506-3': "ProgressNote.hbs",
@@ -48,47 +37,151 @@ doc_sorting_schema = {
 
 
 class CQSearch:
-    def __init__(self, responders, patient_metadata, user_qualifications, national=False):
+    def __init__(self, responders, patient_metadata, user_qualifications, national=False, refresh=False,
+                 doc_filter=None, retrieval_budget=None, deduplicator=None):
         self.user_qualifications = user_qualifications
         self.national = national
+        self.refresh = refresh  # forced refresh: ask every gateway, whatever the locator remembers
+        self.doc_filter = doc_filter  # a document_filter.DocumentFilter every pipeline applies, or None
+        # shared by every pipeline's ITI-39s; pass one in to share it with another search of the same request
+        self.retrieval_budget = retrieval_budget
+        self.planner = None
+        # same for document dedup: a document found by the national and the regional search is kept once
+        self.deduplicator = deduplicator if deduplicator is not None else document_store.DocumentDeduplicator()
+        self.persister = None
+        self.new_documents = []
+
+        # borrowed from the container-wide pool; handed back by release_connection
+        self.app_connection = connection_manager.get_connection(autocommit=True)
+        self.pipelines = []
+        self.remaining_pipelines = []
+        self.patient_metadata = PatientMetadata(patient_metadata)
 
-        self.app_connection = psycopg2.connect(
-            host=DB_HOST_NAME,
-            port=,
-            user=secret_params['db_username'],
-            password=secret_params['db_password'],
-            database=''
-        )
-        self.app_connection.autocommit = True
-        self.pipelines = [
+        self.patients_found = []  # one entry per pipeline that has been through 55, in self.pipelines order
+        self.internal_additions = {"pid": None, "doc_ids": []}
+        self.add_responders(responders)
+
+        # gateways that matched this patient recently skip ITI-55 and go straight to 38,
+        # gateways that recently answered NF / Multiple are skipped altogether
+        self.demographics_hash = patient_locator.demographics_hash(self.patient_metadata)
+        self.located = {} if refresh else patient_locator.lookup(self.app_connection.cursor(), self.demographics_hash)
+        self.known_negative = {} if refresh else patient_locator.lookup_negative(
+            self.app_connection.cursor(), self.demographics_hash)
+        self.rediscovery_tasks = []
+
+    def add_responders(self, responders):
+        '''
+        adds pipelines for more directory endpoints, skipping ones this search already has. returns the new pipelines,
+        which still need a collect_possible_patients
+        '''
+        known = set(pipeline.name for pipeline in self.pipelines)
+        added = [
             Pipeline(
                 responder['name'],
                 responder['oid'],
                 responder['iti55_responder'],
                 responder['iti38_responder'],
                 responder['iti39_responder'],
-                self.user_qualifications, self.app_connection, self.national)
-            for responder in responders]
-        self.remaining_pipelines = []
-        self.patient_metadata = PatientMetadata(patient_metadata)
+                self.user_qualifications, self.app_connection, self.national, refresh=self.refresh)
+            for responder in responders if responder['name'] not in known]
+        for pipeline in added:
+            pipeline.doc_filter = self.doc_filter
+        self.pipelines.extend(added)
+        return added
 
-        self.patients_found = []
-        self.internal_additions = {"pid": None, "doc_ids": []}
+    def responder_names(self):
+        return [pipeline.name for pipeline in self.pipelines]
 
-    async def gather_55_pipelines(self):
-        return await asyncio.gather(*[pipeline.initiate_xcpd_with_patient_metadata(self.patient_metadata) for pipeline in self.pipelines])
+    async def gather_55_pipelines(self, pipelines=None):
+        pipelines = self.pipelines if pipelines is None else pipelines
+        return await asyncio.gather(*[pipeline.initiate_xcpd_with_patient_metadata(self.patient_metadata) for pipeline in pipelines])
 
-    def collect_all_possible_patients(self):
-        all_found_metadata = asyncio.run(self.gather_55_pipelines())
-        self.patients_found = [
+    async def collect_possible_patients(self, pipelines=None):
+        '''
+        ITI-55 for pipelines (default all of them) on the running loop, so it can be gathered with another search.
+        pipelines have to be collected in the order they were added
+        '''
+        pipelines = self.pipelines[len(self.patients_found):] if pipelines is None else pipelines
+        located_pipelines = [pipeline for pipeline in pipelines if pipeline.oid in self.located]
+        negative_pipelines = [pipeline for pipeline in pipelines
+                              if pipeline.oid not in self.located and pipeline.oid in self.known_negative]
+        queried_pipelines = [pipeline for pipeline in pipelines
+                             if pipeline.oid not in self.located and pipeline.oid not in self.known_negative]
+        if located_pipelines:
+            print("patient locator hits, skipping 55 for", [pipeline.name for pipeline in located_pipelines])
+        patient_locator.negative_stats["hits"] += len(negative_pipelines)
+        patient_locator.negative_stats["misses"] += len(queried_pipelines)
+
+        found_by_pipeline = {
+            pipeline.name: pipeline.use_located_patient(self.located[pipeline.oid]) for pipeline in located_pipelines}
+        found_by_pipeline.update(
+            (pipeline.name, self.known_negative[pipeline.oid]) for pipeline in negative_pipelines)
+        queried_metadata = await self.gather_55_pipelines(queried_pipelines)
+        found_by_pipeline.update(
+            (pipeline.name, found_metadata) for pipeline, found_metadata in zip(queried_pipelines, queried_metadata))
+
+        async_db = get_runtime().async_db()
+        await patient_locator.record(async_db, self.demographics_hash,
+                                     [pipeline for pipeline in queried_pipelines
+                                      if isinstance(found_by_pipeline[pipeline.name], PatientMetadata)])
+        await patient_locator.record_negative(async_db, self.demographics_hash,
+                                              {pipeline.oid: found_by_pipeline[pipeline.name]
+                                               for pipeline in queried_pipelines})
+        for pipeline in located_pipelines:
+            if patient_locator.needs_rediscovery(self.located[pipeline.oid]):
+                self.rediscovery_tasks.append(asyncio.ensure_future(self.rediscover(pipeline)))
+
+        self.patients_found.extend([
             {
                 "pipeline": pipeline.name,
-                "patient_metadata": found_metadata
+                "patient_metadata": found_by_pipeline[pipeline.name]
             }
-            for pipeline, found_metadata in zip(self.pipelines, all_found_metadata)
-        ]
+            for pipeline in pipelines
+        ])
         return self.patients_found.copy()
 
+    async def rediscover(self, pipeline):
+        '''
+        background ITI-55 for a gateway served from the locator, on a separate pipeline so the one fetching documents
+        is left alone. it runs alongside 38/39; finish_rediscovery waits for it before the handler returns
+        '''
+        try:
+            probe = Pipeline(pipeline.name, pipeline.oid, pipeline.url55resp, pipeline.url38resp, pipeline.url39resp,
+                             self.user_qualifications, self.app_connection, self.national)
+            found = await probe.initiate_xcpd_with_patient_metadata(self.patient_metadata)
+            async_db = get_runtime().async_db()
+            if isinstance(found, PatientMetadata):
+                await patient_locator.record(async_db, self.demographics_hash, [probe])
+            elif found in ["NF", "Multiple"]:
+                await patient_locator.forget(async_db, self.demographics_hash, pipeline.oid)
+                await patient_locator.record_negative(async_db, self.demographics_hash, {pipeline.oid: found})
+        except Exception as e:
+            print("patient rediscovery failed for", pipeline.name, repr(e))
+
+    async def wait_for_rediscovery(self, timeout):
+        tasks, self.rediscovery_tasks = self.rediscovery_tasks, []
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            print("cancelled", len(pending), "patient rediscoveries still running after", timeout, "seconds")
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                print("patient rediscovery failed,", repr(result))
+
+    def finish_rediscovery(self, timeout=patient_locator.PATIENT_LOCATOR_REDISCOVER_TIMEOUT):
+        '''
+        call before the handler returns: nothing of this search is left on the loop for the next invocation
+        '''
+        if self.rediscovery_tasks:
+            get_runtime().run(self.wait_for_rediscovery(timeout))
+
+    def collect_all_possible_patients(self):
+        self.patients_found = []
+        return get_runtime().run(self.collect_possible_patients())
+
     def conflict_checker(self):
         '''
         check for conflicts
@@ -101,6 +194,7 @@ class CQSearch:
         # forthcoming: patient matching module
 
         past_zips = []  # useful from national search to regional search
+        self.remaining_pipelines = []
         for i in range(len(self.patients_found)):
             if type(self.patients_found[i]['patient_metadata']) in [str, type(None)]:
                 continue
@@ -118,8 +212,82 @@ class CQSearch:
         return [pipeline.name for pipeline in self.remaining_pipelines]
 
     async def gather_38_39_pipelines(self):
+        '''
+        ITI-38 per pipeline, then ITI-39 for all of them at once: requests for the same gateway, home community
+        and repository are merged across pipelines by the planner
+        '''
         print("remaining pipelines", self.remaining_pipelines)
-        return await asyncio.gather(*[pipeline.get_docs() for pipeline in self.remaining_pipelines])
+        if self.retrieval_budget is None:
+            self.retrieval_budget = retrieval_scheduler.RetrievalBudget()
+        for pipeline in self.remaining_pipelines:
+            pipeline.internal_pid = self.internal_additions["pid"]
+        await asyncio.gather(*[pipeline.query_documents() for pipeline in self.remaining_pipelines])
+        # documents are written as they come in, while the rest are still being retrieved
+        self.persister = DocumentPersister(self.internal_additions["pid"])
+        self.persister.start()
+        # and converted to fhir as they come in, on the conversion stage's workers
+        converter = get_runtime().conversion_stage()
+        for pipeline in self.remaining_pipelines:
+            pipeline.deduplicator = self.deduplicator
+            pipeline.persister = self.persister
+            pipeline.converter = converter if converter.enabled() else None
+        # documents we already hold (including what a sync for another internal patient brought in) aren't
+        # retrieved again, only linked to this search's patient
+        for entry, pipeline in await self.deduplicator.skip_stored(get_runtime().async_db(), self.remaining_pipelines):
+            self.persister.link(entry, pipeline)
+        self.planner = RetrievalPlanner(self.remaining_pipelines, doc_sorting_schema)
+        await self.planner.run([self.retrieval_budget])
+        # conversions queue their bundles on the persister, so they finish before it closes
+        await self.finish_conversions()
+        self.new_documents = await self.persister.close()
+        await asyncio.gather(*[pipeline.record_sync() for pipeline in self.remaining_pipelines])
+        return [pipeline.sorted_docs() for pipeline in self.remaining_pipelines]
+
+    async def continue_deferred(self, seconds):
+        deadline = asyncio.get_running_loop().time() + seconds
+        self.persister.start()
+        try:
+            try:
+                await asyncio.wait_for(self.planner.continue_deferred(seconds), seconds)
+            except asyncio.TimeoutError:
+                print("out of time for deferred documents, the next sync picks up the rest")
+            await self.finish_conversions(max(0, deadline - asyncio.get_running_loop().time()))
+        finally:
+            written = await self.persister.close()
+        print("persisted", len(written), "deferred documents")
+        return written
+
+    async def finish_conversions(self, timeout=None):
+        '''
+        waits for the conversions started so far; with a timeout, the ones still running after it are cancelled
+        '''
+        conversions = [conversion for pipeline in self.remaining_pipelines for conversion in pipeline.conversions]
+        for pipeline in self.remaining_pipelines:
+            pipeline.conversions = []
+        if not conversions:
+            return
+        done, pending = await asyncio.wait(conversions, timeout=timeout)
+        for conversion in pending:
+            conversion.cancel()
+        await asyncio.gather(*conversions, return_exceptions=True)
+        print("conversion", get_runtime().conversion_stage().stats(), len(pending), "cancelled")
+
+    def retrieve_deferred(self, seconds):
+        '''
+        documents left over once the retrieval budget ran out, fetched with the time the invocation has left
+        (seconds), before the handler returns. what doesn't fit is picked up by the next sync, since the
+        watermark never moves past a document that wasn't retrieved
+        '''
+        if not retrieval_scheduler.RETRIEVAL_CONTINUE or self.planner is None or not self.planner.deferred:
+            return []
+        if seconds <= 0:
+            print("no time left for", len(self.planner.deferred), "deferred documents")
+            return []
+        written = get_runtime().run(self.continue_deferred(seconds))
+        self.new_documents.extend(written)
+        doc_ids = [item["record"]["doc_id"] for item in written]
+        self.internal_additions["doc_ids"].extend(doc_ids)
+        return doc_ids
 
     def find_docs_for_conflict_free_patients(self):
         '''
@@ -127,32 +295,36 @@ class CQSearch:
         docs will end up in cq_notes
         '''
         print("in here, find_docs_for_conflict_free_patients")
-        all_retrieved_xmls_by_loinc = asyncio.run(self.gather_38_39_pipelines())
+        all_retrieved_doc_ids_by_loinc = get_runtime().run(self.gather_38_39_pipelines())
         self.all_additions_in_db = [
             {"pipeline": pipeline.name, "docs": docs[0],
              "fhir_id": docs[1]} for pipeline,
-            docs in zip(self.remaining_pipelines, all_retrieved_xmls_by_loinc)]
-
-        cur = self.app_connection.cursor()
-        internal_pid = self.internal_additions["pid"]
-        fhir_ids = str([addition["fhir_id"] for addition in self.all_additions_in_db])
-
-        # insert everything here
+            docs in zip(self.remaining_pipelines, all_retrieved_doc_ids_by_loinc)]
 
-        self.app_connection.close()
+        # everything was inserted by the persister as it arrived
+        print("documents,", len(self.new_documents), "new,", self.persister.failed, "failed,",
+              self.deduplicator.stats())
+        self.internal_additions["doc_ids"] = [item["record"]["doc_id"] for item in self.new_documents]
+        self.release_connection()
         return self.internal_additions.copy()
 
+    def release_connection(self):
+        if self.app_connection is not None:
+            connection_manager.put_connection(self.app_connection)
+            self.app_connection = None
+
 
 class Pipeline:
     def __init__(
             self, name, oid, url55resp, url38resp, url39resp, user_qualifications, connection,
-            national=False) -> None:
+            national=False, refresh=False) -> None:
         self.name = name
         self.oid = oid
         self.url55resp = url55resp
         self.url38resp = url38resp
         self.url39resp = url39resp
         self.national = national
+        self.refresh = refresh
 
         self.user_qualifications = user_qualifications
         for key, value in user_qualifications.items():
@@ -163,9 +335,9 @@ class Pipeline:
         self.iti55initiator = None
         self.iti38initiator = None
         self.iti39initiators = []  # at most 10 doc requests per iti39, so need more than 1 initiators
-        self.received_55_response = None  # raw, non-preprocessed strings of response.text
+        self.received_55_response = None  # raw response bytes, parsed once
         self.received_38_response = None
-        self.received_39_responses = []
+        self.received_39_counts = []  # documents received per ITI-39 request; the documents themselves go to the persister
 
         # for 55
         self.patient_metadata = None
@@ -173,22 +345,40 @@ class Pipeline:
         # for 38
         self.patient_ids = []  # list of (patient_root, patient_extension)
         self.return_type = "LeafClass"  # can be overridden to ObjectRef, but ObjectRef is mostly useless
-        # a place to put a filter on the documents we want to process; if None, we process all documents. maybe size and type (fhir or ccd)
+        # a document_filter.DocumentFilter on the documents we want to process; if None, we process all documents
         self.doc_filter = None
 
+        # what an earlier sync with this gateway already brought in for the same internal patient (see document_sync)
+        self.internal_pid = None  # the search's pid, set by the CQSearch
+        self.sync_watermark = None
+        self.synced_entry_uuids = set()
+
         # for 39
-        # list of {"pid": patient_id, "doc_id": document_unique_id, "rid": repository_id_for_doc}
+        # list of {"pid": patient_id, "doc_id": document_unique_id, "rid": repository_id_for_doc, "entry_uuid", ...}
         self.pids_and_doc_ids = []
-
-        # for fhir converter
+        self.entries_by_doc_id = {}  # doc_id -> its pids_and_doc_ids entry, for typing documents as they arrive
+        self.retrieved_doc_ids = set()
+        self.retrieval_budget = None  # this pipeline's share, set once its documents are listed
+        self.deduplicator = None  # a document_store.DocumentDeduplicator, shared by the search
+        self.persister = None  # a document_persistence.DocumentPersister, shared by the search
+        self.converter = None  # the conversion_stage.ConversionStage, when a converter is configured
+        self.conversions = []  # conversion tasks, started as documents arrive
+
+        # doc ids by loinc, and the doc ids that were converted to fhir. the documents and bundles themselves are
+        # only held until the persister has written them
         self.docs_found = {"converted_fhir": []}
 
-
-        self.fb = fhirbase.FHIRBase(connection)
-
     def __str__(self) -> str:
         return f"object with OID: {self.oid}"
 
+    def use_located_patient(self, located) -> PatientMetadata:
+        '''
+        takes the patient ids and metadata from an earlier ITI-55 match (see patient_locator) instead of sending one
+        '''
+        self.patient_metadata = PatientMetadata(located["patient_metadata"])
+        self.patient_ids = located["patient_ids"]
+        return self.patient_metadata
+
     async def initiate_xcpd_with_patient_metadata(self, patient_metadata) -> Union[Tuple, str, None]:
         self.patient_metadata = patient_metadata
         # translate from patient_metadata to params for ITI55
@@ -201,263 +391,152 @@ class Pipeline:
             user_qualifications=self.user_qualifications,
             national=self.national
         )
-        self.received_55_response = await self.iti55initiator.send_request()  # set this to the response.text
+        self.received_55_response = await self.iti55initiator.send_request()  # raw response bytes
         # post-process to get patient metadata as returned from 55, to prepare for conflict checking
         # also get one pair of patient_root, patient id and set self.patient_ids
-        found_patient = self.extract_patient_metadata_and_pid()[0]
-        if found_patient in ["NF", "Timeout", "Multiple"]:
+        found_patient = (await self.extract_patient_metadata_and_pid())[0]
+        if found_patient in ["NF", "Timeout", "Multiple", "Error"]:
             return found_patient
         else:
             return found_patient
 
-    def extract_patient_metadata_and_pid(self) -> Union[Tuple[PatientMetadata, List],
-                                                        Tuple[str, str]]:
+    async def extract_patient_metadata_and_pid(self) -> Union[Tuple[PatientMetadata, List],
+                                                              Tuple[str, str]]:
         # if one found, organize the metadata in a dict. if none found, set to "NF". if multiple found, set to "Multiple"
-        # parse the response
+        # "Error" when the gateway didn't answer the question: an http error, a fault, or something we can't read
+        # the parse itself runs on the parse stage, off the event loop
         preparsed = self.received_55_response
         try:
             if preparsed is None:
                 return "Timeout", ""
-            if preparsed == "" or extract_envelope_content(preparsed) is None:
-                return "NF", ""
-
-            try:
-                response_tree = etree.fromstring(extract_envelope_content(preparsed))
-            except:
-                print("unable to make a tree out of the envelope")
-                print("preparsed", preparsed)
-                return "NF", ""
-
-            # extract queryResponseCode and validates that it says "OK" which means at least one patient found
-            qrc_element = response_tree.find('.//{*}queryResponseCode')
-            if qrc_element is None:
-                return "NF", ""
-            query_response_code = qrc_element.attrib['code']
-
-            if query_response_code != 'OK':
-                return "NF", ""
-            else:  # one or multiple
-                # if one registrationEvent, we have one patient
-                # if multiple registrationEvents, we have multiple patients all fitting
-                # if zero registrationEvents, we have multiple patients all possible but not fitting
-                registration_events = response_tree.findall('.//{*}registrationEvent')
-                if not registration_events or len(registration_events) == 0:
-                    # > 1 close matches with 0 exact match
-                    return "NF", ""
-                elif len(registration_events) == 1:
-                    patient = registration_events[0].find('.//{*}patient')
-                    patient_metadata_dict = {}
-                    patient_root = patient.find('.//{*}id').attrib['root']
-                    patient_id_ext = patient.find('.//{*}id').attrib['extension']
-
-                    try:
-                        patient_metadata_dict['given_name'] = patient.find('.//{*}given').text
-                    except AttributeError:
-                        patient_metadata_dict['given_name'] = None
-
-                    try:
-                        patient_metadata_dict['family_name'] = patient.find('.//{*}family').text
-                    except AttributeError:
-                        patient_metadata_dict['family_name'] = None
-
-                    try:
-                        patient_metadata_dict['administrative_gender_code'] = patient.find(
-                            './/{*}administrativeGenderCode').attrib['code']
-                    except (AttributeError, KeyError):
-                        patient_metadata_dict['administrative_gender_code'] = None
-
-                    try:
-                        patient_metadata_dict['birth_time'] = patient.find(
-                            './/{*}birthTime').attrib['value']
-                    except (AttributeError, KeyError):
-                        patient_metadata_dict['birth_time'] = None
-
-                    try:
-                        patient_metadata_dict['phone_number'] = patient.find(
-                            './/{*}telecom').attrib['value']
-                    except (AttributeError, KeyError):
-                        patient_metadata_dict['phone_number'] = None
-
-                    patient_address = patient.find('.//{*}addr')
-
-                    try:
-                        patient_metadata_dict['street_address_line'] = patient_address.find(
-                            './/{*}streetAddressLine').text
-                    except AttributeError:
-                        patient_metadata_dict['street_address_line'] = None
-
-                    try:
-                        patient_metadata_dict['city'] = patient_address.find('.//{*}city').text
-                    except AttributeError:
-                        patient_metadata_dict['city'] = None
-
-                    try:
-                        patient_metadata_dict['state'] = patient_address.find('.//{*}state').text
-                    except AttributeError:
-                        patient_metadata_dict['state'] = None
-
-                    try:
-                        patient_metadata_dict['postal_code'] = patient_address.find(
-                            './/{*}postalCode').text
-                    except AttributeError:
-                        patient_metadata_dict['postal_code'] = None
-
-                    try:
-                        patient_metadata_dict['country'] = patient_address.find(
-                            './/{*}country').text
-                    except AttributeError:
-                        patient_metadata_dict['country'] = None
-
-                    self.patient_metadata = PatientMetadata(patient_metadata_dict)
-                    self.patient_ids = [(patient_root, patient_id_ext)]
-                    return self.patient_metadata, [(patient_root, patient_id_ext)]
-                else:
-                    return "Multiple", ""
+            http_status = self.iti55initiator.http_status if self.iti55initiator is not None else None
+            if http_status is not None and not 200 <= http_status < 300:
+                print(self.name, "answered ITI-55 with http", http_status)
+                return "Error", ""
+            status, found = await get_parse_stage().xcpd_response(preparsed)
+            if status != "found":
+                return status, ""
+            patient_id, patient_metadata_dict = found
+            self.patient_metadata = PatientMetadata(patient_metadata_dict)
+            self.patient_ids = [patient_id]
+            return self.patient_metadata, [patient_id]
         except Exception as e:
             print("error in extract_patient_metadata_and_pid", e)
-            return "NF", ""
-
+            return "Error", ""
 
-    async def get_docs(self):
-        # trigger ITI38, ITI39
+    async def get_docs(self, retrieval_budget=None):
+        '''
+        ITI-38 and ITI-39 for this pipeline alone; a CQSearch retrieves for all its pipelines together
+        '''
+        await self.query_documents()
+        budgets = [retrieval_budget] if retrieval_budget is not None else []
+        planner = RetrievalPlanner([self], doc_sorting_schema)
+        await planner.run(budgets)
+        await self.record_sync()
+        return self.sorted_docs()
+
+    async def query_documents(self):
+        # trigger ITI38
+        # a gateway we've synced before is only asked for documents created since then
+        if not self.refresh:
+            self.sync_watermark, self.synced_entry_uuids = await document_sync.load(
+                get_runtime().async_db(), self.oid, self.patient_ids, self.internal_pid)
         iti38params = {"pids": self.patient_ids,  # these are the pids internal to other people's system
-                       "returntype": "LeafClass"}
+                       "returntype": "LeafClass",
+                       "extra_slots": self.doc_filter.query_slots(self.oid, creation_time_from=self.sync_watermark)
+                       if self.doc_filter is not None else document_sync.query_slots(self.sync_watermark)}
         await (asyncio.sleep(random.randrange(1)))
         self.iti38initiator = ITI38Initiator(
             params=iti38params, responder_url=self.url38resp, responder_hcid=self.oid,
             user_qualifications=self.user_qualifications)
         self.received_38_response = await self.iti38initiator.send_request()
-        print("in get docs, received 38 response", self.received_38_response)
-        self.extract_ITI39_params()
+        print("in get docs, received 38 response,",
+              len(self.received_38_response) if self.received_38_response is not None else None, "bytes")
+        await self.extract_ITI39_params()
         print("pids and doc ids and loincs", self.pids_and_doc_ids)
         # break into chunks of 1 per request. epic complains if > 10 per request. 1 per request also allows for more async
-        # unfortunately some endpoints complain with 429, so I'm going with chunks of 5
-        for i in range(0, len(self.pids_and_doc_ids), 5):
-            try:
-                iti_39_initiator = ITI39Initiator(
-                    params={"pid_and_doc_ids": self.pids_and_doc_ids[i:i+5]},
-                    responder_url=self.url39resp,
-                    responder_hcid=self.oid,
-                    user_qualifications=self.user_qualifications)
-                self.iti39initiators.append(iti_39_initiator)
-            except:
-                print("issue creating iti39 initiator")
-                continue
-
-        self.received_39_responses = await asyncio.gather(*[
-            self.iti39initiators[i].send_request()
-            for i in range(len(self.iti39initiators))
-        ])
-        return self.extract_full_docs_and_sort()
-
-    def extract_ITI39_params(self) -> List:
+        # unfortunately some endpoints complain with 429, so I'm going with chunks of 5 (RETRIEVAL_CHUNK_SIZE).
+        # chunks go out most wanted first, until this pipeline's or the search's budget runs out
+        self.retrieval_budget = retrieval_scheduler.RetrievalBudget(retrieval_scheduler.RETRIEVAL_PIPELINE_BYTES,
+                                                                    retrieval_scheduler.RETRIEVAL_PIPELINE_SECONDS)
+        return self.pids_and_doc_ids
+
+    async def record_sync(self):
+        if self.received_38_response is not None:
+            await document_sync.record(
+                get_runtime().async_db(), self.oid, self.patient_ids, self.internal_pid, self.pids_and_doc_ids,
+                set(pair["entry_uuid"] for pair in self.pids_and_doc_ids if pair["doc_id"] in self.retrieved_doc_ids),
+                self.sync_watermark, advance=self.doc_filter is None)
+
+    async def extract_ITI39_params(self) -> List:
         '''
         parse self.received_38_response to get what's needed for iti39 call
         '''
-        self.filter = set([])
-        preparsed = self.received_38_response
-        preparsed = extract_envelope_content(preparsed)
-        if preparsed is None:  # Timed out probably
-            return []
-
-        try:
-            response_tree = etree.fromstring(preparsed)
-        except:
-            print("unable to make a tree of the envelope")
-            print("preparsed,", preparsed)
+        if self.received_38_response is None:  # Timed out probably
             return []
 
         try:
-            # extract a list of extrinsic objects
-            extrinsic_objects = response_tree.findall('.//{*}ExtrinsicObject')
-            self.pids_and_doc_ids = []
-            # for each extrinsic object, get all its classification
-            for extrinsic_object in extrinsic_objects:
-                object_done = False
-                # try filling rid with Slot first
-                rid = None
-                replacement_hcid = None
-                try:
-                    # for surescripts docs can be at a different hcid as the patient
-                    replacement_hcid = extrinsic_object.attrib['home'].strip("urn:oid:")
-                except:
-                    replacement_hcid = self.oid
-                    print("could not find replacement hcid, using the original one")
-
-                try:
-                    slots = extrinsic_object.findall('.//{*}Slot')
-                    for slot in slots:
-                        if slot.attrib['name'] == "repositoryUniqueId":
-                            rid = slot.find('.//{*}ValueList/{*}Value').text
-                            break
-                except:
-                    print("could not find repoUniqueId in slots, continuing")
-
-                classifications = extrinsic_object.findall('.//{*}Classification')
-                for classification in classifications:
-                    if object_done:
-                        break
-                    value = classification.find('.//{*}Slot/{*}ValueList/{*}Value')
-                    if value is not None and value.text == "2.16.840.1.113883.6.1":  # we're dealing with the loinc classification
-                        object_done = True  # this object will not need to be looked further
-                        # TODO: check if this is a LOINC recognized by our filter.
-                        if classification.attrib['nodeRepresentation']:
-                            doc_type = classification.attrib['nodeRepresentation']
-                            external_identifiers = extrinsic_object.findall(
-                                './/{*}ExternalIdentifier')
-                            pid = None
-                            doc_id = None
-                            for external_identifier in external_identifiers:
-                                # uuids are here https://profiles.ihe.net/ITI/TF/Volume3/ch-4.2.html
-                                if external_identifier.attrib['identificationScheme'] == 'urn:uuid:58a6f841-87b3-4a3e-92fd-a8ffeff98427':
-                                    pid_and_rid = external_identifier.attrib['value']
-                                    pid = pid_and_rid.split("^^^")[0]
-                                    if rid is None:
-                                        rid = pid_and_rid.split("^^^&")[1].split("&")[0]
-                                elif external_identifier.attrib['identificationScheme'] == 'urn:uuid:2e82c1f6-a085-4c72-9da3-8640a32e42ab':
-                                    doc_id = external_identifier.attrib['value']
-                            if pid is not None and doc_id is not None and rid is not None:
-                                self.pids_and_doc_ids.append(
-                                    {"pid": pid,
-                                     "doc_id": doc_id,
-                                     "rid": rid,
-                                     "type": doc_type,
-                                     "replacement_hcid": replacement_hcid
-                                     }
-                                )
+            entries = await get_parse_stage().xca_query_response(self.received_38_response, self.oid)
+            self.pids_and_doc_ids = [
+                {"pid": entry["pid"],
+                 "doc_id": entry["doc_id"],
+                 "rid": entry["rid"],
+                 "type": entry["type"],
+                 "replacement_hcid": entry["replacement_hcid"],
+                 "entry_uuid": entry["entry_uuid"],
+                 "creation_time": entry["creation_time"]
+                 }
+                for entry in entries
+                if entry["entry_uuid"] not in self.synced_entry_uuids
+                and (self.doc_filter is None or self.doc_filter.matches(entry))
+            ]
+            self.entries_by_doc_id = {pair["doc_id"]: pair for pair in self.pids_and_doc_ids}
+            if len(entries) > len(self.pids_and_doc_ids):
+                print("skipping", len(entries) - len(self.pids_and_doc_ids), "documents from", self.name,
+                      "(already synced or filtered out)")
             return self.pids_and_doc_ids.copy()
 
         except Exception as e:
             print("issue unpacking iti38 response", e)
             return []
 
-    def extract_full_docs_and_sort(self):
-        for i in range(len(self.received_39_responses)):
-            preparsed = self.received_39_responses[i]
-            doc_type = self.pids_and_doc_ids[i]["type"]
-            if type(preparsed) != str and type(preparsed) != bytes:
-                print("weird type preparsed:", type(preparsed))
-                print("content below", preparsed)
-                # if timeout, preparsed = None, we will not insert
-                continue
-            if type(preparsed) == bytes:
-                print("got a bytes 39 preparsed response")
-                preparsed = preparsed.decode('utf-8')
-
-            # envelope = extract_envelope_content(preparsed)
-            # extract all clinical documents
-            clinical_documents = re.findall(
-                r'<ClinicalDocument.*?</ClinicalDocument>', preparsed, re.DOTALL)
-
-            if len(clinical_documents) == 0:
-                print("no clinical documents found in 39 response")
-                print("preparsed,", preparsed)
-
-            if doc_type in self.docs_found:
-                self.docs_found[doc_type].extend(clinical_documents)
-            else:
-                self.docs_found[doc_type] = clinical_documents
+    def sort_document(self, record):
+        if record["document"] is None:
+            print("could not decode document", record["doc_id"])
+            return
+        self.retrieved_doc_ids.add(record["doc_id"])
+        if self.retrieval_budget is not None:
+            self.retrieval_budget.spend(len(record["document"]))
+        # responses come back in chunks of several documents, so type each document by its id
+        requested = self.entries_by_doc_id.get(record["doc_id"])
+        doc_type = requested["type"] if requested is not None else None
+        if record.get("repo_id") is None and requested is not None:
+            record["repo_id"] = requested["rid"]
+        if self.deduplicator is not None and not self.deduplicator.accept(record):
+            return
+        if self.persister is not None:
+            self.persister.put(record, self, doc_type)
+        if self.converter is not None:
+            self.conversions.append(asyncio.ensure_future(self.convert_document(record, doc_type)))
+        if doc_type in self.docs_found:
+            self.docs_found[doc_type].append(record["doc_id"])
+        else:
+            self.docs_found[doc_type] = [record["doc_id"]]
 
+    async def convert_document(self, record, doc_type):
+        '''
+        converted bundles are persisted with the document; docs_found["converted_fhir"] lists the doc ids,
+        in the order they finish
+        '''
+        template = doc_sorting_schema.get(doc_type, doc_sorting_schema[None])
+        bundle = await self.converter.convert(record["document"], template, record["content_hash"],
+                                              mime_type=record.get("mime_type"), db=get_runtime().async_db())
+        if bundle is not None:
+            self.docs_found["converted_fhir"].append(record["doc_id"])
+            if self.persister is not None:
+                self.persister.put_bundle(record, template, bundle)
+
+    def sorted_docs(self):
         try:
             fhir_id = self.pids_and_doc_ids[0]['pid']
         except:
@@ -0,0 +1,219 @@
+import asyncio
+import functools
+import importlib
+import json
+import os
+import shlex
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+ENV = os.environ.get("ENV")
+
+# the cda -> fhir converter runs the handlebars templates in doc_sorting_schema. either a command that takes the
+# template name as its last argument, the cda on stdin and prints the fhir bundle json,
+FHIR_CONVERTER_COMMAND = os.environ.get("FHIR_CONVERTER_COMMAND", "")
+# or a python module with convert(document bytes, template name) -> bundle dict, run in a process pool
+FHIR_CONVERTER_MODULE = os.environ.get("FHIR_CONVERTER_MODULE", "")
+# bump when the templates change, so cached conversions from the old ones aren't served
+FHIR_TEMPLATE_VERSION = os.environ.get("FHIR_TEMPLATE_VERSION", "1")
+
+# conversions running at once; each holds a document and its bundle in memory, so this bounds memory too
+CONVERT_WORKERS = int(os.environ.get("CONVERT_WORKERS", os.cpu_count() or 2))
+# documents bigger than this aren't converted
+CONVERT_MAX_BYTES = int(os.environ.get("CONVERT_MAX_BYTES", 20 * 1024 * 1024))
+CONVERT_TIMEOUT = float(os.environ.get("CONVERT_TIMEOUT", 60))
+# bundles kept in memory across invocations of a warm container
+CONVERT_CACHE_ENTRIES = int(os.environ.get("CONVERT_CACHE_ENTRIES", 256))
+# CONVERT_CACHE_SHARED=0 keeps the cache in memory only
+CONVERT_CACHE_SHARED = os.environ.get("CONVERT_CACHE_SHARED", "1") == "1"
+
+CONVERTED_TABLE_NAME = 'converted_document'
+
+CREATE_CONVERTED_TABLE = f'''
+CREATE TABLE IF NOT EXISTS {CONVERTED_TABLE_NAME} (
+    content_hash text NOT NULL,
+    template text NOT NULL,
+    template_version text NOT NULL,
+    bundle jsonb NOT NULL,
+    converted_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (content_hash, template, template_version)
+)
+'''
+
+# ::text so both async_db drivers hand back the same thing
+SELECT_CONVERTED = f'''
+SELECT bundle::text FROM {CONVERTED_TABLE_NAME} WHERE content_hash = %s AND template = %s AND template_version = %s
+'''
+
+INSERT_CONVERTED = f'''
+INSERT INTO {CONVERTED_TABLE_NAME} (content_hash, template, template_version, bundle) VALUES (%s, %s, %s, %s)
+ON CONFLICT DO NOTHING
+'''
+
+
+def convert_with_module(module_name, document, template):
+    '''
+    runs in a worker process, so it's a plain module level function
+    '''
+    return importlib.import_module(module_name).convert(document, template)
+
+
+class ConversionStage:
+    '''
+    cda -> fhir conversion for retrieved documents, off the event loop and in parallel with the ITI-39s still
+    in flight. outputs are cached by content hash, template and template version
+    '''
+
+    def __init__(self, command=FHIR_CONVERTER_COMMAND, module=FHIR_CONVERTER_MODULE, workers=CONVERT_WORKERS,
+                 shared_cache=CONVERT_CACHE_SHARED):
+        self.command = shlex.split(command) if command else []
+        self.module = module
+        self.workers = workers
+        self.shared_cache = shared_cache
+        self.executor = None
+        # keyed by the loop itself, since the id of a collected loop gets reused by the next one
+        self.semaphores = weakref.WeakKeyDictionary()  # loop -> semaphore
+        self.cache = OrderedDict()  # (content hash, template, version) -> bundle
+        self.in_flight = {}  # key -> future, so the same document isn't converted twice at once
+        self.shared_table_ready = False
+        self.hits = 0
+        self.misses = 0
+        self.failed = 0
+
+    def enabled(self):
+        return bool(self.command or self.module)
+
+    def get_executor(self):
+        if self.executor is None:
+            try:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            except (OSError, NotImplementedError) as e:
+                # no /dev/shm (lambda) means no multiprocessing queues; threads still keep the loop free
+                print("no process pool for conversion, using threads,", repr(e))
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='convert')
+        return self.executor
+
+    def semaphore_for(self, loop):
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.workers)
+        return semaphore
+
+    async def run_command(self, document, template):
+        process = await asyncio.create_subprocess_exec(
+            *self.command, template,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            output, errors = await asyncio.wait_for(process.communicate(document), CONVERT_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            raise Exception("converter exited with " + str(process.returncode) + ", " + errors[:500].decode(
+                'utf-8', 'replace'))
+        return json.loads(output)
+
+    async def run_module(self, document, template):
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(
+            self.get_executor(), functools.partial(convert_with_module, self.module, document, template)),
+            CONVERT_TIMEOUT)
+
+    # cache
+
+    def remember(self, key, bundle):
+        self.cache[key] = bundle
+        self.cache.move_to_end(key)
+        while len(self.cache) > CONVERT_CACHE_ENTRIES:
+            self.cache.popitem(last=False)
+
+    async def ensure_shared_table(self, db):
+        if not self.shared_table_ready:
+            await db.execute(CREATE_CONVERTED_TABLE)
+            self.shared_table_ready = True
+
+    async def read_shared(self, db, key):
+        try:
+            await self.ensure_shared_table(db)
+            row = await db.fetchrow(SELECT_CONVERTED, key)
+            return json.loads(row[0]) if row is not None else None
+        except Exception as e:
+            print("could not read converted document cache,", repr(e))
+            return None
+
+    async def write_shared(self, db, key, bundle):
+        try:
+            await self.ensure_shared_table(db)
+            await db.execute(INSERT_CONVERTED, key + (json.dumps(bundle),))
+        except Exception as e:
+            print("could not write converted document cache,", repr(e))
+
+    async def convert(self, document, template, content_hash, mime_type=None, db=None):
+        '''
+        the fhir bundle for one retrieved document, None if it isn't a cda, is too big or doesn't convert.
+        db is an async_db.AsyncDB for the shared cache
+        '''
+        if not self.enabled() or document is None:
+            return None
+        if mime_type and 'xml' not in mime_type:
+            return None
+        if isinstance(document, str):
+            document = document.encode('utf-8')
+        if len(document) > CONVERT_MAX_BYTES:
+            print("not converting a", len(document), "byte document")
+            return None
+
+        key = (content_hash, template, FHIR_TEMPLATE_VERSION)
+        bundle = self.cache.get(key)
+        if bundle is None and self.shared_cache and db is not None:
+            bundle = await self.read_shared(db, key)
+            if bundle is not None:
+                self.remember(key, bundle)
+        if bundle is not None:
+            self.hits += 1
+            return bundle
+
+        if key in self.in_flight:
+            self.hits += 1
+            return await asyncio.shield(self.in_flight[key])
+        self.misses += 1
+        self.in_flight[key] = asyncio.get_running_loop().create_future()
+        bundle = None
+        try:
+            bundle = await self.run(document, template)
+        finally:
+            self.in_flight.pop(key).set_result(bundle)
+        if bundle is None:
+            return None
+        self.remember(key, bundle)
+        if self.shared_cache and db is not None:
+            await self.write_shared(db, key, bundle)
+        return bundle
+
+    async def run(self, document, template):
+        try:
+            async with self.semaphore_for(asyncio.get_running_loop()):
+                if self.command:
+                    return await self.run_command(document, template)
+                return await self.run_module(document, template)
+        except Exception as e:
+            self.failed += 1
+            print("conversion failed with", template, repr(e))
+            return None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "failed": self.failed, "cached": len(self.cache)}
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+conversion_stage = ConversionStage()
+
+
+def get_conversion_stage():
+    return conversion_stage
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import query_catalog
+import startup_profile
+
+ENV = os.environ.get("ENV")
+secret_id = ""
+secret_params = {}
+
+# host used to connect to PostgreSQL
+DB_HOST_NAME = ''
+# optional read replica for read-only responder queries; empty means reads go to the primary
+DB_READ_REPLICA_HOST_NAME = ''
+DB_PORT = int(os.environ.get("DB_PORT", 5432))
+DB_NAME = ''
+
+# idle connections kept per host between invocations
+POOL_MAX_IDLE = int(os.environ.get("DB_POOL_MAX_IDLE", 4))
+# connections older than this are closed instead of reused, so credential rotation and failovers get picked up
+CONNECTION_MAX_LIFETIME = int(os.environ.get("DB_CONNECTION_MAX_LIFETIME", 15 * 60))
+# a connection idle for longer than this gets a SELECT 1 before it's handed out
+HEALTH_CHECK_AFTER_IDLE = int(os.environ.get("DB_HEALTH_CHECK_AFTER_IDLE", 30))
+
+
+class ConnectionPool:
+    '''
+    idle psycopg2 connections to one host, kept alive across warm lambda invocations
+    '''
+
+    def __init__(self, host, max_idle=POOL_MAX_IDLE, max_lifetime=CONNECTION_MAX_LIFETIME,
+                 health_check_after_idle=HEALTH_CHECK_AFTER_IDLE):
+        self.host = host
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check_after_idle = health_check_after_idle
+        self.idle = []  # list of (connection, time it was returned)
+        self.created_at = {}  # id(connection) -> time it was opened
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def connect(self):
+        with startup_profile.timed('db connect'):
+            connection = psycopg2.connect(
+                host=self.host, port=DB_PORT,
+                user=secret_params['db_username'],
+                password=secret_params['db_password'],
+                database=DB_NAME)
+        self.created_at[id(connection)] = time.monotonic()
+        self.opened += 1
+        return connection
+
+    def discard(self, connection):
+        self.created_at.pop(id(connection), None)
+        query_catalog.forget(connection)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def is_expired(self, connection):
+        created_at = self.created_at.get(id(connection))
+        return created_at is None or time.monotonic() - created_at > self.max_lifetime
+
+    def is_healthy(self, connection, returned_at):
+        if connection.closed:
+            return False
+        if time.monotonic() - returned_at < self.health_check_after_idle:
+            return True
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1")
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def get(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection, returned_at = self.idle.pop()
+            if not self.is_expired(connection) and self.is_healthy(connection, returned_at):
+                self.reused += 1
+                return connection
+            self.discard(connection)
+        return self.connect()
+
+    def put(self, connection, discard=False):
+        if discard or connection.closed or self.is_expired(connection):
+            self.discard(connection)
+            return
+        try:
+            # hand the next borrower a clean session
+            connection.rollback()
+            connection.autocommit = False
+        except psycopg2.Error:
+            self.discard(connection)
+            return
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append((connection, time.monotonic()))
+                return
+        self.discard(connection)
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            self.discard(connection)
+
+
+class ConnectionManager:
+    '''
+    pools for the primary and (optionally) a read replica. borrow with connection() or get_connection()/put_connection()
+    '''
+
+    def __init__(self, host=DB_HOST_NAME, read_replica_host=DB_READ_REPLICA_HOST_NAME):
+        self.primary = ConnectionPool(host)
+        self.replica = ConnectionPool(read_replica_host) if read_replica_host else None
+        self.owners = {}  # id(connection) -> pool it came from
+
+    def pool_for(self, read_only):
+        return self.replica if read_only and self.replica is not None else self.primary
+
+    def get_connection(self, read_only=False, autocommit=False):
+        pool = self.pool_for(read_only)
+        connection = pool.get()
+        connection.autocommit = autocommit
+        self.owners[id(connection)] = pool
+        return connection
+
+    def put_connection(self, connection, discard=False):
+        pool = self.owners.pop(id(connection), self.primary)
+        pool.put(connection, discard=discard)
+
+    @contextmanager
+    def connection(self, read_only=False, autocommit=False):
+        '''
+        commits if the block finishes, rolls back if it raises, and returns the connection to its pool either way
+        '''
+        connection = self.get_connection(read_only=read_only, autocommit=autocommit)
+        try:
+            yield connection
+            if not connection.autocommit:
+                connection.commit()
+        except Exception:
+            self.put_connection(connection, discard=connection.closed)
+            raise
+        self.put_connection(connection)
+
+    def stats(self):
+        pools = {"primary": self.primary, "replica": self.replica}
+        return {name: {"opened": pool.opened, "reused": pool.reused, "idle": len(pool.idle)}
+                for name, pool in pools.items() if pool is not None}
+
+    def close_all(self):
+        self.primary.close_all()
+        if self.replica is not None:
+            self.replica.close_all()
+
+
+connection_manager = ConnectionManager()
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+
+ENV = os.environ.get("ENV")
+
+# directory answers younger than this are served without asking the directory lambda
+DIRECTORY_CACHE_TTL = int(os.environ.get("DIRECTORY_CACHE_TTL", 6 * 60 * 60))
+# older answers, up to this age, are still served right away while a background refresh runs
+DIRECTORY_CACHE_MAX_STALE = int(os.environ.get("DIRECTORY_CACHE_MAX_STALE", 3 * 24 * 60 * 60))
+# DIRECTORY_CACHE_SHARED=1 keeps a copy in postgres, so a cold container starts from what another one fetched
+DIRECTORY_CACHE_SHARED = os.environ.get("DIRECTORY_CACHE_SHARED", "") == "1"
+DIRECTORY_CACHE_TABLE_NAME = 'directory_cache'
+
+CREATE_DIRECTORY_CACHE_TABLE = f'''
+CREATE TABLE IF NOT EXISTS {DIRECTORY_CACHE_TABLE_NAME} (
+    cache_key text PRIMARY KEY,
+    value jsonb NOT NULL,
+    fetched_at double precision NOT NULL
+)
+'''
+
+
+def national_key():
+    return "national"
+
+
+def zips_key(zip_codes, state, radius, country):
+    '''
+    exclude is not part of the key: it only drops endpoints by name, so it is applied to the cached answer instead
+    '''
+    return json.dumps(["zips", sorted(set(zip_codes)), state, radius, country])
+
+
+def without_excluded(endpoints, exclude):
+    if not exclude:
+        return endpoints
+    exclude = set(exclude)
+    return [endpoint for endpoint in endpoints if endpoint['name'] not in exclude]
+
+
+class DirectoryCache:
+    '''
+    ttl cache in front of the stu3 directory lambda. fresh entries are served as is, stale ones are served while
+    a background thread refetches, and only a missing (or too old) entry makes the caller wait on the directory
+    '''
+
+    def __init__(self, ttl=DIRECTORY_CACHE_TTL, max_stale=DIRECTORY_CACHE_MAX_STALE, shared=DIRECTORY_CACHE_SHARED):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.shared = shared
+        self.entries = {}  # key -> (fetched_at epoch seconds, value)
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.shared_table_ready = False
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key, fetch):
+        '''
+        fetch is a zero argument callable that asks the directory; it's only called on a miss or to revalidate
+        '''
+        entry = self.entries.get(key)
+        if entry is None and self.shared:
+            entry = self.read_shared(key)
+            if entry is not None:
+                self.entries[key] = entry
+
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age < self.ttl:
+                self.hits += 1
+                return entry[1]
+            if age < self.ttl + self.max_stale:
+                self.stale_hits += 1
+                self.revalidate(key, fetch)
+                return entry[1]
+
+        self.misses += 1
+        try:
+            return self.store(key, fetch())
+        except Exception as e:
+            if entry is None:
+                raise
+            print("directory lookup failed, serving the old answer,", repr(e))
+            return entry[1]
+
+    def store(self, key, value):
+        fetched_at = time.time()
+        self.entries[key] = (fetched_at, value)
+        if self.shared:
+            self.write_shared(key, fetched_at, value)
+        return value
+
+    def revalidate(self, key, fetch):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.store(key, fetch())
+            except Exception as e:
+                print("background directory refresh failed,", key, repr(e))
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+    # shared tier
+
+    def shared_connection(self):
+        from db import connection_manager
+        return connection_manager.connection(autocommit=True)
+
+    def read_shared(self, key):
+        try:
+            with self.shared_connection() as connection:
+                with connection.cursor() as cur:
+                    self.ensure_shared_table(cur)
+                    cur.execute(f"SELECT fetched_at, value FROM {DIRECTORY_CACHE_TABLE_NAME} WHERE cache_key = %s",
+                                (key,))
+                    row = cur.fetchone()
+            return (row[0], row[1]) if row is not None else None
+        except Exception as e:
+            print("could not read shared directory cache,", repr(e))
+            return None
+
+    def write_shared(self, key, fetched_at, value):
+        try:
+            with self.shared_connection() as connection:
+                with connection.cursor() as cur:
+                    self.ensure_shared_table(cur)
+                    cur.execute(
+                        f'''INSERT INTO {DIRECTORY_CACHE_TABLE_NAME} (cache_key, value, fetched_at) VALUES (%s, %s, %s)
+                        ON CONFLICT (cache_key) DO UPDATE SET value = EXCLUDED.value, fetched_at = EXCLUDED.fetched_at''',
+                        (key, json.dumps(value), fetched_at))
+        except Exception as e:
+            print("could not write shared directory cache,", repr(e))
+
+    def ensure_shared_table(self, cur):
+        if not self.shared_table_ready:
+            cur.execute(CREATE_DIRECTORY_CACHE_TABLE)
+            self.shared_table_ready = True
+
+    def stats(self):
+        return {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses, "entries": len(self.entries)}
+
+
+directory_cache = DirectoryCache()
+
+
+def get_directory_cache():
+    return directory_cache
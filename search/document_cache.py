@@ -0,0 +1,223 @@
+import base64
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+ENV = os.environ.get("ENV")
+
+# memory tier budget, in rendered bytes
+DOCUMENT_CACHE_MAX_BYTES = int(os.environ.get("DOCUMENT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# optional second tiers; empty means off. /tmp survives between warm lambda invocations
+DOCUMENT_CACHE_DIR = os.environ.get("DOCUMENT_CACHE_DIR", "")
+DOCUMENT_CACHE_BUCKET = os.environ.get("DOCUMENT_CACHE_BUCKET", "")
+# objects in the bucket live under this prefix, so a bucket lifecycle rule can expire them as well
+DOCUMENT_CACHE_PREFIX = os.environ.get("DOCUMENT_CACHE_PREFIX", "iti39-documents/")
+# disk and s3 copies older than this are treated as gone and deleted when seen
+DOCUMENT_CACHE_TTL = int(os.environ.get("DOCUMENT_CACHE_TTL", 7 * 24 * 3600))
+
+
+class CachedDocument:
+    '''
+    only the rendered bytes are kept; the base64 is made when a response needs it
+    '''
+
+    def __init__(self, rendered):
+        self.rendered = rendered
+
+    @property
+    def encoded(self):
+        return base64.b64encode(self.rendered)
+
+    def __len__(self):
+        return len(self.rendered)
+
+
+class DocumentCache:
+    '''
+    rendered ITI-39 documents (json2xml output), keyed by table, resource id and version.
+    a new version of a resource gets a new key, so a changed resource is never served stale. every version of
+    a resource shares a key prefix, and storing one deletes the others under that prefix on disk and in s3,
+    whichever container put them there. copies older than DOCUMENT_CACHE_TTL are deleted when seen.
+    tiers: LRU in memory -> files in disk_dir -> objects in s3_bucket
+    '''
+
+    def __init__(self, max_bytes=DOCUMENT_CACHE_MAX_BYTES, disk_dir=DOCUMENT_CACHE_DIR,
+                 s3_bucket=DOCUMENT_CACHE_BUCKET):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.s3_bucket = s3_bucket
+        self.s3_client = None
+        self.memory = OrderedDict()  # key -> CachedDocument
+        self.memory_bytes = 0
+        self.versions = {}  # (table, doc_id) -> key of the version we hold
+        self.hits = 0
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.sweep_disk()
+
+    @staticmethod
+    def make_prefix(table, doc_id):
+        return hashlib.sha256(f"{table}/{doc_id}".encode('utf-8')).hexdigest()
+
+    @classmethod
+    def make_key(cls, table, doc_id, version):
+        return cls.make_prefix(table, doc_id) + "/" + str(version)
+
+    @staticmethod
+    def expired(modified_at):
+        return time.time() - modified_at > DOCUMENT_CACHE_TTL
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    def sweep_disk(self):
+        '''
+        once per container: /tmp can outlive many of them
+        '''
+        removed = 0
+        for directory, _, files in os.walk(self.disk_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    if self.expired(os.path.getmtime(path)):
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed:
+            print("removed", removed, "expired cached documents from disk")
+
+    def get_s3_client(self):
+        if self.s3_client is None:
+            import boto3
+            self.s3_client = boto3.client('s3')
+        return self.s3_client
+
+    def remember(self, key, document):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        self.memory[key] = document
+        self.memory_bytes += len(document)
+        while self.memory_bytes > self.max_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def forget(self, key):
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key))
+        if self.disk_dir:
+            try:
+                os.remove(self.disk_path(key))
+            except FileNotFoundError:
+                pass
+        if self.s3_bucket:
+            try:
+                self.get_s3_client().delete_object(Bucket=self.s3_bucket, Key=DOCUMENT_CACHE_PREFIX + key)
+            except Exception as e:
+                print("could not delete cached document from s3,", e)
+
+    def forget_other_versions(self, prefix, keep):
+        '''
+        drops every version of a resource but keep from all the tiers, including ones this container never saw
+        '''
+        for key in [key for key in self.memory if key.startswith(prefix + "/") and key != keep]:
+            self.memory_bytes -= len(self.memory.pop(key))
+        if self.disk_dir:
+            try:
+                names = os.listdir(os.path.join(self.disk_dir, prefix))
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                if prefix + "/" + name != keep:
+                    try:
+                        os.remove(os.path.join(self.disk_dir, prefix, name))
+                    except FileNotFoundError:
+                        pass
+        if self.s3_bucket:
+            try:
+                listed = self.get_s3_client().list_objects_v2(
+                    Bucket=self.s3_bucket, Prefix=DOCUMENT_CACHE_PREFIX + prefix + "/")
+                stale = [{'Key': item['Key']} for item in listed.get('Contents', [])
+                         if item['Key'] != DOCUMENT_CACHE_PREFIX + keep]
+                if stale:
+                    self.get_s3_client().delete_objects(Bucket=self.s3_bucket, Delete={'Objects': stale})
+            except Exception as e:
+                print("could not delete old cached document versions from s3,", e)
+
+    def get(self, table, doc_id, version):
+        key = self.make_key(table, doc_id, version)
+        document = self.memory.get(key)
+        if document is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return document
+
+        rendered = None
+        if self.disk_dir:
+            try:
+                if self.expired(os.path.getmtime(self.disk_path(key))):
+                    os.remove(self.disk_path(key))
+                else:
+                    with open(self.disk_path(key), 'rb') as f:
+                        rendered = f.read()
+            except FileNotFoundError:
+                pass
+        if rendered is None and self.s3_bucket:
+            try:
+                found = self.get_s3_client().get_object(Bucket=self.s3_bucket, Key=DOCUMENT_CACHE_PREFIX + key)
+                if self.expired(found['LastModified'].timestamp()):
+                    self.get_s3_client().delete_object(Bucket=self.s3_bucket, Key=DOCUMENT_CACHE_PREFIX + key)
+                else:
+                    rendered = found['Body'].read()
+            except Exception:
+                rendered = None
+
+        if rendered is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        document = CachedDocument(rendered)
+        self.versions[(table, doc_id)] = key
+        self.remember(key, document)
+        return document
+
+    def put(self, table, doc_id, version, rendered):
+        key = self.make_key(table, doc_id, version)
+        self.forget_other_versions(self.make_prefix(table, doc_id), key)
+        self.versions[(table, doc_id)] = key
+
+        document = CachedDocument(rendered)
+        self.remember(key, document)
+        if self.disk_dir:
+            # write then rename so a concurrent reader never sees half a file
+            path = self.disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", 'wb') as f:
+                f.write(rendered)
+            os.replace(path + ".tmp", path)
+        if self.s3_bucket:
+            try:
+                self.get_s3_client().put_object(Bucket=self.s3_bucket, Key=DOCUMENT_CACHE_PREFIX + key, Body=rendered)
+            except Exception as e:
+                print("could not write cached document to s3,", e)
+        return document
+
+    def invalidate(self, table, doc_id):
+        key = self.versions.pop((table, doc_id), None)
+        if key is not None:
+            self.forget(key)
+
+
+document_cache = None
+
+
+def get_document_cache():
+    '''
+    one cache per container, so warm invocations share it
+    '''
+    global document_cache
+    if document_cache is None:
+        document_cache = DocumentCache()
+    return document_cache
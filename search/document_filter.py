@@ -0,0 +1,125 @@
+import os
+import re
+from datetime import datetime, timezone
+
+import xpaths
+
+ENV = os.environ.get("ENV")
+
+# DOCUMENT_FILTER_PUSHDOWN=0 keeps every filter client side; some responders reject queries with code slots
+DOCUMENT_FILTER_PUSHDOWN = os.environ.get("DOCUMENT_FILTER_PUSHDOWN", "1") == "1"
+# comma separated home community ids that get the plain query, filtered client side
+DOCUMENT_FILTER_NO_PUSHDOWN_OIDS = set(
+    oid.strip() for oid in os.environ.get("DOCUMENT_FILTER_NO_PUSHDOWN_OIDS", "").split(",") if oid.strip())
+
+
+def split_code(code, default_scheme=None):
+    '''
+    "11488-4^^2.16.840.1.113883.6.1" or "11488-4" -> (code, scheme or default_scheme)
+    '''
+    code, _, scheme = code.partition("^^")
+    return code, scheme or default_scheme
+
+
+HL7_DIGITS = re.compile(r'\d{4,14}')
+
+
+def hl7_time(value):
+    '''
+    the digits ITI-38 time slots take (YYYYMMDD[HHMMSS], UTC like XDS creationTime). takes those digits as they are,
+    or an ISO date or datetime: 2021-01-02 -> 20210102, 2021-01-02T10:00-05:00 -> 20210102150000.
+    anything else is a ValueError
+    '''
+    if not value:
+        return None
+    value = str(value).strip()
+    if HL7_DIGITS.fullmatch(value):
+        return value
+    parsed = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+    if len(value) == 10:
+        return parsed.strftime('%Y%m%d')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.strftime('%Y%m%d%H%M%S')
+
+
+def entry_time(value):
+    '''
+    a responder's creationTime, None if it isn't one we can read
+    '''
+    try:
+        return hl7_time(value)
+    except ValueError:
+        return None
+
+
+class DocumentFilter:
+    '''
+    which documents a pipeline wants. pushed into the ITI-38 query where we can, and always applied to the
+    returned entries before ITI-39, so a responder ignoring a slot doesn't matter.
+    codes are "code" or "code^^coding scheme"; type codes default to loinc. created_to is exclusive, like the
+    $XDSDocumentEntryCreationTimeTo slot
+    '''
+
+    def __init__(self, type_codes=None, class_codes=None, format_codes=None, created_from=None, created_to=None,
+                 max_size=None):
+        self.type_codes = [split_code(code, xpaths.LOINC_OID) for code in type_codes or []]
+        self.class_codes = [split_code(code) for code in class_codes or []]
+        self.format_codes = [split_code(code) for code in format_codes or []]
+        self.created_from = hl7_time(created_from)
+        self.created_to = hl7_time(created_to)
+        self.max_size = int(max_size) if max_size else None
+
+    @classmethod
+    def from_params(cls, params):
+        '''
+        params is the "doc_filter" dict of a search request, None when there isn't one
+        '''
+        if not params:
+            return None
+        return cls(type_codes=params.get("type_codes"), class_codes=params.get("class_codes"),
+                   format_codes=params.get("format_codes"), created_from=params.get("created_from"),
+                   created_to=params.get("created_to"), max_size=params.get("max_size"))
+
+    def query_slots(self, oid, creation_time_from=None):
+        '''
+        ITI-38 slots for this filter. creation_time_from is the sync watermark, if there is one; the later of
+        it and created_from wins. codes without a coding scheme can't go in a slot and stay client side
+        '''
+        # the watermark's day is asked for again, see document_sync.query_slots
+        lower_bounds = [time for time in [self.created_from, creation_time_from and creation_time_from[:8]] if time]
+        created_from = max(lower_bounds) if lower_bounds else None
+        slots = []
+        if created_from:
+            slots.append(("$XDSDocumentEntryCreationTimeFrom", [created_from]))
+        if not DOCUMENT_FILTER_PUSHDOWN or oid in DOCUMENT_FILTER_NO_PUSHDOWN_OIDS:
+            return slots
+        if self.created_to:
+            slots.append(("$XDSDocumentEntryCreationTimeTo", [self.created_to]))
+        for name, codes in [("$XDSDocumentEntryTypeCode", self.type_codes),
+                            ("$XDSDocumentEntryClassCode", self.class_codes),
+                            ("$XDSDocumentEntryFormatCode", self.format_codes)]:
+            if codes and all(scheme for _, scheme in codes):
+                slots.append((name, ["(" + ",".join("'" + code + "^^" + scheme + "'" for code, scheme in codes) + ")"]))
+        return slots
+
+    def matches(self, entry):
+        '''
+        entry is a document entry dict from xpaths.extract_document_entry
+        '''
+        if self.type_codes and not (
+                set([entry["type_code"], entry["type"]]) & set(code for code, _ in self.type_codes)):
+            return False
+        if self.class_codes and entry["class_code"] not in set(code for code, _ in self.class_codes):
+            return False
+        if self.format_codes and entry["format_code"] not in set(code for code, _ in self.format_codes):
+            return False
+        creation_time = entry_time(entry["creation_time"])
+        if self.created_from and creation_time and creation_time[:len(self.created_from)] < self.created_from:
+            return False
+        if self.created_to and creation_time and creation_time[:len(self.created_to)] >= self.created_to:
+            return False
+        # size is only checked when the responder advertises it
+        if self.max_size and entry["size"] is not None and entry["size"] > self.max_size:
+            return False
+        return True
@@ -0,0 +1,310 @@
+import asyncio
+import json
+import os
+import uuid
+from urllib.parse import quote
+
+import conversion_stage
+import document_store
+from db import connection_manager
+
+ENV = os.environ.get("ENV")
+
+# documents per write; one transaction each
+PERSIST_BATCH_SIZE = int(os.environ.get("PERSIST_BATCH_SIZE", 50))
+
+NOTES_TABLE_NAME = 'cq_notes'
+# which patients (internal pids) a stored document belongs to; a document is stored once, and linked to the pid of
+# every search that finds it
+NOTE_PATIENTS_TABLE_NAME = 'cq_note_patients'
+# the fhir bundles converted from stored documents
+NOTE_BUNDLES_TABLE_NAME = 'cq_note_fhir'
+DOCUMENT_REFERENCE_TABLE_NAME = 'documentreference'
+
+CREATE_NOTES_TABLE = f'''
+CREATE TABLE IF NOT EXISTS {NOTES_TABLE_NAME} (
+    repository_id text NOT NULL,
+    doc_id text NOT NULL,
+    home_community_id text,
+    pid text,
+    pipeline text,
+    loinc text,
+    mime_type text,
+    content_hash text,
+    document bytea,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (repository_id, doc_id)
+);
+CREATE TABLE IF NOT EXISTS {NOTE_PATIENTS_TABLE_NAME} (
+    repository_id text NOT NULL,
+    doc_id text NOT NULL,
+    pid text NOT NULL,
+    pipeline text,
+    loinc text,
+    linked_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (repository_id, doc_id, pid)
+);
+CREATE TABLE IF NOT EXISTS {NOTE_BUNDLES_TABLE_NAME} (
+    repository_id text NOT NULL,
+    doc_id text NOT NULL,
+    template text NOT NULL,
+    template_version text NOT NULL,
+    bundle jsonb NOT NULL,
+    converted_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (repository_id, doc_id, template, template_version)
+);
+'''
+
+INSERT_NOTES = f'''
+INSERT INTO {NOTES_TABLE_NAME} (repository_id, doc_id, home_community_id, pid, pipeline, loinc, mime_type,
+                                content_hash, document)
+VALUES %s
+ON CONFLICT DO NOTHING
+'''
+
+INSERT_NOTE_PATIENTS = f'''
+INSERT INTO {NOTE_PATIENTS_TABLE_NAME} (repository_id, doc_id, pid, pipeline, loinc)
+VALUES %s
+ON CONFLICT DO NOTHING
+'''
+
+INSERT_NOTE_BUNDLES = f'''
+INSERT INTO {NOTE_BUNDLES_TABLE_NAME} (repository_id, doc_id, template, template_version, bundle)
+VALUES %s
+ON CONFLICT DO NOTHING
+'''
+
+# fhirbase table; the txid comes from fhirbase's own sequence so its history and the registry refresh see the rows
+INSERT_DOCUMENT_REFERENCES = f'''
+INSERT INTO {DOCUMENT_REFERENCE_TABLE_NAME} (id, txid, status, resource)
+VALUES %s
+ON CONFLICT (id) DO NOTHING
+'''
+DOCUMENT_REFERENCE_TEMPLATE = "(%s, nextval('transaction_id_seq'), 'created', %s)"
+
+tables_ready = False
+
+# stops the consumer
+DONE = None
+
+
+def document_reference_id(repository_id, doc_id, pid=None):
+    '''
+    the same document always gets the same resource id, which is what makes the insert idempotent.
+    with a pid, the id of the reference linking that patient to a document stored for another one
+    '''
+    name = "urn:ihe:xds:" + (repository_id or '') + ":" + doc_id
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name + ":" + pid if pid else name))
+
+
+def note_url(repository_id, doc_id):
+    '''
+    where a DocumentReference finds the document: its cq_notes row, which holds the one stored copy of the bytes
+    '''
+    return NOTES_TABLE_NAME + "/" + quote(repository_id or '', safe='') + "/" + quote(doc_id, safe='')
+
+
+def build_document_reference(item):
+    record = item["record"]
+    document = record["document"]
+    if isinstance(document, str):
+        document = document.encode('utf-8')
+    resource = {
+        "resourceType": "DocumentReference",
+        "id": document_reference_id(record["repo_id"], record["doc_id"]),
+        "status": "current",
+        "masterIdentifier": {"system": "urn:ietf:rfc:3986", "value": "urn:oid:" + record["doc_id"]},
+        "subject": {"reference": "Patient/" + item["pid"]} if item["pid"] else None,
+        "type": {"coding": [{"system": "http://loinc.org", "code": item["loinc"]}]} if item["loinc"] else None,
+        "content": [{"attachment": {"contentType": record.get("mime_type") or "text/xml",
+                                    "url": note_url(record["repo_id"], record["doc_id"]),
+                                    "size": len(document)}}],
+        "context": {"related": [{"identifier": {"system": "urn:ihe:iti:xca:2010:homeCommunityId",
+                                                "value": "urn:oid:" + (record.get("hcid") or item["hcid"] or '')}}]},
+    }
+    return {key: value for key, value in resource.items() if value is not None}
+
+
+def build_linked_document_reference(item):
+    '''
+    a DocumentReference for this search's patient to a document stored for another one; it points at the same
+    cq_notes row
+    '''
+    record = item["record"]
+    resource = {
+        "resourceType": "DocumentReference",
+        "id": document_reference_id(record["repo_id"], record["doc_id"], item["pid"]),
+        "status": "current",
+        "masterIdentifier": {"system": "urn:ietf:rfc:3986", "value": "urn:oid:" + record["doc_id"]},
+        "subject": {"reference": "Patient/" + item["pid"]} if item["pid"] else None,
+        "type": {"coding": [{"system": "http://loinc.org", "code": item["loinc"]}]} if item["loinc"] else None,
+        "content": [{"attachment": {
+            "contentType": record.get("mime_type") or "text/xml",
+            "url": note_url(record["repo_id"], record["doc_id"])}}],
+        "context": {"related": [{"identifier": {"system": "urn:ihe:iti:xca:2010:homeCommunityId",
+                                                "value": "urn:oid:" + (record.get("hcid") or item["hcid"] or '')}}]},
+    }
+    return {key: value for key, value in resource.items() if value is not None}
+
+
+def note_patients_row(item):
+    record = item["record"]
+    return record["repo_id"] or '', record["doc_id"], item["pid"], item["pipeline"], item["loinc"]
+
+
+def notes_row(item):
+    record = item["record"]
+    document = record["document"]
+    if isinstance(document, str):
+        document = document.encode('utf-8')
+    return (record["repo_id"] or '', record["doc_id"], record.get("hcid") or item["hcid"], item["pid"],
+            item["pipeline"], item["loinc"], record.get("mime_type"), record["content_hash"], document)
+
+
+def as_link(item, stored_key):
+    '''
+    a retrieved document whose payload is already stored as stored_key, (repository id, document id)
+    '''
+    repository_id, doc_id = stored_key
+    record = dict(item["record"], repo_id=repository_id, doc_id=doc_id, document=None)
+    return dict(item, kind="link", record=record)
+
+
+def write_batch(items):
+    '''
+    one transaction for a batch (the connection block commits): notes, DocumentReferences, patient links, fhir
+    bundles and the document store, all skipping what's there. documents are stored; links tie an already stored
+    document to this search's patient; bundles go with the stored copy of the document they were converted from.
+    returns the items written: new documents, then links
+    '''
+    from psycopg2.extras import execute_values
+
+    global tables_ready
+    documents = [item for item in items if item["kind"] == "document"]
+    links = [item for item in items if item["kind"] == "link"]
+    bundles = [item for item in items if item["kind"] == "bundle"]
+    with connection_manager.connection() as connection:
+        with connection.cursor() as cur:
+            if not tables_ready:
+                cur.execute(CREATE_NOTES_TABLE)
+                document_store.ensure_tables(cur)
+                tables_ready = True
+            documents = [item for item in documents if item["record"]["doc_id"] is not None]
+            # payloads another search already stored under a different id: linked to that copy, not stored again
+            already_stored = document_store.stored_hashes(cur, [item["record"]["content_hash"] for item in documents])
+            links += [as_link(item, already_stored[item["record"]["content_hash"]]) for item in documents
+                      if item["record"]["content_hash"] in already_stored]
+            documents = [item for item in documents if item["record"]["content_hash"] not in already_stored]
+            if documents:
+                execute_values(cur, INSERT_NOTES, [notes_row(item) for item in documents], page_size=len(documents))
+                execute_values(cur, INSERT_DOCUMENT_REFERENCES,
+                               [(document_reference_id(item["record"]["repo_id"], item["record"]["doc_id"]),
+                                 json.dumps(build_document_reference(item))) for item in documents],
+                               template=DOCUMENT_REFERENCE_TEMPLATE, page_size=len(documents))
+                document_store.record(cur, [(item["record"]["repo_id"] or '', item["record"]["doc_id"],
+                                             item["record"]["content_hash"]) for item in documents])
+            if links:
+                execute_values(cur, INSERT_DOCUMENT_REFERENCES,
+                               [(document_reference_id(item["record"]["repo_id"], item["record"]["doc_id"],
+                                                       item["pid"]),
+                                 json.dumps(build_linked_document_reference(item))) for item in links],
+                               template=DOCUMENT_REFERENCE_TEMPLATE, page_size=len(links))
+            if documents or links:
+                execute_values(cur, INSERT_NOTE_PATIENTS, [note_patients_row(item) for item in documents + links],
+                               page_size=len(documents) + len(links))
+            if bundles:
+                # after the documents above, so a bundle queued with its document finds it stored
+                stored = document_store.stored_hashes(cur, [item["content_hash"] for item in bundles])
+                rows = [stored[item["content_hash"]] + (item["template"], conversion_stage.FHIR_TEMPLATE_VERSION,
+                                                         json.dumps(item["bundle"]))
+                        for item in bundles if item["content_hash"] in stored]
+                if rows:
+                    execute_values(cur, INSERT_NOTE_BUNDLES, rows, page_size=len(rows))
+    return documents + links
+
+
+class DocumentPersister:
+    '''
+    takes documents off the retrieval path as they arrive and writes them in batches, on a worker thread,
+    while the other ITI-39s are still in flight. one per search; start before retrieval, close after
+    '''
+
+    def __init__(self, pid, batch_size=PERSIST_BATCH_SIZE):
+        self.pid = pid
+        self.batch_size = batch_size
+        self.queue = None
+        self.task = None
+        self.written = []  # documents that were new and links, in write order
+        self.failed = 0
+
+    def start(self):
+        # close() returns what was written since this start, so a second run (the deferred continuation)
+        # doesn't report the first one's documents again
+        self.written = []
+        self.queue = asyncio.Queue()
+        self.task = asyncio.ensure_future(self.consume())
+
+    def put(self, record, pipeline, loinc):
+        '''
+        called from the retrieval path for every document that made it past dedup; never blocks
+        '''
+        if self.queue is None:
+            print("document persister not started, dropping", record["doc_id"])
+            return
+        self.queue.put_nowait({"kind": "document", "record": record, "pipeline": pipeline.name, "hcid": pipeline.oid,
+                               "loinc": loinc, "pid": self.pid})
+
+    def link(self, entry, pipeline):
+        '''
+        a document the store already holds (entry is from pipeline.pids_and_doc_ids): it isn't retrieved again,
+        but this search's patient still gets it
+        '''
+        if self.queue is None:
+            print("document persister not started, not linking", entry["doc_id"])
+            return
+        record = {"repo_id": entry["rid"], "doc_id": entry["doc_id"], "hcid": entry["replacement_hcid"],
+                  "mime_type": None, "content_hash": None}
+        self.queue.put_nowait({"kind": "link", "record": record, "pipeline": pipeline.name, "hcid": pipeline.oid,
+                               "loinc": entry["type"], "pid": self.pid})
+
+    def put_bundle(self, record, template, bundle):
+        '''
+        the fhir bundle converted from a document put earlier
+        '''
+        if self.queue is None:
+            print("document persister not started, dropping the bundle for", record["doc_id"])
+            return
+        self.queue.put_nowait({"kind": "bundle", "content_hash": record["content_hash"], "template": template,
+                               "bundle": bundle})
+
+    async def consume(self):
+        done = False
+        while not done:
+            batch = [await self.queue.get()]
+            # take whatever else is already waiting, up to a batch
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if DONE in batch:
+                batch = [item for item in batch if item is not DONE]
+                done = True
+            if batch:
+                await self.flush(batch)
+
+    async def flush(self, batch):
+        try:
+            written = await asyncio.get_running_loop().run_in_executor(None, write_batch, batch)
+            self.written.extend(written)
+        except Exception as e:
+            self.failed += len(batch)
+            print("document persistence failed for", len(batch), "documents,", repr(e))
+
+    async def close(self):
+        '''
+        waits for everything queued to be written
+        '''
+        if self.task is None:
+            return self.written
+        self.queue.put_nowait(DONE)
+        await self.task
+        self.queue, self.task = None, None
+        return self.written
@@ -0,0 +1,256 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+
+import utils
+
+ENV = os.environ.get("ENV")
+
+REGISTRY_TABLE_NAME = 'document_registry'
+CHANGE_TABLE_NAME = 'document_registry_change'
+STATE_TABLE_NAME = 'document_registry_state'
+
+# list of fhir tables that hold documents we serve through ITI-38 / ITI-39
+DOCUMENT_LOCATIONS = [
+
+]
+
+# rows pulled from a fhir table per refresh round trip
+REFRESH_BATCH_SIZE = 500
+
+# tables whose registry has been backfilled; once a table is in here it stays in
+backfilled_tables = set()
+
+CREATE_REGISTRY_TABLES = f'''
+CREATE TABLE IF NOT EXISTS {REGISTRY_TABLE_NAME} (
+    doc_id text NOT NULL,
+    table_name text NOT NULL,
+    patient_id text NOT NULL,
+    loinc_code text NOT NULL DEFAULT '',
+    format_code text NOT NULL DEFAULT '',
+    format_system text NOT NULL DEFAULT '',
+    hcf_code text NOT NULL DEFAULT '',
+    hcf_system text NOT NULL DEFAULT '',
+    creation_time text,
+    size bigint,
+    hash text,
+    txid bigint,
+    PRIMARY KEY (table_name, doc_id)
+);
+CREATE INDEX IF NOT EXISTS {REGISTRY_TABLE_NAME}_patient_id_idx ON {REGISTRY_TABLE_NAME} (patient_id);
+CREATE TABLE IF NOT EXISTS {CHANGE_TABLE_NAME} (
+    table_name text NOT NULL,
+    doc_id text NOT NULL,
+    PRIMARY KEY (table_name, doc_id)
+);
+CREATE TABLE IF NOT EXISTS {STATE_TABLE_NAME} (
+    table_name text PRIMARY KEY,
+    backfilled_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE OR REPLACE FUNCTION {CHANGE_TABLE_NAME}_note() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO {CHANGE_TABLE_NAME} (table_name, doc_id)
+    VALUES (TG_ARGV[0], CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END)
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+'''
+
+# every write to a document table queues its id. a change only shows up in the queue once its transaction commits,
+# so unlike a txid watermark nothing committing out of order gets skipped
+CREATE_CHANGE_TRIGGER = '''
+CREATE TRIGGER {trigger} AFTER INSERT OR UPDATE OR DELETE ON {table}
+FOR EACH ROW EXECUTE PROCEDURE {function}('{table}')
+'''
+
+# a writer re-queueing an id we're taking waits on the delete, so its change is picked up by the next refresh
+TAKE_CHANGES = f'''
+DELETE FROM {CHANGE_TABLE_NAME} WHERE table_name = %s AND doc_id IN (
+    SELECT doc_id FROM {CHANGE_TABLE_NAME} WHERE table_name = %s LIMIT %s FOR UPDATE SKIP LOCKED)
+RETURNING doc_id
+'''
+
+UPSERT_REGISTRY_ROW = f'''
+INSERT INTO {REGISTRY_TABLE_NAME} (doc_id, table_name, patient_id, loinc_code, format_code, format_system,
+                                   hcf_code, hcf_system, creation_time, size, hash, txid)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (table_name, doc_id) DO UPDATE SET
+    patient_id = EXCLUDED.patient_id, loinc_code = EXCLUDED.loinc_code,
+    format_code = EXCLUDED.format_code, format_system = EXCLUDED.format_system,
+    hcf_code = EXCLUDED.hcf_code, hcf_system = EXCLUDED.hcf_system,
+    creation_time = EXCLUDED.creation_time, size = EXCLUDED.size, hash = EXCLUDED.hash,
+    txid = EXCLUDED.txid
+'''
+
+
+def get_patient_id_from_resource(resource):
+    '''
+    documents reference their patient in one of three places depending on where they came from
+    '''
+    for key in ['patient', 'subject']:
+        try:
+            return resource[key]['id']
+        except (KeyError, TypeError):
+            continue
+    return resource.get('patientFhirId')
+
+
+def get_loinc_from_resource(resource):
+    try:
+        return [category['coding'][0]['code']
+                for category in resource['category']
+                if category['coding'][0]['system'] == 'http://loinc.org'][0]
+    except:
+        try:
+            return [code['code']
+                    for code in resource['type']['coding']
+                    if code['system'] == 'http://loinc.org'][0]
+        except:
+            return ""
+
+
+def get_format_code_and_system_from_resource(resource):
+    try:
+        return resource['content'][0]['format']['code'], resource['content'][0]['format'][
+            'system']
+    except:
+        return "", ""
+
+
+def get_hcf_and_system_from_resource(resource):
+    # TODO: implement based on a fhir resource that actually has this.
+    return "", ""
+
+
+def get_creation_time_from_resource(resource, ts=None):
+    '''
+    creationTime as XDS wants it (YYYYMMDDHHMMSS, UTC). falls back to the row timestamp
+    '''
+    for key in ['date', 'created']:
+        value = resource.get(key)
+        if value:
+            try:
+                parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+                if parsed.tzinfo is not None:
+                    parsed = parsed.astimezone(timezone.utc)
+                return parsed.strftime('%Y%m%d%H%M%S')
+            except ValueError:
+                continue
+    if ts is not None:
+        return ts.astimezone(timezone.utc).strftime('%Y%m%d%H%M%S')
+    return None
+
+
+def render_document(resource):
+    '''
+    the exact bytes ITI-39 serves for a resource, so size and hash in ITI-38 agree with the retrieve
+    '''
+    return bytes(utils.json2xml([resource]), 'utf-8')
+
+
+def build_registry_row(table, doc_id, txid, ts, resource):
+    patient_id = get_patient_id_from_resource(resource)
+    if patient_id is None:
+        return None
+    format_code, format_system = get_format_code_and_system_from_resource(resource)
+    hcf, hcf_system = get_hcf_and_system_from_resource(resource)
+    rendered = render_document(resource)
+    return (doc_id, table, patient_id, get_loinc_from_resource(resource), format_code,
+            format_system, hcf, hcf_system, get_creation_time_from_resource(resource, ts),
+            len(rendered), hashlib.sha1(rendered).hexdigest(), txid)
+
+
+def upsert_rows(cur, table, rows):
+    registry_rows = [build_registry_row(table, doc_id, txid, ts, resource) for doc_id, txid, ts, resource in rows]
+    registry_rows = [row for row in registry_rows if row is not None]
+    if registry_rows:
+        cur.executemany(UPSERT_REGISTRY_ROW, registry_rows)
+    return len(registry_rows)
+
+
+def install_trigger(cur, table):
+    trigger = f"{CHANGE_TABLE_NAME}_{table}".lower()
+    cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = %s::regclass", (trigger, table))
+    if cur.fetchone() is None:
+        cur.execute(CREATE_CHANGE_TRIGGER.format(trigger=trigger, table=table, function=CHANGE_TABLE_NAME + '_note'))
+
+
+def backfill_table(cur, table):
+    '''
+    first refresh of a table: the trigger goes in first, so anything written during the scan is queued and
+    picked up again afterwards
+    '''
+    install_trigger(cur, table)
+    written = 0
+    last_id = ''
+    while True:
+        cur.execute(f"SELECT id, txid, ts, resource FROM {table} WHERE id > %s ORDER BY id LIMIT %s",
+                    (last_id, REFRESH_BATCH_SIZE))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        written += upsert_rows(cur, table, rows)
+        last_id = rows[-1][0]
+    # the one full pass: entries left over from before the backfill for documents that are gone
+    cur.execute(
+        f'''DELETE FROM {REGISTRY_TABLE_NAME} r WHERE r.table_name = %s
+        AND NOT EXISTS (SELECT 1 FROM {table} t WHERE t.id = r.doc_id)''', (table,))
+    cur.execute(f"INSERT INTO {STATE_TABLE_NAME} (table_name) VALUES (%s) ON CONFLICT DO NOTHING", (table,))
+    return written
+
+
+def refresh_table(cur, table):
+    '''
+    bring the registry up to date with one fhir table from the queue of changed ids.
+    returns the number of registry rows written
+    '''
+    cur.execute(f"SELECT 1 FROM {STATE_TABLE_NAME} WHERE table_name = %s", (table,))
+    if cur.fetchone() is None:
+        return backfill_table(cur, table)
+
+    written = 0
+    while True:
+        cur.execute(TAKE_CHANGES, (table, table, REFRESH_BATCH_SIZE))
+        changed = [doc_id for (doc_id,) in cur.fetchall()]
+        if not changed:
+            break
+        cur.execute(f"SELECT id, txid, ts, resource FROM {table} WHERE id = ANY(%s)", (changed,))
+        rows = cur.fetchall()
+        written += upsert_rows(cur, table, rows)
+        # fhirbase moves deleted resources out of the table, so drop their registry entries
+        gone = list(set(changed) - set(doc_id for doc_id, *_ in rows))
+        if gone:
+            cur.execute(f"DELETE FROM {REGISTRY_TABLE_NAME} WHERE table_name = %s AND doc_id = ANY(%s)",
+                        (table, gone))
+    return written
+
+
+def refresh_registry(cur, tables=None):
+    '''
+    batch job that keeps document_registry in step with the fhir tables.
+    meant to be run on a schedule; the first run backfills a table, every run after that only touches the
+    documents written since the last one
+    '''
+    cur.execute(CREATE_REGISTRY_TABLES)
+    written = {}
+    for table in (tables if tables is not None else DOCUMENT_LOCATIONS):
+        written[table] = refresh_table(cur, table)
+    print("document registry refreshed,", written)
+    return written
+
+
+def is_ready(cur, tables=None):
+    '''
+    True once every document table has been backfilled. until then ITI-38 asks the fhir tables directly
+    '''
+    tables = set(tables if tables is not None else DOCUMENT_LOCATIONS)
+    if tables <= backfilled_tables:
+        return True
+    cur.execute("SELECT to_regclass(%s)", (STATE_TABLE_NAME,))
+    if cur.fetchone()[0] is None:
+        # the registry has never been refreshed
+        return False
+    cur.execute(f"SELECT table_name FROM {STATE_TABLE_NAME} WHERE table_name = ANY(%s)", (list(tables),))
+    backfilled_tables.update(table_name for (table_name,) in cur.fetchall())
+    return tables <= backfilled_tables
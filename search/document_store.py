@@ -0,0 +1,155 @@
+import hashlib
+import os
+import re
+
+ENV = os.environ.get("ENV")
+
+STORE_TABLE_NAME = 'document_store'
+
+CREATE_STORE_TABLE = f'''
+CREATE TABLE IF NOT EXISTS {STORE_TABLE_NAME} (
+    repository_id text NOT NULL,
+    document_id text NOT NULL,
+    content_hash text NOT NULL,
+    stored_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (repository_id, document_id)
+);
+CREATE INDEX IF NOT EXISTS {STORE_TABLE_NAME}_content_hash_idx ON {STORE_TABLE_NAME} (content_hash);
+'''
+
+INSERT_STORED = f'''
+INSERT INTO {STORE_TABLE_NAME} (repository_id, document_id, content_hash) VALUES (%s, %s, %s)
+ON CONFLICT DO NOTHING
+'''
+
+SELECT_STORED_KEYS = f"SELECT repository_id, document_id FROM {STORE_TABLE_NAME} WHERE document_id = ANY(%s)"
+
+tables_ready = False
+
+BETWEEN_TAGS = re.compile(rb'>\s+<')
+
+
+def normalized(document):
+    '''
+    the same cda served by two gateways differs in encoding declaration spacing, line endings and indentation
+    '''
+    if isinstance(document, str):
+        document = document.encode('utf-8')
+    if document.startswith(b'\xef\xbb\xbf'):
+        document = document[3:]
+    return BETWEEN_TAGS.sub(b'><', document.replace(b'\r\n', b'\n').strip())
+
+
+def content_hash(document):
+    return hashlib.sha256(normalized(document)).hexdigest()
+
+
+def ensure_tables(cur):
+    global tables_ready
+    if not tables_ready:
+        cur.execute(CREATE_STORE_TABLE)
+        tables_ready = True
+
+
+async def ensure_tables_async(db):
+    global tables_ready
+    if not tables_ready:
+        await db.execute(CREATE_STORE_TABLE)
+        tables_ready = True
+
+
+async def stored_keys(db, keys):
+    '''
+    the (repository id, document id) pairs out of keys we already hold. db is an async_db.AsyncDB
+    '''
+    keys = set(keys)
+    if not keys:
+        return set()
+    try:
+        await ensure_tables_async(db)
+        rows = await db.fetch(SELECT_STORED_KEYS, (list(set(document_id for _, document_id in keys)),))
+        return set(tuple(row) for row in rows) & keys
+    except Exception as e:
+        print("document store lookup failed,", repr(e))
+        return set()
+
+
+def stored_hashes(cur, hashes):
+    '''
+    content hash -> (repository id, document id) of a stored document with that payload
+    '''
+    hashes = set(hashes)
+    if not hashes:
+        return {}
+    try:
+        ensure_tables(cur)
+        cur.execute(f"SELECT DISTINCT ON (content_hash) content_hash, repository_id, document_id FROM {STORE_TABLE_NAME} "
+                    f"WHERE content_hash = ANY(%s) ORDER BY content_hash, repository_id, document_id",
+                    (list(hashes),))
+        return {content_hash: (repository_id, document_id) for content_hash, repository_id, document_id in cur.fetchall()}
+    except Exception as e:
+        print("document store hash lookup failed,", repr(e))
+        return {}
+
+
+def record(cur, rows):
+    '''
+    rows of (repository id, document id, content hash) that have been persisted
+    '''
+    if not rows:
+        return
+    try:
+        ensure_tables(cur)
+        cur.executemany(INSERT_STORED, rows)
+    except Exception as e:
+        print("document store record failed,", repr(e))
+
+
+class DocumentDeduplicator:
+    '''
+    one per search request. a document is the same document if it has the same DocumentUniqueId and repository,
+    or failing that the same normalized content
+    '''
+
+    def __init__(self):
+        self.keys = set()
+        self.hashes = set()
+        self.skipped_stored = 0
+        self.dropped = 0
+
+    async def skip_stored(self, db, pipelines):
+        '''
+        marks documents the store already holds as retrieved, so the planner doesn't ask for them again.
+        returns them as (entry, pipeline), for the caller to link to this search's patient
+        '''
+        keys = set((entry["rid"], entry["doc_id"]) for pipeline in pipelines for entry in pipeline.pids_and_doc_ids)
+        stored = await stored_keys(db, keys)
+        skipped = []
+        for pipeline in pipelines:
+            for entry in pipeline.pids_and_doc_ids:
+                if (entry["rid"], entry["doc_id"]) in stored:
+                    pipeline.retrieved_doc_ids.add(entry["doc_id"])
+                    skipped.append((entry, pipeline))
+                    self.skipped_stored += 1
+        self.keys |= stored
+        return skipped
+
+    def accept(self, record):
+        '''
+        True the first time a document comes through; sets record["content_hash"]
+        '''
+        key = (record.get("repo_id"), record["doc_id"])
+        if record["doc_id"] is not None and key in self.keys:
+            self.dropped += 1
+            return False
+        record["content_hash"] = content_hash(record["document"])
+        if record["content_hash"] in self.hashes:
+            self.dropped += 1
+            return False
+        if record["doc_id"] is not None:
+            self.keys.add(key)
+        self.hashes.add(record["content_hash"])
+        return True
+
+    def stats(self):
+        return {"skipped_stored": self.skipped_stored, "dropped": self.dropped, "kept": len(self.hashes)}
@@ -0,0 +1,151 @@
+from urllib.parse import unquote
+
+import aiohttp
+import mtom
+from lxml import etree
+
+from utils import XML_LEADING_BYTES, extract_envelope_content
+
+# bytes pulled off the socket per read
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class RetrieveResponseParser:
+    '''
+    incremental parser for RetrieveDocumentSetResponse bodies. feed() bytes as they arrive and get
+    document records back as each DocumentResponse closes; parsed elements are dropped right away,
+    so at most one document is held at a time
+    '''
+
+    def __init__(self):
+        # huge_tree: a base64 Document is one text node, and those can be far over libxml2's 10MB default
+        self.parser = etree.XMLPullParser(
+            events=('end',), tag='{%s}DocumentResponse' % mtom.XDS_NS, huge_tree=True)
+
+    def records(self):
+        for _, document_response in self.parser.read_events():
+            document_element = document_response.find('{%s}Document' % mtom.XDS_NS)
+            if document_element is not None:
+                include = document_element.find('{%s}Include' % mtom.XOP_NS)
+                content_id = None
+                if include is not None:
+                    content_id = include.get('href', '')
+                    if content_id.startswith('cid:'):
+                        content_id = content_id[4:]
+                    content_id = unquote(content_id)
+                yield {
+                    "doc_id": document_response.findtext('{%s}DocumentUniqueId' % mtom.XDS_NS),
+                    "repo_id": document_response.findtext('{%s}RepositoryUniqueId' % mtom.XDS_NS),
+                    "hcid": document_response.findtext('{%s}HomeCommunityId' % mtom.XDS_NS),
+                    "mime_type": document_response.findtext('{%s}mimeType' % mtom.XDS_NS),
+                    "content_id": content_id,
+                    "document": None if include is not None else mtom.decode_document_element(
+                        document_element, {})
+                }
+            # drop what we've parsed, including the earlier siblings still hanging off the parent
+            document_response.clear()
+            parent = document_response.getparent()
+            if parent is not None:
+                while document_response.getprevious() is not None:
+                    del parent[0]
+
+    def feed(self, data):
+        self.parser.feed(data)
+        return list(self.records())
+
+    def close(self):
+        self.parser.close()
+        return list(self.records())
+
+
+def pair_attachments(records, waiting, early_attachments):
+    '''
+    records that are complete now; the ones still waiting on an MTOM attachment go into waiting
+    '''
+    ready = []
+    for record in records:
+        if record["content_id"] is None:
+            ready.append(record)
+        elif record["content_id"] in early_attachments:
+            record["document"] = early_attachments.pop(record["content_id"])
+            ready.append(record)
+        else:
+            waiting[record["content_id"]] = record
+    return ready
+
+
+async def stream_multipart(response, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    MTOM: the root part is parsed as it streams in, and each attachment is read straight to bytes
+    and paired with the DocumentResponse that referenced it
+    '''
+    start_cid = None
+    for param in response.headers.get('Content-Type', '').split(';'):
+        if param.strip().lower().startswith('start='):
+            start_cid = mtom.strip_content_id(param.split('=', 1)[1].strip().strip('"'))
+
+    reader = aiohttp.MultipartReader.from_response(response)
+    parser = RetrieveResponseParser()
+    root_done = False
+    waiting = {}  # content id -> record whose attachment hasn't arrived yet
+    early_attachments = {}  # attachments that came before the root part
+
+    while True:
+        part = await reader.next()
+        if part is None:
+            break
+        content_id = mtom.strip_content_id(part.headers.get('Content-ID', ''))
+
+        if not root_done and (start_cid is None or content_id == start_cid):
+            while True:
+                chunk = await part.read_chunk(chunk_size)
+                if not chunk:
+                    break
+                for record in pair_attachments(parser.feed(chunk), waiting, early_attachments):
+                    yield record
+            for record in pair_attachments(parser.close(), waiting, early_attachments):
+                yield record
+            root_done = True
+            continue
+
+        data = bytes(await part.read(decode=True))
+        if content_id in waiting:
+            record = waiting.pop(content_id)
+            record["document"] = data
+            yield record
+        elif not root_done:
+            early_attachments[content_id] = data
+        else:
+            print("MTOM attachment not referenced by any DocumentResponse,", content_id)
+
+    for content_id in waiting:
+        print("MTOM attachment missing for,", content_id)
+
+
+async def stream_retrieve_response(response, chunk_size=STREAM_CHUNK_SIZE):
+    '''
+    async generator of document records ({"doc_id", "repo_id", "hcid", "mime_type", "content_id", "document"})
+    from an aiohttp ITI-39 response, plain SOAP or MTOM, consuming the body as it arrives
+    '''
+    if mtom.is_multipart(response.headers.get('Content-Type')):
+        async for record in stream_multipart(response, chunk_size):
+            yield record
+        return
+
+    parser = RetrieveResponseParser()
+    first_chunk = True
+    async for chunk in response.content.iter_chunked(chunk_size):
+        if first_chunk and not chunk[:64].lstrip(XML_LEADING_BYTES).startswith(b'<'):
+            # a multipart body sent without a multipart content type; fall back to finding the envelope
+            envelope = extract_envelope_content(chunk + await response.content.read())
+            if envelope is None:
+                print("no envelope found in 39 response")
+                return
+            for record in parser.feed(envelope) + parser.close():
+                yield record
+            return
+        first_chunk = False
+        for record in parser.feed(chunk):
+            yield record
+    for record in parser.close():
+        yield record
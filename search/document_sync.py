@@ -0,0 +1,125 @@
+import os
+
+ENV = os.environ.get("ENV")
+
+# DOCUMENT_SYNC=0 makes every search ask for, and retrieve, the full document list again
+DOCUMENT_SYNC = os.environ.get("DOCUMENT_SYNC", "1") == "1"
+
+SYNC_TABLE_NAME = 'document_sync'
+SYNC_ENTRY_TABLE_NAME = 'document_sync_entry'
+
+CREATE_SYNC_TABLES = f'''
+CREATE TABLE IF NOT EXISTS {SYNC_TABLE_NAME} (
+    oid text NOT NULL,
+    patient_id text NOT NULL,
+    creation_time_from text NOT NULL,
+    synced_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (oid, patient_id)
+);
+-- the internal patient the watermark was recorded for
+ALTER TABLE {SYNC_TABLE_NAME} ADD COLUMN IF NOT EXISTS pid text;
+CREATE TABLE IF NOT EXISTS {SYNC_ENTRY_TABLE_NAME} (
+    oid text NOT NULL,
+    patient_id text NOT NULL,
+    entry_uuid text NOT NULL,
+    PRIMARY KEY (oid, patient_id, entry_uuid)
+);
+'''
+
+UPSERT_WATERMARK = f'''
+INSERT INTO {SYNC_TABLE_NAME} (oid, patient_id, creation_time_from, pid, synced_at) VALUES (%s, %s, %s, %s, now())
+ON CONFLICT (oid, patient_id) DO UPDATE SET
+    creation_time_from = EXCLUDED.creation_time_from, pid = EXCLUDED.pid, synced_at = EXCLUDED.synced_at
+'''
+
+INSERT_ENTRY = f'''
+INSERT INTO {SYNC_ENTRY_TABLE_NAME} (oid, patient_id, entry_uuid) VALUES (%s, %s, %s)
+ON CONFLICT DO NOTHING
+'''
+
+SELECT_WATERMARK = f"SELECT creation_time_from, pid FROM {SYNC_TABLE_NAME} WHERE oid = %s AND patient_id = %s"
+SELECT_ENTRIES = f"SELECT entry_uuid FROM {SYNC_ENTRY_TABLE_NAME} WHERE oid = %s AND patient_id = %s"
+
+tables_ready = False
+
+
+def patient_key(patient_ids):
+    '''
+    one key for the (root, extension) pairs a gateway gave us for the patient
+    '''
+    return ','.join(sorted(root + '^' + extension for root, extension in patient_ids))
+
+
+async def ensure_tables(db):
+    global tables_ready
+    if not tables_ready:
+        await db.execute(CREATE_SYNC_TABLES)
+        tables_ready = True
+
+
+async def load(db, oid, patient_ids, pid):
+    '''
+    (creation time to ask from, set of entryUUIDs we already hold) for this patient at this gateway,
+    (None, set()) when we've never synced it, or synced it for another internal patient (pid): that one's documents
+    aren't linked to this one yet, so they're listed again and the search links the stored ones.
+    db is an async_db.AsyncDB
+    '''
+    if not DOCUMENT_SYNC or not patient_ids:
+        return None, set()
+    key = patient_key(patient_ids)
+    try:
+        await ensure_tables(db)
+        row = await db.fetchrow(SELECT_WATERMARK, (oid, key))
+        if row is None or row[1] != pid:
+            return None, set()
+        return row[0], set(entry_uuid for (entry_uuid,) in await db.fetch(SELECT_ENTRIES, (oid, key)))
+    except Exception as e:
+        print("document sync load failed,", repr(e))
+        return None, set()
+
+
+def query_slots(creation_time_from):
+    '''
+    extra ITI-38 slots for a follow up query. the day of the watermark is asked for again (the slot is inclusive
+    and gateways disagree on timestamp precision); whatever we already hold is dropped by entryUUID afterwards
+    '''
+    if creation_time_from is None:
+        return []
+    return [("$XDSDocumentEntryCreationTimeFrom", [creation_time_from[:8]])]
+
+
+def next_watermark(entries, retrieved_entry_uuids, previous):
+    '''
+    the newest creation time once everything asked for came back; if something didn't, the oldest one that
+    didn't, so the next sync asks for it again
+    '''
+    missing = [entry["creation_time"] for entry in entries
+               if entry["entry_uuid"] not in retrieved_entry_uuids and entry["creation_time"]]
+    if missing:
+        return min(missing)
+    if any(entry["entry_uuid"] not in retrieved_entry_uuids for entry in entries):
+        # a missing entry without a creation time can't be windowed for, keep the old watermark
+        return previous
+    creation_times = [entry["creation_time"] for entry in entries if entry["creation_time"]]
+    if previous:
+        creation_times.append(previous)
+    return max(creation_times) if creation_times else previous
+
+
+async def record(db, oid, patient_ids, pid, entries, retrieved_entry_uuids, previous, advance=True):
+    '''
+    pid is the internal patient the documents were linked to.
+    advance=False only records the entries. a filtered search has to, since entries it filtered out (in the query
+    or after) are older than what it saw, and a watermark moved past them would hide them from every later search
+    '''
+    if not DOCUMENT_SYNC or not patient_ids:
+        return
+    key = patient_key(patient_ids)
+    watermark = next_watermark(entries, retrieved_entry_uuids, previous) if advance else None
+    try:
+        await ensure_tables(db)
+        await db.executemany(INSERT_ENTRY, [(oid, key, entry_uuid) for entry_uuid in retrieved_entry_uuids])
+        if watermark:
+            await db.execute(UPSERT_WATERMARK, (oid, key, watermark, pid))
+    except Exception as e:
+        print("document sync record failed,", repr(e))
@@ -1,16 +1,14 @@
 import asyncio
-import boto3
 import os
-import ssl
 import traceback
 import uuid
 
 import aiohttp
-from lxml import etree
-from requests import Session
 from saml_wrapper import *
-from zeep import Client, Settings
-from zeep.transports import Transport
+
+import message_builders
+import xpaths
+from runtime import get_runtime
 
 ENV = os.environ.get("ENV")
 
@@ -40,90 +38,30 @@ class ITI38Initiator:
         else:
             self.request = response
             root = self.request
-            self.responder_url = root.find('.//{*}ReplyTo/{*}Address').text
-
-        settings = Settings(strict=False, force_https=True)
-        session = Session()
-        session.cert = ('/tmp/cqcert.crt', '/tmp/cqkey.key')
-        session.verify = "/tmp/trusted.pem"
-        session.verify = False
-
-        self.session = session
-        transport = Transport(session=session)
-
-        # set up the sync client strictly for composing the message. use an async session to actually send the message
-        self.client = Client('wsdls/drive_ITI38_responder.wsdl',
-                             settings=settings,
-                             transport=transport)
-        self.service = self.client.create_service(
-            '{urn:ihe:iti:xds-b:2007}RespondingGatewayQuery_Binding_Soap12',
-            self.responder_url
-        )
+            self.responder_url = xpaths.first_string(xpaths.REPLY_TO_ADDRESS(root))
 
     def setup(self):
         if not self.setup_done:
-            async_ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            async_ssl_ctx.load_cert_chain('/tmp/cqcert.crt', '/tmp/cqkey.key')
-            # enforce verification of the server certificate with trusted.pem
-            async_ssl_ctx.load_verify_locations('/tmp/trusted.pem')
-            async_conn = aiohttp.TCPConnector(ssl_context=async_ssl_ctx)
-
-            async_session = aiohttp.ClientSession(
-                connector=async_conn, timeout=aiohttp.ClientTimeout(total=60))
-            self.async_session = async_session
-
-            # do not use an asyncClient for wsdls that have imports. zeep compatibility is bad
-            # self.async_client = AsyncClient('wsdls/drive_ITI38_responder.wsdl', settings=async_settings, transport=async_transport, plugins=[self.async_history])
-            # self.async_service = self.async_client.create_service('{urn:ihe:iti:xds-b:2007}RespondingGatewayQuery_Binding_Soap12',self.responder_url)
+            # shared with every other initiator in this container; never closed here
+            self.async_session = get_runtime().http_session()
             self.setup_done = True
 
     async def send_request(self):
         try:
             self.setup()
-            # Create the request object
-            AdhocQueryRequest = {
-                "ResponseOption": {
-                    "returnComposedObjects": "true",
-                    "returnType": self.returntype
-                },
-                "AdhocQuery": {
-                    "id": "urn:uuid:" + "",
-                    "home": "urn:oid:" + self.receiver_hcid,
-                    "Slot": [
-                        {
-                            "name": "$XDSDocumentEntryPatientId",
-                            "ValueList": {
-                                "Value": [
-                                    "'" + pid[1] + "^^^&" + pid[0] + "&ISO'" for pid in self.params['pids']
-                                ]
-                            }
-                        },
-                        {
-                            "name": "$XDSDocumentEntryStatus",
-                            "ValueList": {
-                                "Value": [
-                                    "('urn:oasis:names:tc:ebxml-regrep:StatusType:Approved')" *
-                                    len(self.params['pids'])
-                                ]
-                            }
-                        }
-                    ],
-                }
-            }
-
             # Add the SAML assertion to the request
             saml = Saml()
             saml_assertion, refId = saml.create_saml_assertion_string(
                 "http://ihe.connectathon.XUA/X-ServiceProvider-IHE-Connectathon", "",
                 "", self.user_qualifications)
 
-            soap_message = self.client.create_message(
-                self.service, 'RespondingGateway_CrossGatewayQuery',
-                ResponseOption=AdhocQueryRequest['ResponseOption'],
-                AdhocQuery=AdhocQueryRequest['AdhocQuery'],
-                _soapheaders=[saml_assertion])
+            request = message_builders.build_xca_query_request(
+                self.params['pids'], self.receiver_hcid, return_type=self.returntype,
+                extra_slots=self.params.get('extra_slots'))
+            soap_message = message_builders.build_envelope(
+                message_builders.XCA_QUERY_ACTION, self.responder_url, request, saml_assertion)
             signed_message = saml.sign_soap_message(
-                etree.tostring(soap_message),
+                soap_message,
                 refId,
                 self.url,
                 self.responder_url
@@ -137,16 +75,16 @@ class ITI38Initiator:
                 'Accept-Encoding': 'gzip, deflate, br',
                 'Content-Type': 'application/soap+xml'
             }
-            async with self.async_session.post(endpoint, data=signed_message, headers=headers) as response:
+            async with get_runtime().post(endpoint, data=signed_message, headers=headers,
+                                          timeout=aiohttp.ClientTimeout(total=60)) as response:
                 try:
-                    response_text = await response.text()
-                    self.response_xml = response_text
+                    # raw bytes, parsed once by the pipeline
+                    self.response_xml = await response.read()
                     self.process_response()
                     print(f"processed 38 response for {endpoint}")
                 except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.exceptions.TimeoutError) as e:
                     print(repr(e))
                     self.response_xml = None
-            await self.async_session.close()
             return self.response_xml
 
         except Exception:
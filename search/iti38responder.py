@@ -1,9 +1,13 @@
-import boto3
 import os
 import uuid
 
 from lxml import etree
 
+import document_registry
+import query_catalog
+import utils
+import xpaths
+
 ENV = os.environ.get("ENV")
 
 
@@ -20,12 +24,11 @@ class ITI38Responder:
         else:
             self.request = request
             root = self.request
-            self.initiator_url = root.find(
-                './/{*}ReplyTo/{*}Address').text if root.find('.//{*}ReplyTo/{*}Address') else None
-            self.returntype = root.find('.//{*}ResponseOption').attrib['returnType']
+            self.initiator_url = xpaths.first_string(xpaths.REPLY_TO_ADDRESS(root))
+            self.returntype = xpaths.first_string(xpaths.RETURN_TYPE(root))
 
             # check that it's to us
-            to_element = root.find('.//*/{*}To').text
+            to_element = xpaths.first_string(xpaths.TO(root))
             if to_element not in self.possible_urls:
                 raise Exception(f"request is not to us, it's to {to_element}")
 
@@ -42,18 +45,15 @@ class ITI38Responder:
         '''
         root = self.request
 
-        # Find all elements with the specified namespace and tag
-        patient_id_elements = root.findall(
-            './/{*}Slot[@name="$XDSDocumentEntryPatientId"]/{*}ValueList/{*}Value')
-
-        # Extract the values so that we have list of strings
-        patient_ids = [eval(element.text).split('^^^')[0] for element in patient_id_elements]
+        # values of the $XDSDocumentEntryPatientId slot, as a list of strings
+        patient_ids = [utils.ambiguous_strip(value.strip()).split('^^^')[0]
+                       for value in xpaths.PATIENT_ID_SLOT_VALUES(root)]
 
         self.patient_ids = patient_ids
 
     def search_db_for_documents_metadata(self):
         '''
-        Searches our database for documents that match the pids in self.patient_ids, not including summaries.
+        Searches the document registry for documents that match the pids in self.patient_ids, not including summaries.
         Returns a list of [(Home Community ID, Repository ID, and Document unique ID)...] metadata for the documents found
         DO NOT RETURN THE ACTUAL CONTENTS OF THE DOCUMENTS
         '''
@@ -62,59 +62,45 @@ class ITI38Responder:
         hcid = self.hcid
         rid = self.hcid
 
-        # list of fhir tables to search for documents
-        document_locations = [
-           
-        ]
-
-        results = set()  # set of tuples of (hcid, rid, document_id)
-        for pid in self.patient_ids:
-            for table in document_locations:
-                sql_queries = [
-                    '''SELECT id, resource FROM {table} WHERE resource->'patient' @> \'{{"id": "{pid}"}}\''''.
-                    format(table=table, pid=pid),
-                    '''SELECT id, resource FROM {table} WHERE resource->'subject' @> \'{{"id": "{pid}"}}\''''.
-                    format(table=table, pid=pid),
-                    '''SELECT id, resource FROM {table} WHERE resource @> \'{{"patientFhirId": "{pid}"}}\''''.
-                    format(table=table, pid=pid)]  # apparent variation in db
-                for query in sql_queries:
-                    self.cur.execute(query)
-                    doc_ids_resources_for_patients = self.cur.fetchall()
-                    for (doc_id, resource) in doc_ids_resources_for_patients:
-                        loinc_code = self.get_loinc_from_resource(resource)
-                        format_code, format_system = self.get_format_code_and_system_from_resource(
-                            resource)
-                        hcf, hcf_system = self.get_hcf_and_system_from_resource(resource)
-                        results.add((hcid, rid, doc_id, pid, table, loinc_code,
-                                    format_code, format_system, hcf, hcf_system))
+        # the registry is kept up to date from the fhir tables by document_registry.refresh_registry
+        results = set()  # set of tuples of (hcid, rid, document_id, ...)
+        if document_registry.is_ready(self.cur):
+            # one indexed lookup for everything the response needs
+            query_catalog.execute(self.cur, 'registry_documents_for_patients', (list(self.patient_ids),))
+            rows = self.cur.fetchall()
+        else:
+            rows = self.live_documents_metadata()
+        for (doc_id, pid, table, loinc_code, format_code, format_system, hcf, hcf_system,
+             creation_time, size, doc_hash) in rows:
+            results.add((hcid, rid, doc_id, pid, table, loinc_code,
+                        format_code, format_system, hcf, hcf_system, creation_time, size, doc_hash))
 
         self.documents_found = list(results)
         print("documents founds have the following ids", results)
         return results
 
-    def get_loinc_from_resource(self, resource):
-        try:
-            return [category['coding'][0]['code']
-                    for category in resource['category']
-                    if category['coding'][0]['system'] == 'http://loinc.org'][0]
-        except:
-            try:
-                return [code['code']
-                        for code in resource['type']['coding']
-                        if code['system'] == 'http://loinc.org'][0]
-            except:
-                return ""
-
-    def get_format_code_and_system_from_resource(self, resource):
-        try:
-            return resource['content'][0]['format']['code'], resource['content'][0]['format'][
-                'system']
-        except:
-            return "", ""
-
-    def get_hcf_and_system_from_resource(self, resource):
-        # TODO: implement based on a fhir resource that actually has this.
-        return "", ""
+    def live_documents_metadata(self):
+        '''
+        the registry's rows, built from the fhir tables directly, for while it hasn't been backfilled yet
+        '''
+        rows = []
+        for table in document_registry.DOCUMENT_LOCATIONS:
+            query_catalog.execute(self.cur, 'documents_for_patients_live', (list(self.patient_ids),), table=table)
+            for doc_id, txid, ts, resource in self.cur.fetchall():
+                row = document_registry.build_registry_row(table, doc_id, txid, ts, resource)
+                if row is not None:
+                    # same columns as registry_documents_for_patients
+                    rows.append((row[0], row[2]) + (row[1],) + row[3:11])
+        return rows
+
+    def build_slot(self, name, value):
+        slot = etree.Element('{urn:oasis:names:tc:ebxml-regrep:xsd:rim:3.0}Slot', name=name)
+        value_list = etree.SubElement(
+            slot, '{urn:oasis:names:tc:ebxml-regrep:xsd:rim:3.0}ValueList')
+        value_element = etree.SubElement(
+            value_list, '{urn:oasis:names:tc:ebxml-regrep:xsd:rim:3.0}Value')
+        value_element.text = str(value)
+        return slot
 
     def build_classification_object(
             self, registry_object_id_long, classification_scheme, code, system):
@@ -158,14 +144,14 @@ class ITI38Responder:
 
         # object ref is useless
         if self.returntype == "ObjectRef":
-            for hcid, repo_id, doc_id, pid in self.documents_found:
+            for hcid, repo_id, doc_id, pid, *_ in self.documents_found:
                 ObjectRef = etree.SubElement(
                     RegistryObjectList, '{urn:oasis:names:tc:ebxml-regrep:xsd:rim:3.0}ObjectRef')
                 ObjectRef.set('id', "urn:uuid:" + doc_id)
                 ObjectRef.set('home', "urn:oid:" + hcid)
         elif self.returntype == "LeafClass":
-            for hcid, repo_id, doc_id, pid, doc_name, loinc, format_code, format_system, hcf, hcf_system \
-                    in self.documents_found:
+            for hcid, repo_id, doc_id, pid, doc_name, loinc, format_code, format_system, hcf, hcf_system, \
+                    creation_time, size, doc_hash in self.documents_found:
 
                 # make pid slot and external identifier element
                 pid_concat = pid + "^^^&" + hcid + "&ISO"
@@ -277,6 +263,12 @@ class ITI38Responder:
                 ExtrinsicObject.set('status', "urn:oasis:names:tc:ebxml-regrep:StatusType:Approved")
                 ExtrinsicObject.append(patient_slot)
                 ExtrinsicObject.append(repo_slot)
+                if creation_time:
+                    ExtrinsicObject.append(self.build_slot('creationTime', creation_time))
+                if size is not None:
+                    ExtrinsicObject.append(self.build_slot('size', size))
+                if doc_hash:
+                    ExtrinsicObject.append(self.build_slot('hash', doc_hash))
                 ExtrinsicObject.append(doc_name_element)
 
                 ExtrinsicObject.append(classification_classCode)
@@ -1,19 +1,25 @@
 import asyncio
-import boto3
 import os
-import ssl
 import traceback
 import uuid
 
 import aiohttp
+from document_stream import stream_retrieve_response
 from lxml import etree
-from requests import Session
 from saml_wrapper import *
-from zeep import Client, Settings
-from zeep.transports import Transport
+
+import message_builders
+import xpaths
+from runtime import get_runtime
 
 ENV = os.environ.get("ENV")
 
+HEADERS = {
+    'Accept': 'application/soap+xml, multipart/related',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Content-Type': 'application/soap+xml'
+}
+
 
 class ITI39Initiator:
     def __init__(self,
@@ -42,95 +48,53 @@ class ITI39Initiator:
         else:
             self.request = response
             root = self.request
-            self.responder_url = root.find('.//{*}ReplyTo/{*}Address').text
-
-        settings = Settings(strict=False, force_https=True)
-        session = Session()
-        session.cert = ('/tmp/cqcert.crt', '/tmp/cqkey.key')
-        session.verify = "/tmp/trusted.pem"
-
-        self.session = session
-        transport = Transport(session=session)
-
-        self.client = Client('wsdls/drive_ITI39_responder.wsdl',
-                             settings=settings,
-                             transport=transport)
-        self.service = self.client.create_service(
-            '{urn:ihe:iti:xds-b:2007}RespondingGatewayRetrieve_Binding_Soap12',
-            self.responder_url
-        )
+            self.responder_url = xpaths.first_string(xpaths.REPLY_TO_ADDRESS(root))
 
     def setup(self):
         if not self.setup_done:
-            async_ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            async_ssl_ctx.load_cert_chain('/tmp/cqcert.crt', '/tmp/cqkey.key')
-            # enforce verification of the server certificate with trusted.pem
-            async_ssl_ctx.load_verify_locations('/tmp/trusted.pem')
-            async_conn = aiohttp.TCPConnector(ssl_context=async_ssl_ctx)
-
-            async_session = aiohttp.ClientSession(
-                connector=async_conn,
-                timeout=aiohttp.ClientTimeout(total=60)
-            )
-            self.async_session = async_session
-
-            # do not use an asyncClient for wsdls that have imports. zeep compatibility is bad
-            # self.async_client = AsyncClient('wsdls/drive_ITI39_responder.wsdl', settings=async_settings, transport=async_transport, plugins=[self.async_history])
-            # self.async_service = self.async_client.create_service('{urn:ihe:iti:xds-b:2007}RespondingGatewayQuery_Binding_Soap12',self.responder_url)
+            # shared with every other initiator in this container; never closed here
+            self.async_session = get_runtime().http_session()
             self.setup_done = True
 
+    def build_signed_message(self):
+        # Add the SAML assertion to the request
+        saml = Saml()
+        saml_assertion, refId = saml.create_saml_assertion_string(
+            "http://ihe.connectathon.XUA/X-ServiceProvider-IHE-Connectathon", "",
+            "", self.user_qualifications)
+
+        request = message_builders.build_xca_retrieve_request([
+            (self.receiver_hcid, pair['rid'], pair["doc_id"]) for pair in self.params['pid_and_doc_ids']
+        ])
+        soap_message = message_builders.build_envelope(
+            message_builders.XCA_RETRIEVE_ACTION, self.responder_url, request, saml_assertion)
+        return saml.sign_soap_message(
+            soap_message,
+            refId,
+            self.url,
+            self.responder_url
+        )
+
     async def send_request(self):
         try:
             self.setup()
-            # Create the request object
-            DocumentRequest = [
-                {
-                    "HomeCommunityId": "urn:oid:"+self.receiver_hcid,
-                    "RepositoryUniqueId": pair['rid'],
-                    "DocumentUniqueId": pair["doc_id"]
-                } for pair in self.params['pid_and_doc_ids']
-            ]
-
-            # Add the SAML assertion to the request
-            saml = Saml()
-            saml_assertion, refId = saml.create_saml_assertion_string(
-                "http://ihe.connectathon.XUA/X-ServiceProvider-IHE-Connectathon", "",
-                "", self.user_qualifications)
-
-            soap_message = self.client.create_message(self.service,
-                                                      'RespondingGateway_CrossGatewayRetrieve',
-                                                      DocumentRequest=DocumentRequest,
-                                                      _soapheaders=[saml_assertion])
-            signed_message = saml.sign_soap_message(
-                etree.tostring(soap_message),
-                refId,
-                self.url,
-                self.responder_url
-            )
+            signed_message = self.build_signed_message()
 
             # Get the binding object
             endpoint = self.responder_url
 
             # Send the request asynchronously
-            headers = {
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Content-Type': 'application/soap+xml'
-            }
-            async with self.async_session.post(endpoint, data=signed_message, headers=headers) as response:
+            async with get_runtime().post(endpoint, data=signed_message, headers=HEADERS,
+                                          timeout=aiohttp.ClientTimeout(total=60)) as response:
                 try:
-                    response_text = await response.text()
-                    self.response_xml = response_text
+                    # raw bytes, plain soap or multipart
+                    self.response_xml = await response.read()
                     self.process_response()
                     print(f"processed 39 response for {endpoint}")
                 except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.exceptions.TimeoutError) as e:
                     print(repr(e))
                     self.response_xml = None
-                except Exception as e:
-                    print("cannot utf-8 decode. here's the weird bytes like object,",
-                          await response.content.read())
-                    self.response_xml = ''
 
-            await self.async_session.close()
             return self.response_xml
 
         except Exception:
@@ -138,6 +102,27 @@ class ITI39Initiator:
             print(traceback.format_exc())
             return None
 
+    async def stream_documents(self):
+        '''
+        async generator of document records, yielded one at a time as the response body is parsed.
+        the body is never held whole
+        '''
+        endpoint = self.responder_url
+        try:
+            self.setup()
+            signed_message = self.build_signed_message()
+            async with get_runtime().post(endpoint, data=signed_message, headers=HEADERS,
+                                          timeout=aiohttp.ClientTimeout(total=60)) as response:
+                async for record in stream_retrieve_response(response):
+                    yield record
+            print(f"processed 39 response for {endpoint}")
+        except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.exceptions.TimeoutError) as e:
+            print(repr(e))
+        except etree.XMLSyntaxError as e:
+            print(f"unable to parse 39 response from {endpoint},", e)
+        except Exception:
+            print(traceback.format_exc())
+
     def process_response(self):
         # insert processing
         return self.response_xml
@@ -1,14 +1,25 @@
 import base64
-import boto3
 import os
 import uuid
 
 from lxml import etree
 
-import utils
+import document_registry
+import mtom
+import query_catalog
+import xpaths
+from document_cache import get_document_cache
 
 ENV = os.environ.get("ENV")
 
+# rows per round trip when pulling documents through a server side cursor
+FETCH_BATCH_SIZE = 10
+# base64 text handed to the serializer per write
+ENCODED_WRITE_SIZE = 64 * 1024
+# document bytes one response may carry, as base64. lambda caps a response at 6MB and the whole body is held in
+# memory, so documents past this are left out with an error and can be asked for again on their own
+RESPONSE_MAX_BYTES = int(os.environ.get("RESPONSE_MAX_BYTES", 5 * 1024 * 1024))
+
 
 class ITI39Responder:
     def __init__(self, cur, request, initiator_url=None):
@@ -16,6 +27,7 @@ class ITI39Responder:
         self.cur = cur
         self.hcid = ""
         self.possible_urls = []
+        self.document_cache = get_document_cache()
 
         # did not receive an xml request, only got initiator url (usually only for testing)
         if initiator_url:
@@ -24,11 +36,10 @@ class ITI39Responder:
         else:
             self.request = request
             root = self.request
-            self.initiator_url = root.find(
-                './/{*}ReplyTo/{*}Address').text if root.find('.//{*}ReplyTo/{*}Address') else None
+            self.initiator_url = xpaths.first_string(xpaths.REPLY_TO_ADDRESS(root))
 
             # check that it's to us
-            to_element = root.find('.//*/{*}To').text
+            to_element = xpaths.first_string(xpaths.TO(root))
             if to_element not in self.possible_urls:
                 raise Exception(f"request is not to us, it's to {to_element}")
 
@@ -44,13 +55,11 @@ class ITI39Responder:
         '''
         root = self.request
 
-        document_request_elements = root.findall('.//{*}DocumentRequest')
-
         metadata = []
-        for document_request_element in document_request_elements:
-            repo_id = document_request_element.find('.//{*}RepositoryUniqueId').text
-            hcid = document_request_element.find('.//{*}HomeCommunityId').text
-            document_unique_id = document_request_element.find('.//{*}DocumentUniqueId').text
+        for document_request_element in xpaths.DOCUMENT_REQUESTS(root):
+            repo_id = document_request_element.findtext('{%s}RepositoryUniqueId' % mtom.XDS_NS)
+            hcid = document_request_element.findtext('{%s}HomeCommunityId' % mtom.XDS_NS)
+            document_unique_id = document_request_element.findtext('{%s}DocumentUniqueId' % mtom.XDS_NS)
 
             if hcid[:8] == 'urn:oid:':
                 hcid = hcid[8:]
@@ -62,79 +71,179 @@ class ITI39Responder:
         print("metadata:", metadata)
         return metadata
 
-    def search_db_for_documents(self):
+    def search_db_for_documents(self, full=lambda: False):
         '''
         In a list of fhir tables,
-        find actual documents associated with document_unique_id
-        return dicts of {'hcid': hcid, 'repo_id': repo_id, 'document_unique_id': document_unique_id, 'document': document}
-        document needs to be base64 encoded
+        find actual documents associated with document_unique_id, one query per table for all requested ids
+        yields dicts of {'hcid': hcid, 'repo_id': repo_id, 'document_unique_id': document_unique_id, 'document': document}
+        one at a time so that only one uncached document is held in memory. document is a CachedDocument
+        with the rendered bytes, or None once full() says the response has no room left: those aren't read at all
+        '''
+        locations = {document_unique_id: (hcid, repo_id)
+                     for hcid, repo_id, document_unique_id in self.metadata}
+        requested = dict(locations)
+        self.documents_found = []
+        print("searching for doc_ids across tables:", list(requested))
+        for table in document_registry.DOCUMENT_LOCATIONS:
+            if not requested:
+                break
+            # versions first; only resources we don't already have rendered are pulled from the db
+            query_catalog.execute(self.cur, 'document_versions', (list(requested),), table=table)
+            misses = []
+            for document_unique_id, txid in self.cur.fetchall():
+                hcid, repo_id = requested.pop(document_unique_id)
+                self.documents_found.append(document_unique_id)
+                if full():
+                    yield {'hcid': hcid, 'repo_id': repo_id,
+                           'document_unique_id': document_unique_id, 'document': None}
+                    continue
+                cached = self.document_cache.get(table, document_unique_id, txid)
+                if cached is None:
+                    misses.append(document_unique_id)
+                    continue
+                yield {'hcid': hcid, 'repo_id': repo_id,
+                       'document_unique_id': document_unique_id,
+                       'document': cached}
+            if not misses:
+                continue
+            if full():
+                for document_unique_id in misses:
+                    hcid, repo_id = locations[document_unique_id]
+                    yield {'hcid': hcid, 'repo_id': repo_id,
+                           'document_unique_id': document_unique_id, 'document': None}
+                continue
+
+            # server side cursor, so rows come over in batches instead of all at once
+            cur = self.cur.connection.cursor(name="iti39_" + uuid.uuid4().hex)
+            cur.itersize = FETCH_BATCH_SIZE
+            cur.execute(f"SELECT id, txid, resource FROM {table} WHERE id = ANY(%s)", (misses,))
+            for document_unique_id, txid, resource in cur:
+                print("found resource for,", document_unique_id)
+                hcid, repo_id = locations[document_unique_id]
+                if full():
+                    yield {'hcid': hcid, 'repo_id': repo_id,
+                           'document_unique_id': document_unique_id, 'document': None}
+                    continue
+                rendered = document_registry.render_document(resource)
+                yield {'hcid': hcid, 'repo_id': repo_id,
+                       'document_unique_id': document_unique_id,
+                       'document': self.document_cache.put(table, document_unique_id, txid, rendered)}
+            cur.close()
+        print("number of documents found,", len(self.documents_found))
+
+    def build_document_response_header(self, document):
+        '''
+        the small elements of a DocumentResponse that come before the Document itself
+        '''
+        elements = []
+        for tag, text in [('HomeCommunityId', document['hcid']),
+                          ('RepositoryUniqueId', document['repo_id']),
+                          ('DocumentUniqueId', document['document_unique_id']),
+                          ('mimeType', "text/xml")]:
+            element = etree.Element('{urn:ihe:iti:xds-b:2007}' + tag)
+            element.text = text
+            elements.append(element)
+        return elements
+
+    def build_registry_response(self, left_out=()):
+        RegistryResponse = etree.Element('{urn:oasis:names:tc:ebxml-regrep:xsd:rs:3.0}RegistryResponse')
+        if not left_out:
+            RegistryResponse.set('status',
+                                 'urn:oasis:names:tc:ebxml-regrep:ResponseStatusType:Success')
+            return RegistryResponse
+        RegistryResponse.set('status',
+                             'urn:ihe:iti:2007:ResponseStatusType:PartialSuccess')
+        RegistryErrorList = etree.SubElement(
+            RegistryResponse, '{urn:oasis:names:tc:ebxml-regrep:xsd:rs:3.0}RegistryErrorList')
+        for document in left_out:
+            etree.SubElement(
+                RegistryErrorList, '{urn:oasis:names:tc:ebxml-regrep:xsd:rs:3.0}RegistryError',
+                errorCode='XDSRepositoryError',
+                codeContext='response size limit reached, retrieve this document on its own',
+                location=document['document_unique_id'],
+                severity='urn:oasis:names:tc:ebxml-regrep:ErrorSeverityType:Error')
+        return RegistryResponse
+
+    def documents_within_limit(self, max_bytes=RESPONSE_MAX_BYTES):
+        '''
+        (documents that fit in one response, documents left out). documents go in until one doesn't fit; that one
+        and every one after it are left out, and the ones after it aren't even read.
+        left out documents are {'document_unique_id', 'size'}, size None for the ones not read
+        '''
+        included, left_out = [], []
+        total = 0
+        for document in self.search_db_for_documents(full=lambda: bool(left_out)):
+            if document['document'] is None:
+                left_out.append({'document_unique_id': document['document_unique_id'], 'size': None})
+                continue
+            # base64 either way: inline documents are, and an MTOM body is encoded whole for the lambda response
+            size = 4 * ((len(document['document'].rendered) + 2) // 3)
+            if total + size > max_bytes:
+                print("leaving", document['document_unique_id'], "out of the response,", size, "bytes")
+                left_out.append({'document_unique_id': document['document_unique_id'], 'size': size})
+                continue
+            total += size
+            included.append(document)
+        if left_out:
+            print("left", len(left_out), "documents out of the response")
+        return included, left_out
+
+    def write_response_body(self, xf, attachments=None):
         '''
-        tables = []
-        documents_found = []
-        for hcid, repo_id, document_unique_id in self.metadata:
-            our_doc_id = document_unique_id
-
-            print("searching for doc_id across tables:", our_doc_id)
-            for table in tables:
-                self.cur.execute(f"SELECT resource FROM {table} WHERE id = '{our_doc_id}'")
-                resource = self.cur.fetchone()
-                if resource is not None:
-                    print("found resource for,", document_unique_id)
-                    xml_str = utils.json2xml(list(resource))
-                    xml_bytes_doc = bytes(xml_str, 'utf-8')
-
-                    documents_found.append({'hcid': hcid, 'repo_id': repo_id,
-                                            'document_unique_id': document_unique_id,
-                                            'document': base64.b64encode(xml_bytes_doc)})
-        self.documents_found = documents_found
-        print("number of documents found,", len(documents_found))
-        return documents_found
+        writes the RetrieveDocumentSetResponse into an etree.xmlfile, at most RESPONSE_MAX_BYTES of documents.
+        the response as a whole is built in memory (lambda hands it back in one piece), so that's the bound
+        if attachments is a list, documents are instead referenced with xop:Include and appended to it
+        as (content id, bytes) for the caller to pack into an MTOM message
+        '''
+        self.write_request()
+        self.process_xca_retrieve_documents_request()
+        # the registry response, and whether it's a partial success, comes before the documents
+        documents, left_out = self.documents_within_limit()
+        with xf.element('{urn:ihe:iti:xds-b:2007}RetrieveDocumentSetResponse'):
+            xf.write(self.build_registry_response(left_out))
+            for document in documents:
+                with xf.element('{urn:ihe:iti:xds-b:2007}DocumentResponse'):
+                    for element in self.build_document_response_header(document):
+                        xf.write(element)
+                    with xf.element('{urn:ihe:iti:xds-b:2007}Document'):
+                        if attachments is not None:
+                            content_id = mtom.new_content_id()
+                            xf.write(etree.Element('{%s}Include' % mtom.XOP_NS,
+                                                   href="cid:" + content_id,
+                                                   nsmap={'xop': mtom.XOP_NS}))
+                            attachments.append((content_id, document['document'].rendered))
+                        else:
+                            # 3 byte aligned slices encode to base64 that concatenates cleanly
+                            rendered = document['document'].rendered
+                            step = ENCODED_WRITE_SIZE // 4 * 3
+                            for i in range(0, len(rendered), step):
+                                xf.write(base64.b64encode(rendered[i:i + step]).decode('ascii'))
+                xf.flush()
 
     def generate_response_body(self):
         '''
         documents_found is a list of [(Home Community ID, Repository ID, and Document unique ID)...]
+        builds the whole response as a tree; write_response_body is the streaming equivalent
         '''
         self.write_request()
         self.process_xca_retrieve_documents_request()
-        self.search_db_for_documents()
         RetrieveDocumentSetResponse = etree.Element(
             '{urn:ihe:iti:xds-b:2007}RetrieveDocumentSetResponse')
-        RegistryResponse = etree.SubElement(
-            RetrieveDocumentSetResponse,
-            '{urn:oasis:names:tc:ebxml-regrep:xsd:rs:3.0}RegistryResponse')
-        RegistryResponse.set('status',
-                             'urn:oasis:names:tc:ebxml-regrep:ResponseStatusType:Success')
+        documents, left_out = self.documents_within_limit()
+        RetrieveDocumentSetResponse.append(self.build_registry_response(left_out))
 
-        for document in self.documents_found:
+        for document in documents:
             DocumentResponse = etree.SubElement(
                 RetrieveDocumentSetResponse,
                 '{urn:ihe:iti:xds-b:2007}DocumentResponse'
             )
-            HomeCommunityId = etree.SubElement(
-                DocumentResponse,
-                '{urn:ihe:iti:xds-b:2007}HomeCommunityId'
-            )
-            HomeCommunityId.text = document['hcid']
-            RepositoryUniqueId = etree.SubElement(
-                DocumentResponse,
-                '{urn:ihe:iti:xds-b:2007}RepositoryUniqueId'
-            )
-            RepositoryUniqueId.text = document['repo_id']
-            DocumentUniqueId = etree.SubElement(
-                DocumentResponse,
-                '{urn:ihe:iti:xds-b:2007}DocumentUniqueId'
-            )
-            DocumentUniqueId.text = document['document_unique_id']
-            mimeType = etree.SubElement(
-                DocumentResponse,
-                '{urn:ihe:iti:xds-b:2007}mimeType'
-            )
-            mimeType.text = "text/xml"
+            for element in self.build_document_response_header(document):
+                DocumentResponse.append(element)
             Document = etree.SubElement(
                 DocumentResponse,
                 '{urn:ihe:iti:xds-b:2007}Document'
             )
-            Document.text = document['document']
+            Document.text = document['document'].encoded
 
         self.response_body = RetrieveDocumentSetResponse
 
@@ -1,15 +1,13 @@
-import boto3
 import os
 import uuid
 from collections import OrderedDict
 from datetime import datetime, timezone
 
 from lxml import etree
-from zeep import Client, Settings, xsd
-from zeep.exceptions import Fault
-from zeep.transports import Transport
 
+import query_catalog
 import utils
+import xpaths
 
 ENV = os.environ.get("ENV")
 
@@ -29,18 +27,15 @@ class ITI55Responder:
         else:
             self.request = request
             root = self.request
-            self.initiator_url = root.find(
-                './/{*}ReplyTo/{*}Address').text if root.find('.//{*}ReplyTo/{*}Address') else None
+            self.initiator_url = xpaths.first_string(xpaths.REPLY_TO_ADDRESS(root))
             # extension and root of query id
-            self.query_id_element = root.find(
-                './/{*}PRPA_IN201305UV02/{*}controlActProcess/{*}queryByParameter/{*}queryId')
-            self.query_by_parameter_element = root.find(
-                './/{*}PRPA_IN201305UV02/{*}controlActProcess/{*}queryByParameter')  # the query we need to regurgitate
-            self.receiver_hcid = root.find(
-                './/{*}PRPA_IN201305UV02/{*}sender/{*}device/{*}id').get("root")  # the receiver's hcid
+            self.query_id_element = xpaths.first(xpaths.QUERY_ID(root))
+            # the query we need to regurgitate
+            self.query_by_parameter_element = xpaths.first(xpaths.QUERY_BY_PARAMETER(root))
+            self.receiver_hcid = xpaths.first_string(xpaths.SENDER_DEVICE_ID_ROOT(root))  # the receiver's hcid
 
             # check that it's to us
-            to_element = root.find('.//*/{*}To').text
+            to_element = xpaths.first_string(xpaths.TO(root))
             if to_element not in self.possible_urls:
                 raise Exception(f"request is not to us, it's to {to_element}")
 
@@ -53,38 +48,17 @@ class ITI55Responder:
         extract demographic parameters from the request (https://profiles.ihe.net/ITI/TF/Volume2/ITI-55.html 3.55.4.1.2.1)
         returns demographic parameters as a dictionary
         '''
-        root = self.request.find(".//PRPA_IN201305UV02")
-
-        # Define the namespace used in the XML
-        ns = {'hl7': 'urn:hl7-org:v3'}
         root = self.request
 
         # NEED TO HANDEL EACH CASE IF ISNT ABLE TO EXTRACT
-        # keys are parameter names, values are parameter xpaths and extraction types
-        params = {
-            'given': ('.//{*}livingSubjectName/{*}value/{*}given', 'text'),
-            'family': ('.//{*}livingSubjectName/{*}value/{*}family', 'text'),
-            'gender': ('.//{*}livingSubjectAdministrativeGender/{*}value', 'get("code")'),
-            'birthtime': ('.//{*}livingSubjectBirthTime/{*}value', 'get("value")'),
-            'city': ('.//{*}patientAddress/{*}value/{*}city', 'text'),
-            'state': ('.//{*}patientAddress/{*}value/{*}state', 'text'),
-            'line': ('.//{*}patientAddress/{*}value/{*}streetAddressLine', 'text'),
-            'country': ('.//{*}patientAddress/{*}value/{*}country', 'text'),
-            'postal_code': ('.//{*}patientAddress/{*}value/{*}postalCode', 'text'),
-            'mmname': ('.//{*}mothersMaidenName/{*}value/{*}family', 'text'),
-            'patient_telecom': ('.//{*}patientTelecom/{*}value', 'get("value")'),
-            'telecom_use': ('.//{*}patientTelecom/{*}value', 'get("use")'),
-            'pcp_id_root': ('.//{*}principalCareProviderId/{*}value', 'get("root")'),
-            'pcp_id_extension': ('.//{*}principalCareProviderId/{*}value', 'get("extension")'),
-        }
-        # create a dictionary to extract parameters. key: parameter name, value: path
+        # parameter name -> compiled xpath, see xpaths.XCPD_PARAMETERS
         extracted_parameters = {}
-        for key, value in params.items():
-            children = root.find(value[0])
-            if children is None:
+        for key, xpath in xpaths.XCPD_PARAMETERS.items():
+            value = xpaths.first_string(xpath(root))
+            if value is None:
                 continue
 
-            extracted_parameters[key] = eval("children."+value[1])
+            extracted_parameters[key] = value
             if key == 'gender':
                 extracted_parameters[key] = utils.gender_ambiguous_formatting(
                     extracted_parameters[key])
@@ -241,39 +215,17 @@ class ITI55Responder:
         if multiple results are found, the dictionary should have multiple entries
         '''
 
-        field_to_query = {
-            'given': '''resource->'name' @> '[{"given": ["STR_REPLACEMENT_SITE"]}]\'''',
-            'family': '''resource->'name' @> '[{"family": "STR_REPLACEMENT_SITE"}]\'''',
-            'birthtime': '''resource->'birthDate' @> '"STR_REPLACEMENT_SITE"\'''',
-            'gender': '''resource->'gender' @> '"STR_REPLACEMENT_SITE"\'''',
-            'city': '''resource->'address' @> '[{"city": "STR_REPLACEMENT_SITE"}]\'''',
-            'state': '''resource->'address' @> '[{"state": "STR_REPLACEMENT_SITE"}]\'''',
-            'line': '''resource->'address' @> '[{"line": ["STR_REPLACEMENT_SITE"]}]\'''',
-            'country': '''resource->'address' @> '[{"country": "STR_REPLACEMENT_SITE"}]\'''',
-            'postal_code': '''resource->'address' @> '[{"postalCode": ["STR_REPLACEMENT_SITE"]}]\'''',
-            'mmname': '''resource->'extension' @> '[{"url": "http://hl7.org/fhir/StructureDefinition/patient-mothersMaidenName", "valueString": "STR_REPLACEMENT_SITE"}]\'''',
-            'patient_telecom': '''resource->'telecom' @> '[{"value": "STR_REPLACEMENT_SITE"}]\'''',
-            'telecom_use': '''resource->'telecom' @> '[{"use": "STR_REPLACEMENT_SITE"}]\'''',
-            'pcp_id_root': '''resource->'pcpid' @> '[{"root": "STR_REPLACEMENT_SITE"}]\'''',
-            'pcp_id_extension': '''resource->'pcpid' @> '[{"extension": "STR_REPLACEMENT_SITE"}]\'''',
-        }
-
         parameters = self.extracted_parameters
         print("extracted parameters", parameters)
 
         list_of_sets_of_ids = []
-        placeholder = "STR_REPLACEMENT_SITE"
 
-        for field in field_to_query:
-            if field not in parameters or not parameters[field]:  
+        for field in query_catalog.PATIENT_FIELD_QUERIES:
+            if field not in parameters or not parameters[field]:
                 continue
-            sql_where_value = field_to_query[field].replace(
-                placeholder, parameters[field])  # NEED TO GRAB THE ID
-
-            # construct query
-            query = f"SELECT id FROM Patient WHERE {sql_where_value}"
-            # execute query
-            self.cur.execute(query)
+            # prepared per connection; the value is bound as a jsonb parameter, never spliced into the sql
+            query_catalog.execute(self.cur, 'patient_ids_by_' + field,
+                                  (query_catalog.patient_field_argument(field, parameters[field]),))
             ids = set(self.cur.fetchall())
             # append id's
             list_of_sets_of_ids.append(ids)
@@ -285,11 +237,14 @@ class ITI55Responder:
 
         patients_dict = {}  # key: id, values : info about patient
 
+        resources = {}
+        if final_ids:
+            query_catalog.execute(self.cur, 'patient_resources_by_ids', (final_ids,))
+            resources = dict(self.cur.fetchall())
+
         for id in final_ids:
             known_facts = {}
-            query = f"SELECT resource FROM Patient WHERE id = '{id}'"
-            self.cur.execute(query)
-            resource = self.cur.fetchone()[0]
+            resource = resources[id]
             known_facts['given'] = self.get_given_name_from_resource(resource)
             known_facts['family'] = self.get_family_name_from_resource(resource)
             known_facts['gender'] = self.get_gender_from_resource(resource)
@@ -1,40 +1,35 @@
 import asyncio
 import base64
-import boto3
+import io
 import json
 import os
+import time
 import traceback
 import uuid
 
-import psycopg2
-import requests
-from chained import *
-from iti38initiator import ITI38Initiator
-from iti38responder import ITI38Responder
-from iti39initiator import ITI39Initiator
-from iti39responder import ITI39Responder
-from iti55initiator import ITI55Initiator
-from iti55responder import ITI55Responder
+import mtom
+import startup_profile
 from lxml import etree
 
 import utils
+import xpaths
+from runtime import get_runtime
+
+# everything else is imported by the path that needs it: a responder hit never loads the initiator stack
+# (zeep, saml2, signxml, aiohttp) and an initiator run never loads the responder templates
+load = startup_profile.load
 
 ENV = os.environ.get("ENV")
-secretsmanager = boto3.client('secretsmanager')
 secret_id = ""
 secret_params = {}
 
 STU3_DIRECTORY_LAMBDA = ""
+# regional searches narrow the radius until they're down to this many endpoints
+REGIONAL_RESPONDER_TARGET = 80
+# a CQSearch can handle at most 200 at a time
+REGIONAL_RESPONDER_LIMIT = 200
 
-def get_db_connection(database=''):
-    return psycopg2.connect(
-        host='', port=,
-        user=secret_params['db_username'],
-        password=secret_params['db_password'],
-        database=database)
-
-
-def get_endpoints_with_zips(zip_codes, state, radius=10, country="US", exclude=[]):
+def fetch_endpoints_with_zips(zip_codes, state, radius=10, country="US", exclude=[]):
     '''
     calls stu3 directory to get active endpoints within radius of zip code
     '''
@@ -48,11 +43,11 @@ def get_endpoints_with_zips(zip_codes, state, radius=10, country="US", exclude=[
             "exclude": exclude
         }
     })
-    response = requests.post(STU3_DIRECTORY_LAMBDA, data=body, verify=False)
+    response = load('requests').post(STU3_DIRECTORY_LAMBDA, data=body, verify=False)
     return json.loads(response.text)
 
 
-def get_national_endpoints():
+def fetch_national_endpoints():
     '''
     calls stu3 directory to get a manually created national endpoints list
     '''
@@ -60,10 +55,48 @@ def get_national_endpoints():
         "action": "getNationalEndpoints",
         "params": {}
     })
-    response = requests.post(STU3_DIRECTORY_LAMBDA, data=body, verify=False)
+    response = load('requests').post(STU3_DIRECTORY_LAMBDA, data=body, verify=False)
     return json.loads(response.text)
 
 
+def get_endpoints_with_zips(zip_codes, state, radius=10, country="US", exclude=[]):
+    '''
+    active endpoints within radius of zip code, through the directory cache. the directory changes at most daily
+    '''
+    directory_cache = load('directory_cache')
+    endpoints = directory_cache.get_directory_cache().get(
+        directory_cache.zips_key(zip_codes, state, radius, country),
+        lambda: fetch_endpoints_with_zips(zip_codes, state, radius=radius, country=country))
+    return directory_cache.without_excluded(endpoints, exclude)
+
+
+def get_regional_endpoints(zip_codes, state, country, exclude=[]):
+    '''
+    narrows the radius until there are at most REGIONAL_RESPONDER_TARGET endpoints (or we're at the smallest radius).
+    exclude (endpoint names) is applied on every pass, those gateways are already covered by another search
+    '''
+    radius_priority_list = [10, 30, 100]
+
+    responders = get_endpoints_with_zips(
+        zip_codes, state, radius=radius_priority_list.pop(), country=country, exclude=exclude)
+    while len(responders) > REGIONAL_RESPONDER_TARGET and len(radius_priority_list) > 0:
+        radius = radius_priority_list.pop()
+        responders = get_endpoints_with_zips(zip_codes,
+                                             state,
+                                             radius=radius,
+                                             country=country,
+                                             exclude=exclude)
+    return responders
+
+
+def get_national_endpoints():
+    '''
+    the national endpoints list, through the directory cache
+    '''
+    directory_cache = load('directory_cache')
+    return directory_cache.get_directory_cache().get(directory_cache.national_key(), fetch_national_endpoints)
+
+
 def make_and_initiate_request(endpoint_type, destination_url, destination_oid, params):
     '''
     makes an endpoint to make first contact with someone else with the params we're curious about
@@ -71,16 +104,16 @@ def make_and_initiate_request(endpoint_type, destination_url, destination_oid, p
     '''
     test_user_qualification = {}
     if endpoint_type == '/iti55initiator/p':
-        initiator = ITI55Initiator(None, None, params, destination_url,
+        initiator = load('iti55initiator').ITI55Initiator(None, None, params, destination_url,
                                    destination_oid, test_user_qualification)
     elif endpoint_type == '/iti38initiator/p':
-        initiator = ITI38Initiator(None, None, params, destination_url,
+        initiator = load('iti38initiator').ITI38Initiator(None, None, params, destination_url,
                                    destination_oid, test_user_qualification)
     elif endpoint_type == '/iti39initiator/p':
-        initiator = ITI39Initiator(None, None, params, destination_url,
+        initiator = load('iti39initiator').ITI39Initiator(None, None, params, destination_url,
                                    destination_oid, test_user_qualification)
 
-    response = asyncio.run(initiator.send_request())
+    response = get_runtime().run(initiator.send_request())
     return response
 
 
@@ -95,20 +128,20 @@ def make_and_react_to_xml(endpoint_type, xml_message, cur):
 
     elif endpoint_type == "/iti55responder":
         print("iti55responder pinged")
-        responder = ITI55Responder(cur, xml_message)
+        responder = load('iti55responder').ITI55Responder(cur, xml_message)
         # body as an element without being wrapped in <Body> tags
         response_unwrapped_body = responder.generate_response_body()
         return response_unwrapped_body
 
     elif endpoint_type == "/iti38responder":
         print("iti38responder pinged")
-        responder = ITI38Responder(cur, xml_message)
+        responder = load('iti38responder').ITI38Responder(cur, xml_message)
         response_unwrapped_body = responder.generate_response_body()
         return response_unwrapped_body
 
     elif endpoint_type == "/iti39responder":
         print("iti39responder pinged")
-        responder = ITI39Responder(cur, xml_message)
+        responder = load('iti39responder').ITI39Responder(cur, xml_message)
         response_unwrapped_body = responder.generate_response_body()
         return response_unwrapped_body
 
@@ -166,20 +199,38 @@ def create_envelope_with_only_header(relates_to, action=''):
     return soap_env
 
 
+def stream_envelope(envelope, write_body):
+    '''
+    Serializes an envelope from create_envelope_with_only_header without building a tree for the Body.
+    write_body(xf) writes the contents of the Body into the etree.xmlfile. the result is still one bytes object,
+    since the lambda response is, so write_body has to keep the body to a size that fits
+    '''
+    buffer = io.BytesIO()
+    with etree.xmlfile(buffer, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element(envelope.tag, nsmap=envelope.nsmap):
+            for child in envelope:
+                xf.write(child)
+            with xf.element('{{{}}}Body'.format(envelope.nsmap['s'])):
+                write_body(xf)
+    return buffer.getvalue()
+
+
 def get_relates_to(request):
     '''
     returns the relates_to text for the response
     '''
-    relates_to = request.find('.//{*}MessageID')
-    if relates_to is not None:
-        return relates_to.text
-    else:
-        return None
+    return xpaths.first_string(xpaths.MESSAGE_ID(request))
 
 
 
 def responder_workflow(event, https_response):
-    db_connection = get_db_connection()
+    # responders only read, so they can be served from the replica when there is one
+    with load('db').connection_manager.connection(read_only=True) as db_connection:
+        return respond_with_connection(event, https_response, db_connection)
+
+
+def respond_with_connection(event, https_response, db_connection):
     cur = db_connection.cursor()
 
     xml_message = event['body']
@@ -189,26 +240,37 @@ def responder_workflow(event, https_response):
         xml_message = base64.b64decode(xml_message)
 
     endpoint_type = event['path']
-    try:
-        tree = etree.fromstring(xml_message)
-    except:
-        envelope = utils.extract_envelope_content(xml_message)
-        tree = etree.fromstring(envelope)
-    unwrapped_body = make_and_react_to_xml(endpoint_type, tree, cur)
+    tree = utils.parse_envelope(xml_message)
+    if tree is None:
+        raise Exception("no soap envelope in request")
 
     relates_to = get_relates_to(tree)  # should be None if we are initiator
     action = action_selector(endpoint_type)
 
     envelope = create_envelope_with_only_header(relates_to, action)
-    body = etree.SubElement(envelope, '{{{}}}Body'.format(envelope.nsmap['s']))
-    body.append(unwrapped_body)
+    if endpoint_type == "/iti39responder":
+        # documents can be several MB each; serialize them into the response as they come out of the db
+        print("iti39responder pinged")
+        responder = load('iti39responder').ITI39Responder(cur, tree)
+        # requesters that speak MTOM get documents as binary attachments instead of base64
+        attachments = [] if mtom.requester_accepts_mtom(event.get('headers')) else None
+        endpoint_response = stream_envelope(
+            envelope, lambda xf: responder.write_response_body(xf, attachments))
+        if attachments is not None:
+            endpoint_response, content_type = mtom.build_multipart_related(
+                endpoint_response, attachments)
+            https_response['headers'] = {'Content-Type': content_type}
+            https_response['isBase64Encoded'] = True
+            endpoint_response = base64.b64encode(endpoint_response).decode('ascii')
+    else:
+        unwrapped_body = make_and_react_to_xml(endpoint_type, tree, cur)
+        body = etree.SubElement(envelope, '{{{}}}Body'.format(envelope.nsmap['s']))
+        body.append(unwrapped_body)
 
-    endpoint_response = etree.tostring(envelope, pretty_print=True, encoding="UTF-8")
+        endpoint_response = etree.tostring(envelope, pretty_print=True, encoding="UTF-8")
 
     https_response['body'] = endpoint_response
     print("want to return the following http_response,", https_response)
-    db_connection.commit()
-    db_connection.close()
 
     return https_response
 
@@ -221,13 +283,40 @@ def manual_initiator_workflow(event, https_response):
     destination_oid = request_info['destination_oid']
     params = request_info['params']
 
-    response_str = make_and_initiate_request(
+    response = make_and_initiate_request(
         endpoint_type, destination_url, destination_oid, params)
-    https_response['body'] = response_str
+    # initiators hand back raw bytes; only decode here, where the lambda response needs a str
+    if isinstance(response, bytes):
+        try:
+            response = response.decode('utf-8')
+        except UnicodeDecodeError:
+            response = base64.b64encode(response).decode('ascii')
+            https_response['isBase64Encoded'] = True
+    https_response['body'] = response
     return https_response
 
 
+def remaining_seconds(context):
+    '''
+    time left in this invocation; 0 when there's no lambda context to ask
+    '''
+    try:
+        return context.get_remaining_time_in_millis() / 1000
+    except AttributeError:
+        return 0
+
+
 def lambda_handler(event, context):
+    # the loop, http pool, db pool and caches live on the runtime and carry over between warm invocations
+    get_runtime().begin_invocation()
+    try:
+        return handle_event(event, context)
+    finally:
+        # first invocation in a container only: what the cold start cost, and which path paid for it
+        startup_profile.report_once(event.get('path'))
+
+
+def handle_event(event, context):
     https_response = {
         "statusCode": 200,
         'statusDescription': '200 OK',
@@ -253,10 +342,13 @@ def lambda_handler(event, context):
         print("this should be a json event body", event['body'])
 
         if "action" in event['body'] and event['body']["action"] == "getCarequalityPatient":
+            # each CQSearch borrows a pooled connection; whatever happens, they all go back
+            searches = []
             try:
                 print("getCarequalityPatient")
                 connection_id = event['body']['connection_id']
-                non_metadata_keys = set(["token", "location_search_zip", "location_search_state"])
+                non_metadata_keys = set(["token", "location_search_zip", "location_search_state", "force_refresh",
+                                         "doc_filter"])
                 patient_metadata = {
                     key: value for key, value in event['body']['params'].items()
                     if key not in non_metadata_keys
@@ -264,23 +356,10 @@ def lambda_handler(event, context):
                 
                 user_qualifications = {}
                 user_id = user_qualifications['user_id']
-
-                # national umbrella search with stu3 lambda
-                national_endpoints = get_national_endpoints()
-                national_search = CQSearch(responders=national_endpoints,
-                                           patient_metadata=patient_metadata,
-                                           user_qualifications=user_qualifications,
-                                           national=True)
-                national_search.collect_all_possible_patients()
-                # patient past zips according to the national endpoints
-                past_zips = national_search.conflict_checker()
-
-                # zip-based location search 
-                # recent change: location_search_zip is becoming a NON-EMPTY list
-                zip_codes = list(set(event['body']['params']['location_search_zip'] + past_zips))
-                print("zips after national search", zip_codes)
-
-                iti55_found_pipelines_national = national_search.pipelines_with_patient_found()
+                # force_refresh asks every gateway again, ignoring the patient locator and its negative cache
+                refresh = bool(event['body']['params'].get('force_refresh', False))
+                # optional {"type_codes", "class_codes", "format_codes", "created_from", "created_to", "max_size"}
+                doc_filter = load('document_filter').DocumentFilter.from_params(event['body']['params'].get('doc_filter'))
 
                 # continue. these 2 params are not used for now
                 state = event['body']['params']['location_search_state'] if 'location_search_state' in event['body'][
@@ -288,28 +367,53 @@ def lambda_handler(event, context):
                 country = event['body']['params']['country'] if 'country' in event['body'][
                     'params'] else "US"
 
-                radius_priority_list = [10, 30, 100]
-
-                responders = get_endpoints_with_zips(
-                    zip_codes, state, radius=radius_priority_list.pop(), country=country)
-                while len(responders) > 80 and len(radius_priority_list) > 0:
-                    radius = radius_priority_list.pop()
-                    responders = get_endpoints_with_zips(zip_codes,
-                                                         state,
-                                                         radius=radius,
-                                                         country=country,
-                                                         exclude=iti55_found_pipelines_national)
+                # national umbrella search with stu3 lambda
+                national_endpoints = get_national_endpoints()
+                CQSearch = load('chained').CQSearch
+                national_search = CQSearch(responders=national_endpoints,
+                                           patient_metadata=patient_metadata,
+                                           user_qualifications=user_qualifications,
+                                           national=True,
+                                           refresh=refresh,
+                                           doc_filter=doc_filter)
+                searches.append(national_search)
 
+                # zip-based location search for the zips we were given, started alongside the national search
+                # recent change: location_search_zip is becoming a NON-EMPTY list
+                supplied_zips = list(set(event['body']['params']['location_search_zip']))
+                responders = get_regional_endpoints(supplied_zips, state, country,
+                                                    exclude=national_search.responder_names())
                 print("got " + str(len(responders)) + " responders, starting with", responders[:5])
+                radius_search = CQSearch(responders=responders[:REGIONAL_RESPONDER_LIMIT],
+                                         patient_metadata=patient_metadata,
+                                         user_qualifications=user_qualifications,
+                                         refresh=refresh,
+                                         doc_filter=doc_filter)
+                searches.append(radius_search)
+
+                # ITI 55 national and regional in one round
+                get_runtime().run(asyncio.gather(national_search.collect_possible_patients(),
+                                                 radius_search.collect_possible_patients()))
+                # patient past zips according to the national endpoints
+                past_zips = national_search.conflict_checker()
+                iti55_found_pipelines_national = national_search.pipelines_with_patient_found()
 
-                radius_search = CQSearch(responders=responders[:200],
-                                         patient_metadata=patient_metadata,  # can handle at most 200 at a time
-                                         user_qualifications=user_qualifications)
+                # only zips the national search uncovered need another directory lookup and another 55 round
+                new_zips = list(set(past_zips) - set(supplied_zips))
+                print("new zips after national search", new_zips)
+                room = REGIONAL_RESPONDER_LIMIT - len(radius_search.pipelines)
+                if new_zips and room > 0:
+                    extra_responders = get_regional_endpoints(
+                        new_zips, state, country,
+                        exclude=national_search.responder_names() + radius_search.responder_names())
+                    added = radius_search.add_responders(extra_responders[:room])
+                    print("added " + str(len(added)) + " responders for new zips")
+                    if added:
+                        get_runtime().run(radius_search.collect_possible_patients(added))
 
-                # ITI 55 regional
-                radius_search.collect_all_possible_patients()
                 radius_search.conflict_checker()
                 iti55_found_pipelines_regional = radius_search.pipelines_with_patient_found()
+                print("patient negative cache,", load('patient_locator').stats())
                 iti55_return = iti55_found_pipelines_national + iti55_found_pipelines_regional
 
                 if len(iti55_return) == 0:  # early termination because no patients are found
@@ -325,20 +429,49 @@ def lambda_handler(event, context):
                     shared_pid = str(uuid.uuid4())
                     radius_search.internal_additions['pid'] = shared_pid
                     national_search.internal_additions['pid'] = shared_pid
+                    # one retrieval budget for both searches, counted from here. they run one after the other, so
+                    # the regional one gets its share (by pipelines) and the national one whatever is left after it
+                    retrieval_budget = load('retrieval_scheduler').RetrievalBudget()
+                    radius_search.retrieval_budget = retrieval_budget.share(
+                        len(iti55_found_pipelines_regional) / len(iti55_return))
+                    # and one deduplicator, so a document both searches find is kept once
+                    national_search.deduplicator = radius_search.deduplicator
 
 
                     # to avoid race condition, these have to be done in two steps;
                     # TODO: figure out how to merge 2 CQSearch Objects
                     # this will speed up document queries by 2x
                     regional_inserted_materials = radius_search.find_docs_for_conflict_free_patients()
+                    national_search.retrieval_budget = retrieval_budget.share(1)
                     national_inserted_materials = national_search.find_docs_for_conflict_free_patients()
 
+                    # documents the retrieval budget deferred get whatever time this invocation has left
+                    deadline = time.monotonic() + remaining_seconds(context) - load(
+                        'retrieval_scheduler').RETRIEVAL_CONTINUE_MARGIN
+                    for search in [radius_search, national_search]:
+                        search.retrieve_deferred(deadline - time.monotonic())
+
                     # search is done.
 
 
                 return https_response
             except Exception as e:
                 print(traceback.format_exc().replace('\n', '\r'))
+            finally:
+                for search in searches:
+                    try:
+                        search.finish_rediscovery()
+                    except Exception:
+                        print(traceback.format_exc().replace('\n', '\r'))
+                    search.release_connection()
+
+        # scheduled batch job that keeps the ITI-38 document registry in step with the fhir tables
+        elif "action" in event['body'] and event['body']["action"] == "refreshDocumentRegistry":
+            with load('db').connection_manager.connection() as db_connection:
+                written = load('document_registry').refresh_registry(db_connection.cursor())
+            https_response['headers'] = {'Content-Type': 'application/json'}
+            https_response['body'] = json.dumps(written)
+            return https_response
 
         # manual initiator workflow
         elif event['headers']['content-type'] == 'application/json':
@@ -0,0 +1,261 @@
+import os
+import uuid
+from copy import deepcopy
+
+from lxml import etree
+
+import xpaths
+
+# MESSAGE_VALIDATION=1 runs every built message through zeep against the wsdl before it goes out.
+# slow (the wsdl is loaded on first use), so it's for checking the builders, not for production traffic
+MESSAGE_VALIDATION = os.environ.get("MESSAGE_VALIDATION", "") == "1"
+
+SOAP_NS = xpaths.NAMESPACES['soap']
+WSA_NS = xpaths.NAMESPACES['wsa']
+HL7_NS = xpaths.NAMESPACES['hl7']
+QUERY_NS = xpaths.NAMESPACES['query']
+RIM_NS = xpaths.NAMESPACES['rim']
+XDS_NS = xpaths.NAMESPACES['xds']
+
+XCPD_ACTION = 'urn:hl7-org:v3:PRPA_IN201305UV02:CrossGatewayPatientDiscovery'
+XCA_QUERY_ACTION = 'urn:ihe:iti:2007:CrossGatewayQuery'
+XCA_RETRIEVE_ACTION = 'urn:ihe:iti:2007:CrossGatewayRetrieve'
+
+# stored query id for FindDocuments
+FIND_DOCUMENTS_QUERY_ID = "urn:uuid:" + ""
+APPROVED_STATUS = "('urn:oasis:names:tc:ebxml-regrep:StatusType:Approved')"
+
+# wsdl, binding and operation each message is checked against in validation mode
+ZEEP_OPERATIONS = {
+    XCPD_ACTION: ('wsdls/gazelle_ITI55_responder.wsdl',
+                  '{urn:ihe:iti:xcpd:2009}RespondingGateway_ServiceSoapBinding',
+                  'RespondingGateway_PRPA_IN201305UV02'),
+    XCA_QUERY_ACTION: ('wsdls/drive_ITI38_responder.wsdl',
+                       '{urn:ihe:iti:xds-b:2007}RespondingGatewayQuery_Binding_Soap12',
+                       'RespondingGateway_CrossGatewayQuery'),
+    XCA_RETRIEVE_ACTION: ('wsdls/drive_ITI39_responder.wsdl',
+                          '{urn:ihe:iti:xds-b:2007}RespondingGatewayRetrieve_Binding_Soap12',
+                          'RespondingGateway_CrossGatewayRetrieve'),
+}
+
+# blank text would end up in the signed header and shift the header[n] positions the signer relies on
+template_parser = etree.XMLParser(remove_blank_text=True)
+
+
+def parse_template(template):
+    return etree.fromstring(template.strip(), template_parser)
+
+
+# header order matters: once the security header goes in front it is [Security, Action, MessageID, To],
+# which is what Saml.sign_soap_message expects
+ENVELOPE_TEMPLATE = parse_template(f'''
+<soap-env:Envelope xmlns:soap-env="{SOAP_NS}">
+    <soap-env:Header>
+        <wsa:Action xmlns:wsa="{WSA_NS}"/>
+        <wsa:MessageID xmlns:wsa="{WSA_NS}"/>
+        <wsa:To xmlns:wsa="{WSA_NS}"/>
+    </soap-env:Header>
+    <soap-env:Body/>
+</soap-env:Envelope>
+''')
+
+XCPD_TEMPLATE = parse_template(f'''
+<PRPA_IN201305UV02 xmlns="{HL7_NS}" ITSVersion="XML_1.0">
+    <id extension="2211"/>
+    <creationTime/>
+    <interactionId extension="PRPA_IN201305UV02" root="2.16.840.1.113883.1.6"/>
+    <processingCode code="P"/>
+    <processingModeCode code="T"/>
+    <acceptAckCode code="AL"/>
+    <receiver typeCode="RCV">
+        <device classCode="DEV" determinerCode="INSTANCE">
+            <id/>
+            <asAgent classCode="AGNT">
+                <representedOrganization classCode="ORG" determinerCode="INSTANCE">
+                    <id/>
+                </representedOrganization>
+            </asAgent>
+        </device>
+    </receiver>
+    <sender typeCode="SND">
+        <device classCode="DEV" determinerCode="INSTANCE">
+            <id/>
+            <asAgent classCode="AGNT">
+                <representedOrganization classCode="ORG" determinerCode="INSTANCE">
+                    <id/>
+                </representedOrganization>
+            </asAgent>
+        </device>
+    </sender>
+    <controlActProcess classCode="CACT" moodCode="EVN">
+        <code code="PRPA_TE201305UV02" codeSystemName="2.16.840.1.113883.1.6"/>
+        <authorOrPerformer typeCode="AUT">
+            <assignedPerson classCode="ASSIGNED"/>
+        </authorOrPerformer>
+        <queryByParameter>
+            <queryId root="61023518-3f6e-4ad5-a465-87082e96b66f"/>
+            <statusCode code="new"/>
+            <responseModalityCode code="R"/>
+            <responsePriorityCode code="I"/>
+            <matchCriterionList/>
+            <parameterList/>
+        </queryByParameter>
+    </controlActProcess>
+</PRPA_IN201305UV02>
+''')
+
+XCA_QUERY_TEMPLATE = parse_template(f'''
+<query:AdhocQueryRequest xmlns:query="{QUERY_NS}" xmlns:rim="{RIM_NS}">
+    <query:ResponseOption returnComposedObjects="true"/>
+    <rim:AdhocQuery/>
+</query:AdhocQueryRequest>
+''')
+
+XCA_RETRIEVE_TEMPLATE = parse_template(f'''
+<xds:RetrieveDocumentSetRequest xmlns:xds="{XDS_NS}"/>
+''')
+
+
+def hl7(tag):
+    return '{%s}%s' % (HL7_NS, tag)
+
+
+def sub_element(parent, tag, text=None, **attrib):
+    # missing values leave the attribute out, the way zeep did
+    element = etree.SubElement(parent, tag, {key: value for key, value in attrib.items() if value is not None})
+    if text is not None:
+        element.text = text
+    return element
+
+
+def build_envelope(action, to_url, body, security_header=None):
+    '''
+    soap 1.2 envelope with ws-addressing headers around body, as an element for the signer
+    '''
+    envelope = deepcopy(ENVELOPE_TEMPLATE)
+    header = envelope[0]
+    header[0].text = action
+    header[1].text = "urn:uuid:" + str(uuid.uuid4())
+    header[2].text = to_url
+    if security_header is not None:
+        header.insert(0, security_header)
+    envelope[1].append(body)
+    if MESSAGE_VALIDATION:
+        validate_with_zeep(action, envelope)
+    return envelope
+
+
+def add_parameter(parameter_list, name, semantics_text, values):
+    '''
+    values is a list of (attributes, [(child tag, text)]) for each <value>
+    '''
+    parameter = sub_element(parameter_list, hl7(name))
+    for attributes, children in values:
+        value = sub_element(parameter, hl7('value'), **attributes)
+        for tag, text in children:
+            sub_element(value, hl7(tag), text)
+    sub_element(parameter, hl7('semanticsText'), semantics_text)
+    return parameter
+
+
+def build_xcpd_request(params, receiver_hcid, sender_hcid, org_hcid, creation_time, national=False):
+    '''
+    PRPA_IN201305UV02 body from the demographics in params (PatientMetadata.get_dict_for_iti55)
+    '''
+    request = deepcopy(XCPD_TEMPLATE)
+    request.find(hl7('id')).set('root', str(uuid.uuid4()))
+    request.find(hl7('creationTime')).set('value', creation_time)
+    for party, device_hcid, organization_hcid in [('receiver', receiver_hcid, receiver_hcid),
+                                                  ('sender', sender_hcid, org_hcid)]:
+        device = request.find(hl7(party)).find(hl7('device'))
+        device.find(hl7('id')).set('root', device_hcid)
+        device.find('%s/%s/%s' % (hl7('asAgent'), hl7('representedOrganization'), hl7('id'))).set(
+            'root', organization_hcid)
+
+    parameter_list = request.find('%s/%s/%s' % (
+        hl7('controlActProcess'), hl7('queryByParameter'), hl7('parameterList')))
+    # children of parameterList have a schema order
+    add_parameter(parameter_list, 'livingSubjectAdministrativeGender', 'LivingSubject.AdministrativeGender',
+                  [({'code': params['gender']}, [])])
+    add_parameter(parameter_list, 'livingSubjectBirthTime', 'LivingSubject.birthTime',
+                  [({'value': params['date_of_birth']}, [])])
+    add_parameter(parameter_list, 'livingSubjectName', 'LivingSubject.name',
+                  [({}, [('family', params['patient_family_name']), ('given', params['patient_given_name'])])])
+
+    if not national:
+        address_parts = [(tag, params.get(key)) for tag, key in [
+            ('streetAddressLine', 'patient_address_street'),
+            ('city', 'patient_address_city'),
+            ('state', 'patient_address_state'),
+            ('postalCode', 'patient_address_postal_code'),
+            ('country', 'patient_address_country')] if params.get(key) is not None]
+        if address_parts:
+            add_parameter(parameter_list, 'patientAddress', 'Patient.addr', [({}, address_parts)])
+
+    telecoms = []
+    if params.get('patient_phone') is not None:
+        formatted_phone = params['patient_phone']
+        if len(formatted_phone) == 10:
+            formatted_phone = formatted_phone[:3] + "-" + formatted_phone[3:6] + "-" + formatted_phone[6:]
+        telecoms.append(({'value': "tel:+1-" + formatted_phone, 'use': "HP"}, []))
+    if params.get('patient_email') is not None:
+        telecoms.append(({'value': "mailto:" + params['patient_email'], 'use': "H"}, []))
+    if telecoms:
+        add_parameter(parameter_list, 'patientTelecom', 'Patient.telecom', telecoms)
+    return request
+
+
+def build_xca_query_request(pids, receiver_hcid, return_type="LeafClass", extra_slots=None):
+    '''
+    AdhocQueryRequest body for FindDocuments on pids, a list of (patient_root, patient_extension).
+    extra_slots is a list of (slot name, [values]) added after the patient id and status slots
+    '''
+    request = deepcopy(XCA_QUERY_TEMPLATE)
+    request[0].set('returnType', return_type)
+    adhoc_query = request[1]
+    adhoc_query.set('id', FIND_DOCUMENTS_QUERY_ID)
+    adhoc_query.set('home', "urn:oid:" + receiver_hcid)
+    slots = [("$XDSDocumentEntryPatientId", ["'" + pid[1] + "^^^&" + pid[0] + "&ISO'" for pid in pids]),
+             ("$XDSDocumentEntryStatus", [APPROVED_STATUS])]
+    for name, values in slots + (extra_slots or []):
+        slot = sub_element(adhoc_query, '{%s}Slot' % RIM_NS, name=name)
+        value_list = sub_element(slot, '{%s}ValueList' % RIM_NS)
+        for value in values:
+            sub_element(value_list, '{%s}Value' % RIM_NS, value)
+    return request
+
+
+def build_xca_retrieve_request(document_requests):
+    '''
+    RetrieveDocumentSetRequest body. document_requests is a list of (home community id, repository id, document id)
+    '''
+    request = deepcopy(XCA_RETRIEVE_TEMPLATE)
+    for hcid, repository_id, document_id in document_requests:
+        document_request = sub_element(request, '{%s}DocumentRequest' % XDS_NS)
+        sub_element(document_request, '{%s}HomeCommunityId' % XDS_NS, "urn:oid:" + hcid)
+        sub_element(document_request, '{%s}RepositoryUniqueId' % XDS_NS, repository_id)
+        sub_element(document_request, '{%s}DocumentUniqueId' % XDS_NS, document_id)
+    return request
+
+
+# wsdl path -> zeep client, only ever filled in validation mode
+zeep_clients = {}
+
+
+def get_zeep_client(wsdl):
+    if wsdl not in zeep_clients:
+        from zeep import Client, Settings
+        zeep_clients[wsdl] = Client(wsdl, settings=Settings(strict=True, force_https=True))
+    return zeep_clients[wsdl]
+
+
+def validate_with_zeep(action, envelope):
+    '''
+    deserializes the envelope with the operation's input message, which fails on anything the schema doesn't allow
+    '''
+    wsdl, binding_name, operation_name = ZEEP_OPERATIONS[action]
+    try:
+        operation = get_zeep_client(wsdl).wsdl.bindings[binding_name].get(operation_name)
+        operation.input.deserialize(envelope)
+    except Exception as e:
+        print(f"{operation_name} message failed zeep validation,", repr(e))
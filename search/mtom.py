@@ -0,0 +1,84 @@
+import base64
+import binascii
+import uuid
+from urllib.parse import unquote
+
+from lxml import etree
+
+XOP_NS = 'http://www.w3.org/2004/08/xop/include'
+XDS_NS = 'urn:ihe:iti:xds-b:2007'
+
+
+def is_multipart(content_type):
+    return content_type is not None and 'multipart/related' in content_type.lower()
+
+
+def requester_accepts_mtom(headers):
+    '''
+    a requester that sent MTOM, or says it accepts multipart/related, gets MTOM back
+    '''
+    headers = {key.lower(): value for key, value in (headers or {}).items()}
+    return is_multipart(headers.get('content-type')) or is_multipart(headers.get('accept'))
+
+
+def strip_content_id(content_id):
+    content_id = content_id.strip()
+    if content_id.startswith('<') and content_id.endswith('>'):
+        content_id = content_id[1:-1]
+    return content_id
+
+
+def decode_document_element(document_element, attachments):
+    '''
+    the contents of an ITI-39 <Document> as bytes, whether it's an xop:Include, base64 text,
+    or (from a few gateways) the xml inline
+    '''
+    include = document_element.find('{%s}Include' % XOP_NS)
+    if include is not None:
+        href = include.get('href', '')
+        if href.startswith('cid:'):
+            href = href[4:]
+        return attachments.get(unquote(href))
+
+    if len(document_element):
+        return etree.tostring(document_element[0])
+
+    text = (document_element.text or '').strip()
+    if text.startswith('<'):
+        return text.encode('utf-8')
+    try:
+        return base64.b64decode(text)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def new_content_id():
+    return uuid.uuid4().hex + "@abstractivehealth.com"
+
+
+def build_multipart_related(root_xml, attachments):
+    '''
+    packs a serialized SOAP envelope (with xop:Include references) and its attachments into an
+    MTOM message. attachments is a list of (content id, bytes).
+    returns (body bytes, content type header value)
+    '''
+    boundary = "MIMEBoundary_" + uuid.uuid4().hex
+    root_cid = new_content_id()
+    content_type = (
+        f'multipart/related; boundary="{boundary}"; type="application/xop+xml"; '
+        f'start="<{root_cid}>"; start-info="application/soap+xml"')
+
+    body = bytearray()
+    body += (f'--{boundary}\r\n'
+             f'Content-Type: application/xop+xml; charset=UTF-8; type="application/soap+xml"\r\n'
+             f'Content-Transfer-Encoding: binary\r\n'
+             f'Content-ID: <{root_cid}>\r\n\r\n').encode('ascii')
+    body += root_xml
+    for content_id, data in attachments:
+        body += (f'\r\n--{boundary}\r\n'
+                 f'Content-Type: application/octet-stream\r\n'
+                 f'Content-Transfer-Encoding: binary\r\n'
+                 f'Content-ID: <{content_id}>\r\n\r\n').encode('ascii')
+        body += data
+    body += f'\r\n--{boundary}--\r\n'.encode('ascii')
+    return bytes(body), content_type
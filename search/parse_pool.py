@@ -0,0 +1,107 @@
+import asyncio
+import functools
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import xpaths
+from utils import parse_envelope
+
+# lxml releases the GIL while it parses, so threads get real parallelism without pickling payloads to processes
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", 4))
+# parses allowed in flight at once; the rest wait their turn instead of piling up payloads in the executor queue
+PARSE_CONCURRENCY = int(os.environ.get("PARSE_CONCURRENCY", PARSE_WORKERS * 2))
+# PARSE_INLINE=1 parses on the calling coroutine, for tests and local debugging
+PARSE_INLINE = os.environ.get("PARSE_INLINE", "") == "1"
+
+
+def parse_xcpd_response(payload):
+    '''
+    ITI-55 response -> ("NF", None) / ("Multiple", None) / ("found", ((root, extension), patient metadata dict))
+    / ("Error", None). NF and Multiple are the gateway's answer about the patient; Error is everything that isn't
+    an answer (no parseable envelope, a SOAP Fault, queryResponseCode AE or QE, an OK with nobody in it).
+    only plain python comes back, the tree stays on the parsing thread
+    '''
+    response_tree = parse_envelope(payload)
+    if response_tree is None:
+        return "Error", None
+    if xpaths.SOAP_FAULT(response_tree):
+        return "Error", None
+
+    # queryResponseCode "OK" means at least one patient found, "NF" that there's no such patient
+    query_response_code = xpaths.first_string(xpaths.QUERY_RESPONSE_CODE(response_tree))
+    if query_response_code == 'NF':
+        return "NF", None
+    if query_response_code != 'OK':
+        return "Error", None
+
+    # if one registrationEvent, we have one patient
+    # if multiple registrationEvents, we have multiple patients all fitting
+    registration_events = xpaths.REGISTRATION_EVENTS(response_tree)
+    if len(registration_events) == 0:
+        return "Error", None
+    elif len(registration_events) == 1:
+        return "found", xpaths.extract_patient(registration_events[0])
+    else:
+        return "Multiple", None
+
+
+def parse_xca_query_response(payload, default_hcid):
+    '''
+    ITI-38 response -> list of document entry dicts (see xpaths.extract_document_entry), [] if unparseable
+    '''
+    response_tree = parse_envelope(payload)
+    if response_tree is None:
+        return []
+    return xpaths.extract_document_entries(response_tree, default_hcid)
+
+
+class ParseStage:
+    '''
+    runs response parsing off the event loop, so a multi MB payload doesn't stall every other connection in flight
+    '''
+
+    def __init__(self, workers=PARSE_WORKERS, concurrency=PARSE_CONCURRENCY, inline=PARSE_INLINE):
+        self.workers = workers
+        self.concurrency = concurrency
+        self.inline = inline
+        self.executor = None
+        # asyncio primitives belong to one loop; the runtime keeps one, but nothing stops a caller using asyncio.run.
+        # keyed by the loop itself, since the id of a collected loop gets reused by the next one
+        self.semaphores = weakref.WeakKeyDictionary()  # loop -> semaphore
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='parse')
+        return self.executor
+
+    def semaphore_for(self, loop):
+        semaphore = self.semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    async def run(self, function, *args):
+        if self.inline:
+            return function(*args)
+        loop = asyncio.get_running_loop()
+        async with self.semaphore_for(loop):
+            return await loop.run_in_executor(self.get_executor(), functools.partial(function, *args))
+
+    async def xcpd_response(self, payload):
+        return await self.run(parse_xcpd_response, payload)
+
+    async def xca_query_response(self, payload, default_hcid):
+        return await self.run(parse_xca_query_response, payload, default_hcid)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+parse_stage = ParseStage()
+
+
+def get_parse_stage():
+    return parse_stage
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import re
+
+ENV = os.environ.get("ENV")
+
+# a gateway that matched the patient within this many seconds is trusted without another ITI-55. 0 turns the locator off
+PATIENT_LOCATOR_FRESHNESS = int(os.environ.get("PATIENT_LOCATOR_FRESHNESS", 7 * 24 * 60 * 60))
+# PATIENT_LOCATOR_REDISCOVER=1 re-runs ITI-55 in the background for hits older than half the freshness window
+PATIENT_LOCATOR_REDISCOVER = os.environ.get("PATIENT_LOCATOR_REDISCOVER", "") == "1"
+# how long a search waits, before it returns, for rediscoveries still running; the rest are cancelled
+PATIENT_LOCATOR_REDISCOVER_TIMEOUT = float(os.environ.get("PATIENT_LOCATOR_REDISCOVER_TIMEOUT", 10))
+# a gateway that answered NF or Multiple for this patient within this many seconds is not asked again. 0 turns it off
+PATIENT_NEGATIVE_TTL = int(os.environ.get("PATIENT_NEGATIVE_TTL", 24 * 60 * 60))
+
+LOCATOR_TABLE_NAME = 'patient_locator'
+NEGATIVE_TABLE_NAME = 'patient_locator_negative'
+
+CREATE_LOCATOR_TABLE = f'''
+CREATE TABLE IF NOT EXISTS {LOCATOR_TABLE_NAME} (
+    demographics_hash text NOT NULL,
+    oid text NOT NULL,
+    name text NOT NULL DEFAULT '',
+    patient_ids jsonb NOT NULL,
+    patient_metadata jsonb NOT NULL,
+    located_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (demographics_hash, oid)
+);
+CREATE TABLE IF NOT EXISTS {NEGATIVE_TABLE_NAME} (
+    demographics_hash text NOT NULL,
+    oid text NOT NULL,
+    status text NOT NULL,
+    checked_at timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (demographics_hash, oid)
+);
+'''
+
+UPSERT_NEGATIVE_ROW = f'''
+INSERT INTO {NEGATIVE_TABLE_NAME} (demographics_hash, oid, status, checked_at)
+VALUES (%s, %s, %s, now())
+ON CONFLICT (demographics_hash, oid) DO UPDATE SET status = EXCLUDED.status, checked_at = EXCLUDED.checked_at
+'''
+
+SELECT_NEGATIVE = f'''
+SELECT oid, status FROM {NEGATIVE_TABLE_NAME}
+WHERE demographics_hash = %s AND checked_at > now() - make_interval(secs => %s)
+'''
+
+UPSERT_LOCATOR_ROW = f'''
+INSERT INTO {LOCATOR_TABLE_NAME} (demographics_hash, oid, name, patient_ids, patient_metadata, located_at)
+VALUES (%s, %s, %s, %s, %s, now())
+ON CONFLICT (demographics_hash, oid) DO UPDATE SET
+    name = EXCLUDED.name, patient_ids = EXCLUDED.patient_ids,
+    patient_metadata = EXCLUDED.patient_metadata, located_at = EXCLUDED.located_at
+'''
+
+SELECT_LOCATED = f'''
+SELECT oid, name, patient_ids, patient_metadata, extract(epoch from now() - located_at)
+FROM {LOCATOR_TABLE_NAME}
+WHERE demographics_hash = %s AND located_at > now() - make_interval(secs => %s)
+'''
+
+DELETE_LOCATED = f"DELETE FROM {LOCATOR_TABLE_NAME} WHERE demographics_hash = %s AND oid = %s"
+DELETE_NEGATIVE = f"DELETE FROM {NEGATIVE_TABLE_NAME} WHERE demographics_hash = %s AND oid = %s"
+
+tables_ready = False
+
+# gateways skipped thanks to a cached NF/Multiple, and gateways that had to be asked
+negative_stats = {"hits": 0, "misses": 0}
+
+# fields that identify the person; address and phone change too often to be part of the key
+DEMOGRAPHIC_FIELDS = ['given_name', 'family_name', 'birth_time', 'administrative_gender_code']
+
+
+def normalize(field, value):
+    if value is None:
+        return ''
+    value = str(value).strip().lower()
+    if field == 'birth_time':
+        # 1980-01-02, 19800102 and 19800102000000 are the same birthday
+        return re.sub(r'\D', '', value)[:8]
+    if field == 'administrative_gender_code':
+        return value[:1]
+    return re.sub(r'[^a-z0-9]', '', value)
+
+
+def demographics_hash(patient_metadata):
+    '''
+    patient_metadata is a PatientMetadata or a plain dict of it
+    '''
+    metadata = patient_metadata if isinstance(patient_metadata, dict) else patient_metadata.get_dict()
+    normalized = '|'.join(normalize(field, metadata.get(field)) for field in DEMOGRAPHIC_FIELDS)
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def ensure_tables(cur):
+    global tables_ready
+    if not tables_ready:
+        cur.execute(CREATE_LOCATOR_TABLE)
+        tables_ready = True
+
+
+def lookup(cur, demo_hash, freshness=PATIENT_LOCATOR_FRESHNESS):
+    '''
+    oid -> {"name", "patient_ids": [(root, extension)], "patient_metadata": dict, "age": seconds} for gateways
+    that matched this patient within the freshness window
+    '''
+    if freshness <= 0:
+        return {}
+    try:
+        ensure_tables(cur)
+        cur.execute(SELECT_LOCATED, (demo_hash, freshness))
+        return {
+            oid: {"name": name,
+                  "patient_ids": [tuple(patient_id) for patient_id in patient_ids],
+                  "patient_metadata": patient_metadata,
+                  "age": float(age)}
+            for oid, name, patient_ids, patient_metadata, age in cur.fetchall()
+        }
+    except Exception as e:
+        print("patient locator lookup failed,", repr(e))
+        return {}
+
+
+async def ensure_tables_async(db):
+    global tables_ready
+    if not tables_ready:
+        await db.execute(CREATE_LOCATOR_TABLE)
+        tables_ready = True
+
+
+def locator_rows(demo_hash, pipelines):
+    return [
+        (demo_hash, pipeline.oid, pipeline.name, json.dumps(pipeline.patient_ids),
+         json.dumps(pipeline.patient_metadata.get_dict()))
+        for pipeline in pipelines if pipeline.patient_ids
+    ]
+
+
+async def record(db, demo_hash, pipelines):
+    '''
+    remembers the gateways where ITI-55 came back with exactly one patient. db is an async_db.AsyncDB,
+    this runs on the search path
+    '''
+    rows = locator_rows(demo_hash, pipelines)
+    if not rows:
+        return 0
+    try:
+        await ensure_tables_async(db)
+        await db.executemany(UPSERT_LOCATOR_ROW, rows)
+        return len(rows)
+    except Exception as e:
+        print("patient locator record failed,", repr(e))
+        return 0
+
+def needs_rediscovery(located, freshness=PATIENT_LOCATOR_FRESHNESS):
+    return PATIENT_LOCATOR_REDISCOVER and located["age"] > freshness / 2
+
+
+async def forget(db, demo_hash, oid):
+    '''
+    a gateway that stopped matching goes back to the full ITI-55 path
+    '''
+    try:
+        await ensure_tables_async(db)
+        await db.execute(DELETE_LOCATED, (demo_hash, oid))
+    except Exception as e:
+        print("patient locator forget failed,", repr(e))
+
+
+def lookup_negative(cur, demo_hash, ttl=PATIENT_NEGATIVE_TTL):
+    '''
+    oid -> "NF" / "Multiple" for gateways that recently didn't give us exactly one patient
+    '''
+    if ttl <= 0:
+        return {}
+    try:
+        ensure_tables(cur)
+        cur.execute(SELECT_NEGATIVE, (demo_hash, ttl))
+        return dict(cur.fetchall())
+    except Exception as e:
+        print("patient negative cache lookup failed,", repr(e))
+        return {}
+
+
+def negative_changes(demo_hash, statuses):
+    '''
+    statuses is oid -> what ITI-55 returned. NF and Multiple are cached, a match clears what was cached,
+    and a timeout or error says nothing about the patient so it's left alone
+    '''
+    negative_rows = [(demo_hash, oid, status) for oid, status in statuses.items() if status in ["NF", "Multiple"]]
+    matched = [(demo_hash, oid) for oid, status in statuses.items() if not isinstance(status, (str, type(None)))]
+    return negative_rows, matched
+
+
+async def record_negative(db, demo_hash, statuses):
+    negative_rows, matched = negative_changes(demo_hash, statuses)
+    try:
+        await ensure_tables_async(db)
+        await db.executemany(UPSERT_NEGATIVE_ROW, negative_rows)
+        await db.executemany(DELETE_NEGATIVE, matched)
+    except Exception as e:
+        print("patient negative cache record failed,", repr(e))
+
+
+def stats():
+    return dict(negative_stats)
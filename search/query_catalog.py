@@ -0,0 +1,85 @@
+import json
+
+from document_registry import REGISTRY_TABLE_NAME
+
+# responder queries. each one is PREPAREd once per database session and EXECUTEd with bound parameters after that,
+# so postgres plans it once and nothing from a request is ever spliced into sql text
+# name -> (parameter types, sql). {table} is filled in for per-table queries and becomes part of the statement name
+QUERIES = {
+    'patient_resources_by_ids': (
+        ['text[]'], "SELECT id, resource FROM Patient WHERE id = ANY($1)"),
+    'registry_documents_for_patients': (
+        ['text[]'],
+        f'''SELECT doc_id, patient_id, table_name, loinc_code, format_code, format_system,
+        hcf_code, hcf_system, creation_time, size, hash
+        FROM {REGISTRY_TABLE_NAME} WHERE patient_id = ANY($1)'''),
+    # straight off a fhir table, for ITI-38 before the registry has been backfilled
+    'documents_for_patients_live': (
+        ['text[]'],
+        '''SELECT id, txid, ts, resource FROM {table} WHERE resource#>>'{{patient,id}}' = ANY($1)
+        OR resource#>>'{{subject,id}}' = ANY($1) OR resource->>'patientFhirId' = ANY($1)'''),
+    'document_versions': (
+        ['text[]'], "SELECT id, txid FROM {table} WHERE id = ANY($1)"),
+}
+
+# ITI-55 demographic field -> (jsonb containment on Patient, how the field value becomes the jsonb argument)
+PATIENT_FIELD_QUERIES = {
+    'given': ("resource->'name' @> $1", lambda value: [{"given": [value]}]),
+    'family': ("resource->'name' @> $1", lambda value: [{"family": value}]),
+    'birthtime': ("resource->'birthDate' @> $1", lambda value: value),
+    'gender': ("resource->'gender' @> $1", lambda value: value),
+    'city': ("resource->'address' @> $1", lambda value: [{"city": value}]),
+    'state': ("resource->'address' @> $1", lambda value: [{"state": value}]),
+    'line': ("resource->'address' @> $1", lambda value: [{"line": [value]}]),
+    'country': ("resource->'address' @> $1", lambda value: [{"country": value}]),
+    'postal_code': ("resource->'address' @> $1", lambda value: [{"postalCode": [value]}]),
+    'mmname': ("resource->'extension' @> $1", lambda value: [
+        {"url": "http://hl7.org/fhir/StructureDefinition/patient-mothersMaidenName", "valueString": value}]),
+    'patient_telecom': ("resource->'telecom' @> $1", lambda value: [{"value": value}]),
+    'telecom_use': ("resource->'telecom' @> $1", lambda value: [{"use": value}]),
+    'pcp_id_root': ("resource->'pcpid' @> $1", lambda value: [{"root": value}]),
+    'pcp_id_extension': ("resource->'pcpid' @> $1", lambda value: [{"extension": value}]),
+}
+
+for field, (condition, _) in PATIENT_FIELD_QUERIES.items():
+    QUERIES['patient_ids_by_' + field] = (['jsonb'], f"SELECT id FROM Patient WHERE {condition}")
+
+
+def patient_field_argument(field, value):
+    return json.dumps(PATIENT_FIELD_QUERIES[field][1](value))
+
+
+# (id(connection), backend pid) -> names of statements prepared in that session
+prepared = {}
+
+
+def forget(connection):
+    '''
+    call when a connection is closed, so a new session never assumes statements it doesn't have
+    '''
+    for key in [key for key in prepared if key[0] == id(connection)]:
+        prepared.pop(key, None)
+
+
+def statement_for(name, table=None):
+    types, sql = QUERIES[name]
+    if table is not None:
+        return f"{name}_{table}".lower(), types, sql.format(table=table)
+    return name, types, sql
+
+
+def execute(cur, name, params=(), table=None):
+    '''
+    runs a catalog query on cur, preparing it first if this session hasn't seen it yet
+    '''
+    statement_name, types, sql = statement_for(name, table)
+    connection = cur.connection
+    session_statements = prepared.setdefault((id(connection), connection.get_backend_pid()), set())
+    if statement_name not in session_statements:
+        cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = %s", (statement_name,))
+        if cur.fetchone() is None:
+            cur.execute(f"PREPARE {statement_name} ({', '.join(types)}) AS {sql}")
+        session_statements.add(statement_name)
+    placeholders = ', '.join(['%s'] * len(params))
+    cur.execute(f"EXECUTE {statement_name} ({placeholders})", params)
+    return cur
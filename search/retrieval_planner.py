@@ -0,0 +1,112 @@
+import os
+
+import retrieval_scheduler
+from iti39initiator import ITI39Initiator
+
+ENV = os.environ.get("ENV")
+
+
+def request_key(entry):
+    '''
+    requests for the same document from several pipelines are one document request
+    '''
+    return entry["rid"], entry["doc_id"]
+
+
+def group_key(entry):
+    '''
+    document requests that can share one ITI-39: same gateway, same home community, same repository
+    '''
+    pipeline = entry["pipeline"]
+    return pipeline.url39resp, entry["replacement_hcid"] or pipeline.oid, entry["rid"]
+
+
+class RetrievalPlanner:
+    '''
+    pools the document requests of every pipeline in a search, sends them as merged ITI-39 batches per
+    (gateway url, home community, repository) and hands each document back to every pipeline that asked for it
+    '''
+
+    def __init__(self, pipelines, sorting_schema):
+        self.pipelines = pipelines
+        self.sorting_schema = sorting_schema
+        self.deferred = []
+        self.batches = 0
+
+    def planned_entries(self):
+        '''
+        every listed document that isn't already in hand (see document_store.DocumentDeduplicator.skip_stored)
+        '''
+        return [dict(entry, pipeline=pipeline) for pipeline in self.pipelines for entry in pipeline.pids_and_doc_ids
+                if entry["doc_id"] not in pipeline.retrieved_doc_ids]
+
+    async def run(self, budgets, entries=None):
+        entries = self.planned_entries() if entries is None else entries
+        gateways = set(entry["pipeline"].url39resp for entry in entries)
+        # RETRIEVAL_CONCURRENCY requests in flight per gateway, however the priorities fall
+        scheduler = retrieval_scheduler.RetrievalScheduler(
+            entries, self.sorting_schema, budgets, group_key=group_key,
+            concurrency=retrieval_scheduler.RETRIEVAL_CONCURRENCY * max(1, len(gateways)),
+            entry_budget=lambda entry: entry["pipeline"].retrieval_budget,
+            lane_key=lambda entry: entry["pipeline"].url39resp,
+            lane_concurrency=retrieval_scheduler.RETRIEVAL_CONCURRENCY)
+        self.deferred = await scheduler.run(self.retrieve_chunk)
+        print("retrieved documents for", len(self.pipelines), "pipelines in", self.batches, "ITI-39 batches")
+        return self.deferred
+
+    async def continue_deferred(self, seconds):
+        '''
+        retrieves what run deferred, within seconds and the search's byte budget but without the per pipeline
+        ones, and records the sync of the pipelines it touched
+        '''
+        deferred, self.deferred = self.deferred, []
+        for entry in deferred:
+            entry["pipeline"].retrieval_budget = retrieval_scheduler.unlimited()
+        await self.run([retrieval_scheduler.RetrievalBudget(max_seconds=seconds)], deferred)
+        print("continued retrieval for", len(deferred), "deferred documents")
+        for pipeline in set(entry["pipeline"] for entry in deferred):
+            await pipeline.record_sync()
+
+    async def retrieve_chunk(self, chunk):
+        '''
+        one merged ITI-39 request; returns the bytes it brought in
+        '''
+        requesters = {}  # (rid, doc_id) -> pipelines that want it
+        requests = []
+        for entry in chunk:
+            key = request_key(entry)
+            if key not in requesters:
+                requesters[key] = []
+                requests.append(entry)
+            requesters[key].append(entry["pipeline"])
+
+        url, hcid, _ = group_key(chunk[0])
+        pipeline = chunk[0]["pipeline"]
+        try:
+            iti39initiator = ITI39Initiator(
+                params={"pid_and_doc_ids": requests},
+                responder_url=url,
+                responder_hcid=hcid,
+                user_qualifications=pipeline.user_qualifications)
+        except:
+            print("issue creating iti39 initiator")
+            return 0
+        self.batches += 1
+
+        received = 0
+        received_bytes = 0
+        async for record in iti39initiator.stream_documents():
+            received += 1
+            if record["document"] is not None:
+                received_bytes += len(record["document"])
+            # responders don't always echo the repository, fall back to the document id alone
+            for requester in requesters.get((record["repo_id"], record["doc_id"])) or [
+                    requester for (rid, doc_id), pipelines in requesters.items() if doc_id == record["doc_id"]
+                    for requester in pipelines]:
+                requester.sort_document(record)
+        for requester in set(entry["pipeline"] for entry in chunk):
+            requester.iti39initiators.append(iti39initiator)
+            requester.received_39_counts.append(received)
+        if received == 0:
+            print("no clinical documents found in 39 response from", url)
+        return received_bytes
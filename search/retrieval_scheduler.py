@@ -0,0 +1,198 @@
+import asyncio
+import os
+import time
+
+ENV = os.environ.get("ENV")
+
+# documents per ITI-39 request. epic complains if > 10 per request, some endpoints answer 429 on many small ones
+RETRIEVAL_CHUNK_SIZE = int(os.environ.get("RETRIEVAL_CHUNK_SIZE", 5))
+# ITI-39 requests kept in flight per gateway; requests go out in priority order
+RETRIEVAL_CONCURRENCY = int(os.environ.get("RETRIEVAL_CONCURRENCY", 4))
+# per pipeline budget, after which the rest is deferred. 0 is no limit
+RETRIEVAL_PIPELINE_BYTES = int(os.environ.get("RETRIEVAL_PIPELINE_BYTES", 50 * 1024 * 1024))
+RETRIEVAL_PIPELINE_SECONDS = float(os.environ.get("RETRIEVAL_PIPELINE_SECONDS", 30))
+# budget shared by every pipeline of one search request
+RETRIEVAL_GLOBAL_BYTES = int(os.environ.get("RETRIEVAL_GLOBAL_BYTES", 250 * 1024 * 1024))
+RETRIEVAL_GLOBAL_SECONDS = float(os.environ.get("RETRIEVAL_GLOBAL_SECONDS", 45))
+# RETRIEVAL_CONTINUE=0 leaves deferred documents to the next sync instead of fetching them with whatever time the
+# invocation has left once the search is done
+RETRIEVAL_CONTINUE = os.environ.get("RETRIEVAL_CONTINUE", "1") == "1"
+# seconds of the invocation kept back from the continuation, for writing what it retrieved and returning
+RETRIEVAL_CONTINUE_MARGIN = float(os.environ.get("RETRIEVAL_CONTINUE_MARGIN", 15))
+
+# what a clinician opens first. types in doc_sorting_schema come before anything else, in this order
+TYPE_PRIORITY = [
+    '18776-5',  # discharge summary
+    '34133-9',  # summary of episode (ccd)
+    '11488-4',  # consultation note
+    '34117-2',  # history and physical
+    '18761-7',  # transfer summary
+    '11504-8',  # operative note
+    '57133-1',  # referral note
+    '11506-3',  # progress note
+]
+
+
+def priority(entry, sorting_schema):
+    '''
+    sort key for a pids_and_doc_ids entry: known document type, then newest first, then smallest first
+    (entries without an advertised size go after the ones with one)
+    '''
+    doc_type = entry.get("type")
+    if doc_type in TYPE_PRIORITY:
+        type_rank = TYPE_PRIORITY.index(doc_type)
+    elif doc_type in sorting_schema:
+        type_rank = len(TYPE_PRIORITY)
+    else:
+        type_rank = len(TYPE_PRIORITY) + 1
+    # hl7 timestamps sort as strings; negate by sorting on the reversed digits
+    creation_time = entry.get("creation_time") or ''
+    recency = ''.join(chr(ord('9') - ord(digit) + ord('0')) if digit.isdigit() else digit for digit in creation_time)
+    size = entry.get("size")
+    return type_rank, recency or '~', size is None, size or 0
+
+
+class RetrievalBudget:
+    '''
+    bytes and wall clock one retrieval (a pipeline, or a whole search) may spend. 0 is no limit
+    '''
+
+    def __init__(self, max_bytes=RETRIEVAL_GLOBAL_BYTES, max_seconds=RETRIEVAL_GLOBAL_SECONDS):
+        self.max_bytes = max_bytes
+        self.deadline = time.monotonic() + max_seconds if max_seconds else None
+        self.used_bytes = 0
+        self.parent = None  # the budget this one is a share of; what's spent here is spent there too
+
+    def spend(self, num_bytes):
+        self.used_bytes += num_bytes
+        if self.parent is not None:
+            self.parent.spend(num_bytes)
+
+    def share(self, fraction):
+        '''
+        a budget for part of this one's remaining work: fraction of the bytes and of the time it has left
+        '''
+        budget = unlimited()
+        budget.parent = self
+        if self.max_bytes:
+            budget.max_bytes = self.max_bytes
+            budget.used_bytes = self.max_bytes - int(max(0, self.max_bytes - self.used_bytes) * fraction)
+        if self.deadline is not None:
+            budget.deadline = time.monotonic() + max(0.0, self.deadline - time.monotonic()) * fraction
+        return budget
+
+    def exhausted(self):
+        if self.max_bytes and self.used_bytes >= self.max_bytes:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+
+def unlimited():
+    return RetrievalBudget(max_bytes=0, max_seconds=0)
+
+
+def priority_chunks(ordered, chunk_size, group_key=None):
+    '''
+    chunks of up to chunk_size entries that share a group_key (entries that can go in one ITI-39 request),
+    ordered by their most wanted entry
+    '''
+    chunks = []
+    open_chunks = {}  # group -> chunk still taking entries
+    for entry in ordered:
+        group = group_key(entry) if group_key is not None else None
+        chunk = open_chunks.get(group)
+        if chunk is None:
+            chunk = open_chunks[group] = []
+            chunks.append(chunk)
+        chunk.append(entry)
+        if len(chunk) >= chunk_size:
+            del open_chunks[group]
+    return chunks
+
+
+# next_chunk has chunks left, but all of them are for lanes that are full
+WAIT = object()
+
+
+class RetrievalScheduler:
+    '''
+    hands out ITI-39 chunks in priority order while every budget has room. what's left once one runs out is
+    kept in deferred, for a continuation (or the next sync) to pick up.
+    budgets apply to every chunk; entry_budget, if given, returns a further budget for one entry (its pipeline's).
+    lane_key, if given, puts every chunk in a lane (its gateway) with a semaphore of lane_concurrency around its
+    requests. a worker takes the most wanted chunk whose lane has room, so one gateway holding the top of the list
+    doesn't get every worker, and doesn't hold the others up either
+    '''
+
+    def __init__(self, entries, sorting_schema, budgets, chunk_size=RETRIEVAL_CHUNK_SIZE,
+                 concurrency=RETRIEVAL_CONCURRENCY, group_key=None, entry_budget=None, lane_key=None,
+                 lane_concurrency=RETRIEVAL_CONCURRENCY):
+        ordered = sorted(entries, key=lambda entry: priority(entry, sorting_schema))
+        self.chunks = priority_chunks(ordered, chunk_size, group_key)
+        self.budgets = budgets
+        self.entry_budget = entry_budget
+        self.concurrency = max(1, concurrency)
+        self.lane_key = lane_key
+        self.lane_concurrency = max(1, lane_concurrency)
+        self.lanes = {}  # lane -> semaphore
+        self.lane_freed = None
+        self.deferred = []
+
+    def lane(self, chunk):
+        key = self.lane_key(chunk[0]) if self.lane_key is not None else None
+        if key not in self.lanes:
+            self.lanes[key] = asyncio.Semaphore(self.lane_concurrency)
+        return self.lanes[key]
+
+    def next_chunk(self):
+        '''
+        (chunk, its lane's semaphore, already acquired), None when there's nothing left, WAIT when every chunk left
+        is for a full lane
+        '''
+        while self.chunks:
+            if any(budget.exhausted() for budget in self.budgets):
+                for chunk in self.chunks:
+                    self.deferred.extend(chunk)
+                self.chunks = []
+                return None
+            index = next((i for i, chunk in enumerate(self.chunks) if not self.lane(chunk).locked()), None)
+            if index is None:
+                return WAIT
+            chunk = self.chunks.pop(index)
+            if self.entry_budget is not None:
+                self.deferred.extend(entry for entry in chunk if self.entry_budget(entry).exhausted())
+                chunk = [entry for entry in chunk if not self.entry_budget(entry).exhausted()]
+            if chunk:
+                return chunk, self.lane(chunk)
+        return None
+
+    async def worker(self, retrieve_chunk):
+        while True:
+            taken = self.next_chunk()
+            if taken is None:
+                return
+            if taken is WAIT:
+                async with self.lane_freed:
+                    await self.lane_freed.wait()
+                continue
+            chunk, lane = taken
+            # never waits: next_chunk only hands out chunks for lanes with room, and nothing runs in between
+            await lane.acquire()
+            try:
+                received_bytes = await retrieve_chunk(chunk)
+            finally:
+                lane.release()
+                async with self.lane_freed:
+                    self.lane_freed.notify_all()
+            for budget in self.budgets:
+                budget.spend(received_bytes)
+
+    async def run(self, retrieve_chunk):
+        '''
+        retrieve_chunk is a coroutine function taking a list of entries and returning the bytes it received
+        '''
+        self.lane_freed = asyncio.Condition()
+        await asyncio.gather(*[self.worker(retrieve_chunk) for _ in range(min(self.concurrency, len(self.chunks)))])
+        if self.deferred:
+            print("deferred", len(self.deferred), "documents, retrieval budget used up")
+        return self.deferred
@@ -0,0 +1,158 @@
+import asyncio
+import contextlib
+import os
+import ssl
+import sys
+import time
+
+import certs
+import startup_profile
+
+ENV = os.environ.get("ENV")
+
+# connections the shared http pool keeps open at once; 0 is no limit, which is what a session per initiator amounted to
+HTTP_CONNECTION_LIMIT = int(os.environ.get("HTTP_CONNECTION_LIMIT", 0))
+# per endpoint cap, some gateways answer 429 when we open too many at once. 0 is no limit
+HTTP_CONNECTION_LIMIT_PER_HOST = int(os.environ.get("HTTP_CONNECTION_LIMIT_PER_HOST", 0))
+# a pooled connection idle longer than this isn't reused. the pool checks it when it hands a connection out, so it
+# holds across a freeze too. keep it under the gateways' own keep-alive period
+HTTP_KEEPALIVE_TIMEOUT = int(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 15))
+
+
+class Runtime:
+    '''
+    everything that is expensive to set up and safe to keep between invocations of a warm container:
+    the event loop, the tls context and http pool, the db pool, wsdls, the signer, caches and the parse stage.
+    handlers borrow from it; nothing here is built until something asks for it
+    '''
+
+    def __init__(self):
+        self.loop = None
+        self.ssl_context = None
+        self.session = None
+        self.stale_retries = 0
+        self.last_invocation_at = None
+        self.invocations = 0
+
+    # event loop
+
+    def get_loop(self):
+        if self.loop is None or self.loop.is_closed():
+            with startup_profile.timed('event loop'):
+                self.loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self.loop)
+        return self.loop
+
+    def run(self, coroutine):
+        '''
+        drop in for asyncio.run that keeps the loop (and the http pool bound to it) for the next call
+        '''
+        return self.get_loop().run_until_complete(coroutine)
+
+    def begin_invocation(self):
+        '''
+        called at the top of every handler run. the http pool is kept however long the container sat idle;
+        connections past their keep-alive aren't reused, and one that died anyway is retried by post
+        '''
+        self.last_invocation_at = time.monotonic()
+        self.invocations += 1
+
+    # tls and http
+
+    def get_ssl_context(self):
+        if self.ssl_context is None:
+            with startup_profile.timed('ssl context'):
+                certs.ensure_cert_files()
+                ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                ssl_context.load_cert_chain(certs.CERT_FILE, certs.KEY_FILE)
+                # enforce verification of the server certificate with trusted.pem
+                ssl_context.load_verify_locations(certs.TRUSTED_FILE)
+            self.ssl_context = ssl_context
+        return self.ssl_context
+
+    def http_session(self):
+        '''
+        one aiohttp session for every initiator, so connections and tls sessions to a gateway are reused.
+        has to be used on the runtime loop. timeouts are per request
+        '''
+        if self.session is None or self.session.closed:
+            aiohttp = startup_profile.load('aiohttp')
+            ssl_context = self.get_ssl_context()
+            # the session binds to the loop it's created on
+            asyncio.set_event_loop(self.get_loop())
+            with startup_profile.timed('http session'):
+                connector = aiohttp.TCPConnector(
+                    ssl=ssl_context, limit=HTTP_CONNECTION_LIMIT, limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+                    keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+                self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    @contextlib.asynccontextmanager
+    async def post(self, url, **kwargs):
+        '''
+        session.post on the shared pool. a reused connection the gateway already closed fails before any response
+        comes back; that request goes out once more, on a fresh connection
+        '''
+        aiohttp = startup_profile.load('aiohttp')
+        session = self.http_session()
+        try:
+            response = await session.post(url, **kwargs)
+        except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError) as e:
+            self.stale_retries += 1
+            print("connection to", url, "was dead,", repr(e), "retrying")
+            response = await session.post(url, **kwargs)
+        try:
+            yield response
+        finally:
+            response.release()
+
+    def close_session(self):
+        if self.session is None:
+            return
+        session, self.session = self.session, None
+        if session.closed:
+            return
+        loop = self.get_loop()
+        if loop.is_running():
+            loop.create_task(session.close())
+        else:
+            loop.run_until_complete(session.close())
+
+    # the rest is owned by its own module; the runtime is the one place handlers go for it
+
+    def db(self):
+        return startup_profile.load('db').connection_manager
+
+    def signer(self):
+        return startup_profile.load('saml_wrapper').Saml()
+
+    def wsdl(self, wsdl_path):
+        return startup_profile.load('message_builders').get_zeep_client(wsdl_path)
+
+    def document_cache(self):
+        return startup_profile.load('document_cache').get_document_cache()
+
+    def parse_stage(self):
+        return startup_profile.load('parse_pool').get_parse_stage()
+
+    def conversion_stage(self):
+        return startup_profile.load('conversion_stage').get_conversion_stage()
+
+    def async_db(self):
+        '''
+        the search path's own db pool, for coroutines. responders stay on db()
+        '''
+        return startup_profile.load('async_db').get_async_db()
+
+    def stats(self):
+        return {"invocations": self.invocations,
+                "db": self.db().stats() if 'db' in sys.modules else None,
+                "http_session_open": self.session is not None and not self.session.closed,
+                "stale_connection_retries": self.stale_retries}
+
+
+runtime = Runtime()
+
+
+def get_runtime():
+    return runtime
@@ -1,5 +1,4 @@
 import base64
-import boto3
 import json
 import os
 import uuid
@@ -22,7 +21,6 @@ from saml2.saml import (NAMEID_FORMAT_ENTITY, NAMEID_FORMAT_UNSPECIFIED,
 from saml_config import *
 from signxml import DigestAlgorithm, SignatureMethod, XMLSigner, XMLVerifier
 
-secretsmanager = boto3.client('secretsmanager')
 secret_id = ""
 secret_params = {}
 cq_cert = ''
@@ -235,7 +233,11 @@ class Saml(object):
             "wsse",
             "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd")
 
-        soap_etree = etree.fromstring(soap_message)
+        # builders hand over the tree itself; bytes still work for anything serialized elsewhere
+        if isinstance(soap_message, etree._Element):
+            soap_etree = soap_message
+        else:
+            soap_etree = etree.fromstring(soap_message)
 
         header = soap_etree[0]
 
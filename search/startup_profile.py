@@ -0,0 +1,61 @@
+import importlib
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# STARTUP_PROFILE=0 turns the cold start report off; timings are still collected, they're cheap
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "1") == "1"
+
+# when this module was first imported, as close to container start as we can get from inside the handler module
+process_started = time.monotonic()
+
+imports = {}  # module name -> seconds spent importing it (including what it pulled in) the first time
+inits = {}  # label -> seconds spent in that one time setup
+reported = False
+
+
+def load(module_name):
+    '''
+    imports module_name on first use and records how long it took. later calls are a dict lookup
+    '''
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    started = time.monotonic()
+    module = importlib.import_module(module_name)
+    imports[module_name] = time.monotonic() - started
+    return module
+
+
+@contextmanager
+def timed(label):
+    '''
+    records a one time setup step (a pool, a client, a cache) under label
+    '''
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        inits[label] = inits.get(label, 0) + time.monotonic() - started
+
+
+def report():
+    return {
+        "since_start_ms": round((time.monotonic() - process_started) * 1000, 1),
+        "imports_ms": {name: round(seconds * 1000, 1) for name, seconds in
+                       sorted(imports.items(), key=lambda item: -item[1])},
+        "inits_ms": {label: round(seconds * 1000, 1) for label, seconds in
+                     sorted(inits.items(), key=lambda item: -item[1])},
+    }
+
+
+def report_once(path):
+    '''
+    prints the report at the end of the first invocation in a container, tagged with the path that paid for it
+    '''
+    global reported
+    if reported or not STARTUP_PROFILE:
+        return
+    reported = True
+    print("cold start profile,", path, report())
@@ -1,10 +1,8 @@
 import re
-import xml.etree.ElementTree as ET
 from datetime import datetime, timezone
 from uuid import uuid4
 
-import aiohttp
-import requests
+from lxml import etree
 
 
 def ambiguous_strip(s):
@@ -68,34 +66,70 @@ def personalize_wsdl(destination_url, responder_iti_no, template):
 
 def format_prepped_request(prepped, encoding=None):
     # prepped has .method, .path_url, .headers and .body attribute to view the request
+    import requests
     encoding = encoding or requests.utils.get_encoding_from_headers(prepped.headers)
     body = prepped.body.decode(encoding) if encoding else '<binary data>'
     headers = '\n'.join(['{}: {}'.format(*hv) for hv in prepped.headers.items()])
     return f"""{prepped.method} {prepped.path_url} HTTP/1.1{headers}{body}"""
 
 
+# opening tag of a soap envelope, with or without a namespace prefix
+ENVELOPE_START = re.compile(rb'<([A-Za-z_][\w.\-]*:)?Envelope[\s>/]')
+# what a body can start with and still be handed to the parser as is
+XML_LEADING_BYTES = b'\xef\xbb\xbf \t\r\n'
+
+
 def extract_envelope_content(envelope_bytes):
-    # Convert bytes to string
-    try:
-        envelope_string = envelope_bytes.decode('utf-8')
-    except:
-        envelope_string = envelope_bytes
+    '''
+    the soap envelope out of a response body, as bytes. multipart bodies have it wrapped in mime parts
+    found with a scan over the raw bytes, nothing is decoded. returns None if there is no whole envelope
+    '''
+    if envelope_bytes is None:
+        return None
+    if isinstance(envelope_bytes, str):
+        envelope_bytes = envelope_bytes.encode('utf-8')
+    elif not isinstance(envelope_bytes, bytes):
+        envelope_bytes = bytes(envelope_bytes)
 
+    start = ENVELOPE_START.search(envelope_bytes)
+    if start is None:
+        return None
+    end_tag = b'</' + (start.group(1) or b'') + b'Envelope'
+    end = envelope_bytes.find(end_tag, start.end())
+    if end == -1:
+        return None
+    end = envelope_bytes.find(b'>', end + len(end_tag))
+    if end == -1:
+        return None
+    if start.start() == 0 and end + 1 == len(envelope_bytes):
+        return envelope_bytes
+    return envelope_bytes[start.start():end + 1]
+
+
+def parse_envelope(payload):
+    '''
+    parses a response body once, straight from bytes when it is plain xml, otherwise from the envelope
+    found in it. returns the root element, or None if there is nothing parseable
+    '''
+    if not payload:
+        return None
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    elif not isinstance(payload, bytes):
+        payload = bytes(payload)
+
+    if payload[:64].lstrip(XML_LEADING_BYTES).startswith(b'<'):
+        try:
+            return etree.fromstring(payload)
+        except etree.XMLSyntaxError:
+            pass
+    envelope = extract_envelope_content(payload)
+    if envelope is None:
+        return None
     try:
-        # Define the regular expression pattern to match the entire envelope
-        pattern = re.compile(r'<(?:[^>:]+:)?Envelope[^>]*>.*?</(?:[^>:]+:)?Envelope>', re.DOTALL)
-
-        # Search for the envelope within the provided string
-        match = pattern.search(envelope_string)
-
-        if match:
-            # Return the entire envelope (including tags and content)
-            return match.group(0)
-        else:
-            return None
-    except Exception as e:
-        print("Error extracting envelope content:", e)
-        print("envelope_string:", envelope_string)
+        return etree.fromstring(envelope)
+    except etree.XMLSyntaxError as e:
+        print("unable to make a tree out of the envelope,", e)
         return None
 
 
@@ -0,0 +1,203 @@
+from lxml import etree
+
+NAMESPACES = {
+    'soap': 'http://www.w3.org/2003/05/soap-envelope',
+    'wsa': 'http://www.w3.org/2005/08/addressing',
+    'hl7': 'urn:hl7-org:v3',
+    'query': 'urn:oasis:names:tc:ebxml-regrep:xsd:query:3.0',
+    'rim': 'urn:oasis:names:tc:ebxml-regrep:xsd:rim:3.0',
+    'rs': 'urn:oasis:names:tc:ebxml-regrep:xsd:rs:3.0',
+    'xds': 'urn:ihe:iti:xds-b:2007',
+}
+
+RIM = '{%s}' % NAMESPACES['rim']
+
+# ebXML identification / classification schemes, https://profiles.ihe.net/ITI/TF/Volume3/ch-4.2.html
+PATIENT_ID_SCHEME = 'urn:uuid:58a6f841-87b3-4a3e-92fd-a8ffeff98427'
+UNIQUE_ID_SCHEME = 'urn:uuid:2e82c1f6-a085-4c72-9da3-8640a32e42ab'
+CLASS_CODE_SCHEME = 'urn:uuid:41a5887f-8865-4c09-adf7-e362475b143a'
+TYPE_CODE_SCHEME = 'urn:uuid:f0306f51-975f-434e-a61c-c59651d33983'
+FORMAT_CODE_SCHEME = 'urn:uuid:a09d5840-386c-46f2-b5ad-9c3699a4309d'
+LOINC_OID = '2.16.840.1.113883.6.1'
+
+
+def compile_xpath(path):
+    return etree.XPath(path, namespaces=NAMESPACES)
+
+
+def first(results):
+    '''
+    first result of a compiled XPath, or None
+    '''
+    return results[0] if results else None
+
+
+def first_string(results):
+    '''
+    first result of a text()/@attribute XPath as a plain str, or None
+    '''
+    return str(results[0]) if results else None
+
+
+# WS-Addressing, on every request
+REPLY_TO_ADDRESS = compile_xpath('(//wsa:ReplyTo/wsa:Address)[1]/text()')
+TO = compile_xpath('(//wsa:To)[1]/text()')
+MESSAGE_ID = compile_xpath('(//wsa:MessageID)[1]/text()')
+
+# a SOAP 1.2 fault in place of a response
+SOAP_FAULT = compile_xpath('//soap:Body/soap:Fault')
+
+# XCPD (ITI-55)
+QUERY_RESPONSE_CODE = compile_xpath('//hl7:queryAck/hl7:queryResponseCode/@code')
+REGISTRATION_EVENTS = compile_xpath('//hl7:controlActProcess/hl7:subject/hl7:registrationEvent')
+PATIENT = compile_xpath('(.//hl7:patient)[1]')
+PATIENT_ID = compile_xpath('(.//hl7:id)[1]')
+GIVEN = compile_xpath('(.//hl7:given)[1]/text()')
+FAMILY = compile_xpath('(.//hl7:family)[1]/text()')
+GENDER_CODE = compile_xpath('(.//hl7:administrativeGenderCode)[1]/@code')
+BIRTH_TIME = compile_xpath('(.//hl7:birthTime)[1]/@value')
+TELECOM = compile_xpath('(.//hl7:telecom)[1]/@value')
+ADDRESS = compile_xpath('(.//hl7:addr)[1]')
+STREET_ADDRESS_LINE = compile_xpath('(.//hl7:streetAddressLine)[1]/text()')
+CITY = compile_xpath('(.//hl7:city)[1]/text()')
+STATE = compile_xpath('(.//hl7:state)[1]/text()')
+POSTAL_CODE = compile_xpath('(.//hl7:postalCode)[1]/text()')
+COUNTRY = compile_xpath('(.//hl7:country)[1]/text()')
+
+QUERY_ID = compile_xpath('//hl7:PRPA_IN201305UV02/hl7:controlActProcess/hl7:queryByParameter/hl7:queryId')
+QUERY_BY_PARAMETER = compile_xpath('//hl7:PRPA_IN201305UV02/hl7:controlActProcess/hl7:queryByParameter')
+SENDER_DEVICE_ID_ROOT = compile_xpath('//hl7:PRPA_IN201305UV02/hl7:sender/hl7:device/hl7:id/@root')
+
+# ITI-55 request parameters we search on. keys are the ones ITI55Responder.search_db knows
+XCPD_PARAMETERS = {
+    'given': compile_xpath('(//hl7:livingSubjectName/hl7:value/hl7:given)[1]/text()'),
+    'family': compile_xpath('(//hl7:livingSubjectName/hl7:value/hl7:family)[1]/text()'),
+    'gender': compile_xpath('(//hl7:livingSubjectAdministrativeGender/hl7:value)[1]/@code'),
+    'birthtime': compile_xpath('(//hl7:livingSubjectBirthTime/hl7:value)[1]/@value'),
+    'city': compile_xpath('(//hl7:patientAddress/hl7:value/hl7:city)[1]/text()'),
+    'state': compile_xpath('(//hl7:patientAddress/hl7:value/hl7:state)[1]/text()'),
+    'line': compile_xpath('(//hl7:patientAddress/hl7:value/hl7:streetAddressLine)[1]/text()'),
+    'country': compile_xpath('(//hl7:patientAddress/hl7:value/hl7:country)[1]/text()'),
+    'postal_code': compile_xpath('(//hl7:patientAddress/hl7:value/hl7:postalCode)[1]/text()'),
+    'mmname': compile_xpath('(//hl7:mothersMaidenName/hl7:value/hl7:family)[1]/text()'),
+    'patient_telecom': compile_xpath('(//hl7:patientTelecom/hl7:value)[1]/@value'),
+    'telecom_use': compile_xpath('(//hl7:patientTelecom/hl7:value)[1]/@use'),
+    'pcp_id_root': compile_xpath('(//hl7:principalCareProviderId/hl7:value)[1]/@root'),
+    'pcp_id_extension': compile_xpath('(//hl7:principalCareProviderId/hl7:value)[1]/@extension'),
+}
+
+# XCA query (ITI-38)
+RETURN_TYPE = compile_xpath('//query:AdhocQueryRequest/query:ResponseOption/@returnType')
+PATIENT_ID_SLOT_VALUES = compile_xpath(
+    '//query:AdhocQuery/rim:Slot[@name="$XDSDocumentEntryPatientId"]/rim:ValueList/rim:Value/text()')
+EXTRINSIC_OBJECTS = compile_xpath('//rim:RegistryObjectList/rim:ExtrinsicObject')
+
+# XCA retrieve (ITI-39)
+DOCUMENT_REQUESTS = compile_xpath('//xds:RetrieveDocumentSetRequest/xds:DocumentRequest')
+
+
+def extract_patient(registration_event):
+    '''
+    ((patient_root, patient_extension), metadata dict) from one ITI-55 registrationEvent
+    '''
+    patient = first(PATIENT(registration_event))
+    patient_id = first(PATIENT_ID(patient))
+    address = first(ADDRESS(patient))
+    patient_metadata_dict = {
+        'given_name': first_string(GIVEN(patient)),
+        'family_name': first_string(FAMILY(patient)),
+        'administrative_gender_code': first_string(GENDER_CODE(patient)),
+        'birth_time': first_string(BIRTH_TIME(patient)),
+        'phone_number': first_string(TELECOM(patient)),
+        'street_address_line': None,
+        'city': None,
+        'state': None,
+        'postal_code': None,
+        'country': None,
+    }
+    if address is not None:
+        patient_metadata_dict.update({
+            'street_address_line': first_string(STREET_ADDRESS_LINE(address)),
+            'city': first_string(CITY(address)),
+            'state': first_string(STATE(address)),
+            'postal_code': first_string(POSTAL_CODE(address)),
+            'country': first_string(COUNTRY(address)),
+        })
+    return (patient_id.attrib['root'], patient_id.attrib['extension']), patient_metadata_dict
+
+
+def first_slot_value(slot):
+    value_list = slot.find(RIM + 'ValueList')
+    if value_list is None:
+        return None
+    value = value_list.find(RIM + 'Value')
+    return value.text if value is not None else None
+
+
+def extract_document_entry(extrinsic_object, default_hcid):
+    '''
+    everything we use from one ExtrinsicObject, from a single walk over its children
+    '''
+    home = extrinsic_object.get('home')
+    entry = {
+        "entry_uuid": extrinsic_object.get('id'),
+        "mime_type": extrinsic_object.get('mimeType'),
+        # for surescripts docs can be at a different hcid as the patient
+        "replacement_hcid": home[len('urn:oid:'):] if home and home.startswith('urn:oid:') else (home or default_hcid),
+        "pid": None, "doc_id": None, "rid": None, "type": None,
+        "creation_time": None, "service_start_time": None, "size": None, "hash": None,
+        "class_code": None, "type_code": None, "format_code": None,
+    }
+    assigning_authority = None
+    for child in extrinsic_object:
+        tag = child.tag
+        if tag == RIM + 'Slot':
+            name = child.get('name')
+            if name == 'repositoryUniqueId':
+                entry["rid"] = first_slot_value(child)
+            elif name == 'creationTime':
+                entry["creation_time"] = first_slot_value(child)
+            elif name == 'serviceStartTime':
+                entry["service_start_time"] = first_slot_value(child)
+            elif name == 'size':
+                size = first_slot_value(child)
+                entry["size"] = int(size) if size and size.isdigit() else None
+            elif name == 'hash':
+                entry["hash"] = first_slot_value(child)
+        elif tag == RIM + 'Classification':
+            scheme = child.get('classificationScheme')
+            code = child.get('nodeRepresentation')
+            if scheme == CLASS_CODE_SCHEME:
+                entry["class_code"] = code
+            elif scheme == TYPE_CODE_SCHEME:
+                entry["type_code"] = code
+            elif scheme == FORMAT_CODE_SCHEME:
+                entry["format_code"] = code
+            if entry["type"] is None and code:
+                coding_scheme = child.find(RIM + 'Slot')
+                if coding_scheme is not None and first_slot_value(coding_scheme) == LOINC_OID:
+                    entry["type"] = code
+        elif tag == RIM + 'ExternalIdentifier':
+            scheme = child.get('identificationScheme')
+            if scheme == PATIENT_ID_SCHEME:
+                pid_and_authority = child.get('value', '')
+                entry["pid"] = pid_and_authority.split("^^^")[0]
+                if "^^^&" in pid_and_authority:
+                    assigning_authority = pid_and_authority.split("^^^&")[1].split("&")[0]
+            elif scheme == UNIQUE_ID_SCHEME:
+                entry["doc_id"] = child.get('value')
+    if entry["rid"] is None:
+        entry["rid"] = assigning_authority
+    return entry
+
+
+def extract_document_entries(tree, default_hcid):
+    '''
+    document entries from an ITI-38 response that have what an ITI-39 request needs and a LOINC type
+    '''
+    entries = []
+    for extrinsic_object in EXTRINSIC_OBJECTS(tree):
+        entry = extract_document_entry(extrinsic_object, default_hcid)
+        if entry["type"] and entry["pid"] is not None and entry["doc_id"] is not None and entry["rid"] is not None:
+            entries.append(entry)
+    return entries